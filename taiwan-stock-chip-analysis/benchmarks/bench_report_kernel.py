@@ -0,0 +1,90 @@
+"""
+報告彙總核心效能測試
+比較逐項分組 (analyze_top_brokers / analyze_branch_activity / detect_unusual_activity)
+與 fused_aggregate 單次掃描在大量資料下的耗時
+
+使用方式: python benchmarks/bench_report_kernel.py [--rows 1000000] [--repeat 3]
+"""
+import argparse
+import logging
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# 添加專案根目錄到路徑
+sys.path.append(str(Path(__file__).parent.parent))
+from src.analyzer.chip_analyzer import ChipAnalyzer
+
+def make_synthetic_day(rows: int, brokers: int = 120, branches_per_broker: int = 40, seed: int = 0) -> pd.DataFrame:
+    """產生一個交易日的合成券商分點資料 (分析器欄位格式)"""
+    rng = np.random.default_rng(seed)
+
+    broker_ids = rng.integers(0, brokers, rows)
+    branch_ids = rng.integers(0, branches_per_broker, rows)
+    broker_names = np.array([f"{1000 + i * 7:04d}" for i in range(brokers)], dtype=object)
+    branch_names = np.array([f"分點{i:03d}" for i in range(branches_per_broker)], dtype=object)
+
+    df = pd.DataFrame({
+        '券商': broker_names[broker_ids],
+        '分點': branch_names[branch_ids],
+        '買進股數': rng.integers(0, 200000, rows),
+        '賣出股數': rng.integers(0, 200000, rows),
+        '買進金額': rng.integers(0, 50000000, rows),
+        '賣出金額': rng.integers(0, 50000000, rows),
+    })
+    df['淨買賣股數'] = df['買進股數'] - df['賣出股數']
+    df['淨買賣金額'] = df['買進金額'] - df['賣出金額']
+    return df
+
+def multi_pass(analyzer: ChipAnalyzer, df: pd.DataFrame) -> dict:
+    """原本的逐項計算方式，每一項各自以字串鍵分組"""
+    return {
+        '券商數量': df['券商'].nunique(),
+        '分點數量': len(df.groupby(['券商', '分點'])),
+        '主要券商': analyzer.analyze_top_brokers(df),
+        '活躍分點': analyzer.analyze_branch_activity(df),
+        '異常交易': analyzer.detect_unusual_activity(df),
+    }
+
+def best_of(func, repeat: int) -> float:
+    """執行 repeat 次取最短耗時 (秒)"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description='報告彙總核心效能測試')
+    parser.add_argument('--rows', type=int, default=1_000_000, help='合成資料筆數 (預設1,000,000)')
+    parser.add_argument('--repeat', type=int, default=3, help='重複次數，取最短耗時 (預設3)')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    analyzer = ChipAnalyzer()
+
+    print(f"產生 {args.rows:,} 筆合成資料...")
+    df = make_synthetic_day(args.rows)
+
+    # 先確認兩種方式結果一致
+    expected = multi_pass(analyzer, df)
+    actual = analyzer.compute_report_tables(df)
+    for key in ['主要券商', '活躍分點', '異常交易']:
+        if not expected[key].equals(actual[key]):
+            raise SystemExit(f"結果不一致: {key}")
+    if (expected['券商數量'], expected['分點數量']) != (actual['基本統計']['券商數量'], actual['基本統計']['分點數量']):
+        raise SystemExit("結果不一致: 基本統計")
+
+    multi_time = best_of(lambda: multi_pass(analyzer, df), args.repeat)
+    fused_time = best_of(lambda: analyzer.compute_report_tables(df), args.repeat)
+
+    print(f"逐項分組:     {multi_time * 1000:10.1f} ms")
+    print(f"單次融合彙總: {fused_time * 1000:10.1f} ms")
+    print(f"加速倍數:     {multi_time / fused_time:10.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+本機假 TWSE 伺服器
+以合成資料回應 BFIAMU、STOCK_DAY_ALL 與休市日期表，供效能測試在不連網的情況下量測收集流程
+
+單獨執行: python benchmarks/fake_twse.py --port 8765
+接著以 TWSE_WEB_BASE=http://127.0.0.1:8765 執行主程式，即可對假伺服器收集資料
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+from synthetic import make_bfiamu_payload, make_stock_codes, make_stock_day_all_payload
+
+NO_DATA = {'stat': '很抱歉，沒有符合條件的資料!'}
+
+class FakeTWSEServer:
+    """在背景執行緒執行的假 TWSE 伺服器"""
+
+    def __init__(self, stock_codes: List[str], branches: int = 1000, port: int = 0,
+                 latency: float = 0.0):
+        """
+        Args:
+            stock_codes: 有資料的股票代碼
+            branches: 每檔股票每日的分點數
+            port: 監聽埠號，0 表示自動選擇
+            latency: 每個回應額外等待的秒數 (模擬網路延遲)
+        """
+        self.stock_codes = list(stock_codes)
+        self.branches = branches
+        self.latency = latency
+        self.request_count = 0
+
+        self._known = set(self.stock_codes)
+        self._payloads: Dict[tuple, bytes] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', port), self._handler_class())
+        self._httpd.daemon_threads = True
+
+    @property
+    def base_url(self) -> str:
+        """伺服器網址 (設定為 TWSE_WEB_BASE)"""
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def preload(self, dates: List[str]):
+        """預先產生並快取回應，量測時不含產生資料的時間"""
+        for date in dates:
+            date = date.replace('-', '')
+            self._response('STOCK_DAY_ALL', date)
+            for stock_code in self.stock_codes:
+                self._response('BFIAMU', date, stock_code)
+
+    def _response(self, endpoint: str, date: str, stock_code: str = None) -> bytes:
+        """取得 (端點, 日期, 股票) 的回應內容"""
+        key = (endpoint, date, stock_code)
+        with self._lock:
+            body = self._payloads.get(key)
+        if body is not None:
+            return body
+
+        if endpoint == 'BFIAMU':
+            payload = make_bfiamu_payload(stock_code, date, self.branches) if stock_code in self._known else NO_DATA
+        elif endpoint == 'STOCK_DAY_ALL':
+            payload = make_stock_day_all_payload(self.stock_codes, date)
+        else:
+            payload = {'stat': 'OK', 'fields': ['名稱', '日期', '星期', '說明'], 'data': []}
+
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        with self._lock:
+            self._payloads[key] = body
+        return body
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            routes = {
+                '/exchangeReport/BFIAMU': 'BFIAMU',
+                '/rwd/zh/afterTrading/STOCK_DAY_ALL': 'STOCK_DAY_ALL',
+                '/holidaySchedule/holidaySchedule': 'holidaySchedule',
+            }
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                endpoint = self.routes.get(url.path)
+                if endpoint is None:
+                    self.send_error(404)
+                    return
+
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                body = server._response(endpoint, params.get('date', ''), params.get('stockNo'))
+
+                with server._lock:
+                    server.request_count += 1
+                if server.latency:
+                    time.sleep(server.latency)
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> 'FakeTWSEServer':
+        """在背景執行緒開始服務"""
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='fake-twse', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """停止服務"""
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='本機假 TWSE 伺服器')
+    parser.add_argument('--port', type=int, default=8765, help='監聽埠號 (預設8765)')
+    parser.add_argument('--stocks', type=int, default=200, help='有資料的股票數 (預設200)')
+    parser.add_argument('--branches', type=int, default=1000, help='每檔股票每日的分點數 (預設1000)')
+    parser.add_argument('--latency', type=float, default=0.0, help='每個回應的延遲秒數')
+    args = parser.parse_args()
+
+    fake = FakeTWSEServer(make_stock_codes(args.stocks), args.branches, args.port, args.latency)
+    print(f"假 TWSE 伺服器: {fake.base_url} (股票 {args.stocks} 檔，代碼 {fake.stock_codes[0]} 起)")
+    try:
+        fake._httpd.serve_forever()
+    except KeyboardInterrupt:
+        fake.stop()
@@ -0,0 +1,205 @@
+"""
+收集 → 儲存 → 分析 流程效能測試
+以合成資料 (每檔股票上千個分點、每日數百檔股票) 與本機假 TWSE 伺服器量測各階段的耗時與記憶體高峰，
+並與 baselines.json 比較，超出容許範圍時以非零狀態結束
+
+使用方式:
+    python benchmarks/run_benchmarks.py                      # 與基準比較
+    python benchmarks/run_benchmarks.py --update-baseline    # 更新基準
+    python benchmarks/run_benchmarks.py --stocks 20 --branches 500 --days 1 --case collect
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Dict
+
+BENCH_DIR = Path(__file__).parent
+DEFAULT_BASELINE = BENCH_DIR / "baselines.json"
+
+# 添加專案根目錄到路徑
+sys.path.append(str(BENCH_DIR.parent))
+from fake_twse import FakeTWSEServer
+from synthetic import make_market_frame, make_stock_codes, make_trading_dates
+
+def measure(run: Callable, repeat: int, setup: Callable = None) -> Dict[str, float]:
+    """
+    量測 run(state) 的耗時 (repeat 次取最短) 與記憶體高峰 (另外執行一次，以 tracemalloc 追蹤)
+
+    Args:
+        run: 受測函式，參數為 setup 的回傳值
+        repeat: 計時次數
+        setup: 每次執行前的準備 (不計入耗時)
+
+    Returns:
+        {'seconds': 最短耗時, 'peak_mb': Python 與 NumPy 配置的記憶體高峰}
+    """
+    timings = []
+    for _ in range(repeat):
+        state = setup() if setup else None
+        start = time.perf_counter()
+        run(state)
+        timings.append(time.perf_counter() - start)
+
+    state = setup() if setup else None
+    tracemalloc.start()
+    try:
+        run(state)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {'seconds': round(min(timings), 4), 'peak_mb': round(peak / 2 ** 20, 2)}
+
+def build_cases(args, work_dir: Path) -> Dict[str, tuple]:
+    """建立測試項目 {名稱: (run, setup)}"""
+    from src.analyzer.chip_analyzer import ChipAnalyzer
+    from src.analyzer.market_screener import MarketScreener
+    from src.data_collector.twse_collector import TWSECollector
+    from src.utils.database import ChipDatabase
+    from src.utils.rate_limiter import RateLimiter
+    from main import ANALYSIS_COLUMNS
+
+    stock_codes = make_stock_codes(args.stocks)
+    dates = make_trading_dates(args.days)
+    latest = dates[-1]
+
+    print(f"產生合成資料: {args.stocks} 檔股票 × {args.days} 日 × {args.branches} 分點...")
+    market = make_market_frame(stock_codes, dates, args.branches)
+
+    # 查詢與分析共用一份已寫入的資料庫
+    query_db = ChipDatabase(work_dir / "query.db")
+    query_db.insert_broker_data(market)
+
+    analyzer = ChipAnalyzer()
+    stock_day = query_db.get_broker_data(stock_code=stock_codes[0], date=latest).rename(columns=ANALYSIS_COLUMNS)
+    market_day = market[market['date'] == latest.replace('-', '')]
+    report = analyzer.generate_analysis_report(analyzer.clean_broker_data(market_day.copy()), 'market')
+
+    db_counter = iter(range(1_000_000))
+
+    def fresh_db(_=None):
+        return ChipDatabase(work_dir / f"insert_{next(db_counter)}.db")
+
+    collector = TWSECollector(rate_limiter=RateLimiter(0), max_workers=args.workers)
+    tasks = [(stock_code, latest) for stock_code in stock_codes]
+
+    def collect(_):
+        rows = sum(len(df) for _, _, df in collector.iter_broker_trading(tasks) if df is not None)
+        if rows != args.stocks * args.branches:
+            raise RuntimeError(f"收集筆數不符: {rows}")
+
+    return {
+        'collect': (collect, None),
+        'insert_broker_data': (lambda db: db.insert_broker_data(market), fresh_db),
+        'get_broker_data 個股區間': (
+            lambda _: query_db.get_broker_data(stock_code=stock_codes[0], start_date=dates[0], end_date=latest), None),
+        'get_broker_data 全市場單日': (lambda _: query_db.get_broker_data(date=latest), None),
+        'get_analysis_aggregates 個股區間': (
+            lambda _: query_db.get_analysis_aggregates(stock_code=stock_codes[0], start_date=dates[0], end_date=latest),
+            None),
+        'get_top_brokers 全市場': (lambda _: query_db.get_top_brokers(days=30), None),
+        'get_top_brokers 個股': (lambda _: query_db.get_top_brokers(stock_code=stock_codes[0], days=30), None),
+        'MarketScreener.screen 全市場單日': (lambda _: MarketScreener(query_db).screen(date=latest, min_volume=0), None),
+        'clean_broker_data': (lambda _: analyzer.clean_broker_data(market_day.copy()), None),
+        'generate_analysis_report 全市場單日': (
+            lambda _: analyzer.generate_analysis_report(analyzer.clean_broker_data(market_day.copy()), 'market'), None),
+        'generate_analysis_report 個股單日': (lambda _: analyzer.generate_analysis_report(stock_day, stock_codes[0]), None),
+        'save_report_to_excel': (lambda _: analyzer.save_report_to_excel(report, str(work_dir / 'report')), None),
+        'save_report csv': (lambda _: analyzer.save_report(report, str(work_dir / 'report'), ['csv']), None),
+        'save_report html': (lambda _: analyzer.save_report(report, str(work_dir / 'report'), ['html']), None),
+    }
+
+def compare(results: Dict, baseline: Dict, tolerance: float, memory_tolerance: float) -> list:
+    """與基準比較，回傳退步的項目說明"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            continue
+        if result['seconds'] > base['seconds'] * (1 + tolerance):
+            regressions.append(f"{name}: 耗時 {result['seconds']:.3f}s > 基準 {base['seconds']:.3f}s")
+        # 記憶體另加 1 MB 的絕對容許值，避免小項目的雜訊
+        if result['peak_mb'] > base['peak_mb'] * (1 + memory_tolerance) + 1:
+            regressions.append(f"{name}: 記憶體 {result['peak_mb']:.1f}MB > 基準 {base['peak_mb']:.1f}MB")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='收集 → 儲存 → 分析 流程效能測試')
+    parser.add_argument('--stocks', type=int, default=200, help='股票數 (預設200)')
+    parser.add_argument('--branches', type=int, default=1000, help='每檔股票每日的分點數 (預設1000)')
+    parser.add_argument('--days', type=int, default=3, help='交易日數 (預設3)')
+    parser.add_argument('--workers', type=int, default=8, help='收集的並行工作數 (預設8)')
+    parser.add_argument('--repeat', type=int, default=3, help='重複次數，取最短耗時 (預設3)')
+    parser.add_argument('--case', action='append', help='只執行名稱包含此字串的項目 (可指定多個)')
+    parser.add_argument('--baseline', default=str(DEFAULT_BASELINE), help='基準檔路徑')
+    parser.add_argument('--update-baseline', action='store_true', help='以本次結果更新基準')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='耗時容許的退步比例 (預設0.5)')
+    parser.add_argument('--memory-tolerance', type=float, default=0.2, help='記憶體容許的增加比例 (預設0.2)')
+    args = parser.parse_args()
+
+    stock_codes = make_stock_codes(args.stocks)
+    fake = FakeTWSEServer(stock_codes, args.branches).start()
+
+    # 專案模組載入前指向假伺服器並停用回應快取
+    os.environ['TWSE_WEB_BASE'] = fake.base_url
+    os.environ['HTTP_CACHE_ENABLED'] = 'false'
+    logging.disable(logging.WARNING)
+
+    work_dir = Path(tempfile.mkdtemp(prefix='chip_bench_'))
+    try:
+        fake.preload(make_trading_dates(args.days)[-1:])
+        cases = build_cases(args, work_dir)
+
+        results = {}
+        for name, (run, setup) in cases.items():
+            if args.case and not any(pattern in name for pattern in args.case):
+                continue
+            results[name] = measure(run, args.repeat, setup)
+            print(f"{name:<36} {results[name]['seconds'] * 1000:10.1f} ms {results[name]['peak_mb']:10.1f} MB")
+    finally:
+        fake.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    params = {key: getattr(args, key) for key in ('stocks', 'branches', 'days', 'workers')}
+    baseline_path = Path(args.baseline)
+
+    if args.update_baseline:
+        baseline = json.loads(baseline_path.read_text(encoding='utf-8')) if baseline_path.exists() else {}
+        if baseline.get('params') != params:
+            baseline = {}
+        baseline.update({
+            'params': params,
+            'machine': f"{platform.system()} {platform.machine()} / Python {platform.python_version()}",
+        })
+        baseline.setdefault('results', {}).update(results)
+        baseline_path.write_text(json.dumps(baseline, ensure_ascii=False, indent=2) + '\n', encoding='utf-8')
+        print(f"\n基準已更新: {baseline_path}")
+        return
+
+    if not baseline_path.exists():
+        print(f"\n沒有基準檔 {baseline_path}，請以 --update-baseline 建立")
+        return
+
+    baseline = json.loads(baseline_path.read_text(encoding='utf-8'))
+    if baseline.get('params') != params:
+        print(f"\n參數與基準不同 (基準: {baseline.get('params')})，略過比較")
+        return
+
+    regressions = compare(results, baseline, args.tolerance, args.memory_tolerance)
+    if regressions:
+        print("\n效能退步:")
+        for line in regressions:
+            print(f"  {line}")
+        raise SystemExit(1)
+    print("\n與基準相比沒有退步")
+
+if __name__ == "__main__":
+    main()
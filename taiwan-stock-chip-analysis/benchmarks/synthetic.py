@@ -0,0 +1,114 @@
+"""
+合成資料產生器
+產生與證交所 BFIAMU 回應相同形狀的券商分點資料：每檔股票每日上千個分點、每日數百檔股票
+同一 (股票, 日期) 每次產生的內容都相同，供效能測試與假 TWSE 伺服器共用
+"""
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+BROKER_FIELDS = ['券商', '分點', '買進股數', '賣出股數', '買進金額', '賣出金額']
+
+# 全市場的券商與分點 (約 120 家券商、每家 30 個分點)
+BROKER_COUNT = 120
+BRANCHES_PER_BROKER = 30
+
+def make_stock_codes(count: int) -> List[str]:
+    """產生 count 個不重複的四碼股票代碼"""
+    return [f"{1101 + i * 7:04d}" for i in range(count)]
+
+def make_trading_dates(days: int, end_date: str = None) -> List[str]:
+    """產生截至 end_date (預設今天) 的最近 days 個平日 (YYYY-MM-DD)"""
+    end = pd.Timestamp(end_date) if end_date else pd.Timestamp.now().normalize()
+    return [day.strftime('%Y-%m-%d') for day in pd.bdate_range(end=end, periods=days)]
+
+def branch_universe():
+    """全市場的 (券商代碼, 分點名稱) 列表"""
+    brokers = np.repeat([f"{1020 + i * 37:04d}" for i in range(BROKER_COUNT)], BRANCHES_PER_BROKER)
+    branches = np.tile([f"分點{i:02d}" for i in range(BRANCHES_PER_BROKER)], BROKER_COUNT)
+    branches[::BRANCHES_PER_BROKER] = '總公司'
+    return brokers.astype(object), branches.astype(object)
+
+_UNIVERSE = branch_universe()
+
+def make_bfiamu_rows(stock_code: str, date: str, branches: int) -> List[List[str]]:
+    """
+    產生一檔股票一日的 BFIAMU data 陣列 (數字為含千分位逗號的字串)
+
+    Args:
+        stock_code: 股票代碼
+        date: 日期 (YYYY-MM-DD 或 YYYYMMDD)
+        branches: 有交易的分點數 (不超過全市場分點數)
+
+    Returns:
+        [[券商, 分點, 買進股數, 賣出股數, 買進金額, 賣出金額], ...]
+    """
+    rng = np.random.default_rng([int(stock_code), int(date.replace('-', ''))])
+    brokers, branch_names = _UNIVERSE
+    picked = np.sort(rng.choice(len(brokers), size=min(branches, len(brokers)), replace=False))
+
+    price = rng.uniform(10, 1000)
+    # 成交量為長尾分布，少數分點大量進出
+    buy = (rng.pareto(1.5, len(picked)) * 2000).astype(np.int64) // 1000 * 1000
+    sell = (rng.pareto(1.5, len(picked)) * 2000).astype(np.int64) // 1000 * 1000
+    buy_amount = (buy * price).astype(np.int64)
+    sell_amount = (sell * price).astype(np.int64)
+
+    return [
+        [brokers[i], branch_names[i], f"{b:,}", f"{s:,}", f"{ba:,}", f"{sa:,}"]
+        for i, b, s, ba, sa in zip(picked, buy.tolist(), sell.tolist(), buy_amount.tolist(), sell_amount.tolist())
+    ]
+
+def make_bfiamu_payload(stock_code: str, date: str, branches: int) -> Dict:
+    """產生 BFIAMU 的完整 JSON 回應"""
+    return {
+        'stat': 'OK',
+        'date': date.replace('-', ''),
+        'fields': BROKER_FIELDS,
+        'data': make_bfiamu_rows(stock_code, date, branches)
+    }
+
+def make_stock_day_all_payload(stock_codes: List[str], date: str) -> Dict:
+    """產生 STOCK_DAY_ALL 的完整 JSON 回應 (每檔股票皆有成交)"""
+    rows = []
+    for stock_code in stock_codes:
+        rng = np.random.default_rng([int(stock_code), int(date.replace('-', ''))])
+        close = round(rng.uniform(10, 1000), 2)
+        volume = int(rng.integers(1000, 50_000_000))
+        rows.append([
+            stock_code, f"股票{stock_code}", f"{volume:,}", f"{int(volume * close):,}",
+            f"{close:.2f}", f"{close:.2f}", f"{close:.2f}", f"{close:.2f}", "0.00", f"{volume // 1000:,}"
+        ])
+    return {
+        'stat': 'OK',
+        'date': date.replace('-', ''),
+        'fields': ['證券代號', '證券名稱', '成交股數', '成交金額', '開盤價', '最高價', '最低價', '收盤價', '漲跌價差', '成交筆數'],
+        'data': rows
+    }
+
+def make_market_frame(stock_codes: List[str], dates: List[str], branches: int) -> pd.DataFrame:
+    """
+    產生多日全市場的券商分點資料 (與 TWSECollector.fetch_broker_trading 的輸出格式相同)
+
+    Args:
+        stock_codes: 股票代碼列表
+        dates: 日期列表 (YYYY-MM-DD)
+        branches: 每檔股票每日的分點數
+
+    Returns:
+        券商分點資料 DataFrame
+    """
+    from src.data_collector.twse_collector import parse_broker_rows
+
+    frames = [
+        parse_broker_rows(BROKER_FIELDS, make_bfiamu_rows(stock_code, date, branches),
+                          date.replace('-', ''), stock_code)
+        for date in dates for stock_code in stock_codes
+    ]
+    df = pd.concat(frames, ignore_index=True)
+
+    # 各段的類別不同，合併後重新轉為 categorical
+    for column in ['券商', '分點', 'date', 'stock_code']:
+        df[column] = df[column].astype('category')
+    return df
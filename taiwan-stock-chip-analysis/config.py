@@ -19,6 +19,15 @@ OUTPUT_DIR = PROJECT_ROOT / "output"
 
 # 資料庫設定
 DB_PATH = os.getenv("DB_PATH", "data/chip_analysis.db")
+DB_INSERT_CHUNK_SIZE = int(os.getenv("DB_INSERT_CHUNK_SIZE", 50000))
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", 30))  # 等待寫入鎖的秒數
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", 65536))  # 每條連線的頁面快取 (KB)
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", 268435456))  # 記憶體映射讀取大小 (bytes)
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 256))  # 每條連線快取的 prepared statement 數
+
+# 儲存後端: sqlite 或 parquet (依日期、股票分區的欄式檔案，需安裝 pyarrow)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+PARQUET_DATA_DIR = PROJECT_ROOT / os.getenv("PARQUET_DATA_DIR", PROCESSED_DATA_DIR / "parquet")
 
 # API 設定
 FUGLE_API_KEY = os.getenv("FUGLE_API_KEY")
@@ -29,18 +38,49 @@ REQUEST_DELAY = float(os.getenv("REQUEST_DELAY", 1.0))
 MAX_RETRIES = int(os.getenv("MAX_RETRIES", 3))
 TIMEOUT = int(os.getenv("TIMEOUT", 30))
 
+# 並行收集設定 (全域權杖桶限速，所有請求共用)
+REQUEST_RATE = float(os.getenv("REQUEST_RATE", 1.0 / REQUEST_DELAY if REQUEST_DELAY > 0 else 0))  # 每秒請求數，0 表示不限速
+REQUEST_BURST = int(os.getenv("REQUEST_BURST", 1))
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", 8))
+
+# API 回應快取 (過去交易日永久有效，當日資料逾 TTL 秒後以 ETag / Last-Modified 重新驗證)
+HTTP_CACHE_ENABLED = os.getenv("HTTP_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+HTTP_CACHE_DIR = PROJECT_ROOT / os.getenv("HTTP_CACHE_DIR", RAW_DATA_DIR / "http_cache")
+HTTP_CACHE_TTL = float(os.getenv("HTTP_CACHE_TTL", 1800))
+
+# 交易日曆 (證交所休市日期表的本機快取，今年度資料超過指定天數即重新下載)
+TRADING_CALENDAR_PATH = PROJECT_ROOT / os.getenv("TRADING_CALENDAR_PATH", DATA_DIR / "trading_calendar.json")
+TRADING_CALENDAR_MAX_AGE_DAYS = float(os.getenv("TRADING_CALENDAR_MAX_AGE_DAYS", 1))
+
 # 分析設定
 MINIMUM_VOLUME_THRESHOLD = int(os.getenv("MINIMUM_VOLUME_THRESHOLD", 1000))
 TOP_BROKERS_COUNT = int(os.getenv("TOP_BROKERS_COUNT", 20))
+UNUSUAL_STD_THRESHOLD = float(os.getenv("UNUSUAL_STD_THRESHOLD", 2.0))  # 異常交易的標準差倍數
+# 分點異常基準: 各股票、分點淨買賣股數的指數加權平均與變異數 (跨度約為該分點最近 N 個有交易的日子)
+BASELINE_SPAN_DAYS = int(os.getenv("BASELINE_SPAN_DAYS", 20))
+BASELINE_MIN_DAYS = int(os.getenv("BASELINE_MIN_DAYS", 5))  # 基準累積不足此天數的分點不評分
+ANALYSIS_CHUNK_SIZE = int(os.getenv("ANALYSIS_CHUNK_SIZE", 200000))  # 串流分析每段讀取的筆數
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", 1))  # 批量分析的行程數，1 表示依序分析
+# 全市場主力集中度篩選
+SCREEN_TOP_BRANCHES = int(os.getenv("SCREEN_TOP_BRANCHES", 15))  # 主力買超 / 賣超取前 N 大分點
+SCREEN_MIN_VOLUME = int(os.getenv("SCREEN_MIN_VOLUME", 1000000))  # 成交股數低於此值的股票不列入排名
+
+# 執行指標 (JSON 執行摘要目錄；設定 METRICS_PROMETHEUS_FILE 時另寫入 Prometheus textfile)
+METRICS_DIR = PROJECT_ROOT / os.getenv("METRICS_DIR", OUTPUT_DIR / "metrics")
+METRICS_PROMETHEUS_FILE = os.getenv("METRICS_PROMETHEUS_FILE", "")
 
 # 輸出設定
-OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "csv,excel").split(",")
+OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "csv,html").split(",")  # 分析報告格式: csv、parquet、jsonl、html、excel
 CHART_THEME = os.getenv("CHART_THEME", "plotly_white")
 
 # TWSE API URLs
 TWSE_API_BASE = "https://openapi.twse.com.tw/v1"
+TWSE_WEB_BASE = os.getenv("TWSE_WEB_BASE", "https://www.twse.com.tw")
 TPEX_API_BASE = "https://www.tpex.org.tw/openapi/v1"
 
+# 全市場收集時需逐檔抓取券商分點的股票代碼格式 (預設為四碼的股票與 ETF)
+MARKET_STOCK_PATTERN = os.getenv("MARKET_STOCK_PATTERN", r"^\d{4}$")
+
 # 常用股票代碼 (可根據需要調整)
 DEFAULT_STOCK_CODES = [
     "2330",  # 台積電
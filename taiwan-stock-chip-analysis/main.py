@@ -2,11 +2,15 @@
 台股券商分點籌碼統計分析系統 - 主程式
 """
 import argparse
+import contextlib
 import logging
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from pathlib import Path
 import colorama
+import pandas as pd
 from colorama import Fore, Back, Style
 
 # 初始化 colorama
@@ -15,31 +19,91 @@ colorama.init()
 # 添加專案模組到路徑
 sys.path.append(str(Path(__file__).parent))
 from config import *
-from src.data_collector.twse_collector import TWSECollector
-from src.analyzer.chip_analyzer import ChipAnalyzer
-from src.utils.database import ChipDatabase
+# 收集器 (requests) 與分析器 (plotly) 載入較慢，只在子指令需要時才匯入，
+# 讓 top 等只查詢資料庫的指令能快速啟動
+from src.analyzer.report_writers import REPORT_WRITERS, normalize_formats
+from src.utils.database import open_database
+from src.utils.metrics import get_metrics
+
+# 資料庫欄位對應到分析器期望的欄位名稱
+ANALYSIS_COLUMNS = {
+    'broker_code': '券商',
+    'branch_name': '分點',
+    'buy_volume': '買進股數',
+    'sell_volume': '賣出股數',
+    'buy_amount': '買進金額',
+    'sell_amount': '賣出金額',
+    'net_volume': '淨買賣股數',
+    'net_amount': '淨買賣金額'
+}
+
+# 分點基準異常 (unusual_trading) 欄位對應到分析器的欄位名稱
+UNUSUAL_COLUMNS = {
+    'broker_code': '券商',
+    'branch_name': '分點',
+    'net_volume': '淨買賣股數',
+    'net_amount': '淨買賣金額',
+    'anomaly_score': '異常程度',
+    'anomaly_type': '異常類型'
+}
+
+# 市場代碼 (twse_collector 的 MARKET_TWSE、MARKET_TPEX) 對應的顯示名稱
+MARKET_NAMES = {'TWSE': '上市', 'TPEX': '上櫃'}
+
+# pnl 指令的排序選項對應到 get_branch_pnl 的欄位
+PNL_SORT_COLUMNS = {'unrealized': 'unrealized_pnl', 'realized': 'realized_pnl', 'position': 'position'}
 
 class ChipAnalysisSystem:
     """籌碼分析系統主類別"""
     
-    def __init__(self):
+    def __init__(self, read_only: bool = False, quiet: bool = False):
+        """
+        Args:
+            read_only: 以唯讀模式開啟資料庫 (平行批量分析的子行程)
+            quiet: 不顯示橫幅，日誌只寫入檔案
+        """
         # 設定日誌
+        handlers = [logging.FileHandler('chip_analysis.log', encoding='utf-8')]
+        if not quiet:
+            handlers.append(logging.StreamHandler())
         logging.basicConfig(
             level=logging.INFO,
             format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-            handlers=[
-                logging.FileHandler('chip_analysis.log', encoding='utf-8'),
-                logging.StreamHandler()
-            ]
+            handlers=handlers
         )
         self.logger = logging.getLogger(__name__)
         
-        # 初始化組件
-        self.collector = TWSECollector()
-        self.analyzer = ChipAnalyzer()
-        self.database = ChipDatabase()
+        # 組件在第一次使用時才建立
+        self.read_only = read_only
+        self._collector = None
+        self._analyzer = None
+        self._database = None
         
-        self.print_banner()
+        if not quiet:
+            self.print_banner()
+    
+    @property
+    def collector(self):
+        """資料收集器"""
+        if self._collector is None:
+            from src.data_collector.twse_collector import TWSECollector
+            self._collector = TWSECollector()
+        return self._collector
+    
+    @property
+    def analyzer(self):
+        """籌碼分析器"""
+        if self._analyzer is None:
+            from src.analyzer.chip_analyzer import ChipAnalyzer
+            self._analyzer = ChipAnalyzer()
+        return self._analyzer
+    
+    @property
+    def database(self):
+        """籌碼資料庫"""
+        if self._database is None:
+            self._database = open_database(read_only=self.read_only)
+        return self._database
     
     def print_banner(self):
         """顯示系統橫幅"""
@@ -50,7 +114,8 @@ class ChipAnalysisSystem:
         print("=" * 60)
         print(Style.RESET_ALL)
     
-    def collect_data(self, stock_codes: list, date: str = None, save_to_db: bool = True):
+    def collect_data(self, stock_codes: list, date: str = None, save_to_db: bool = True,
+                     max_workers: int = None):
         """
         收集指定股票的籌碼資料
         
@@ -58,6 +123,7 @@ class ChipAnalysisSystem:
             stock_codes: 股票代碼列表
             date: 指定日期，None 表示今天
             save_to_db: 是否儲存到資料庫
+            max_workers: 並行工作數，None 表示使用 MAX_WORKERS
         """
         print(f"{Fore.GREEN}🔄 開始收集籌碼資料...{Style.RESET_ALL}")
         
@@ -65,15 +131,13 @@ class ChipAnalysisSystem:
             date = datetime.now().strftime('%Y-%m-%d')
         
         all_data = []
+        tasks = [(stock_code, date) for stock_code in stock_codes]
         
-        for stock_code in stock_codes:
-            self.logger.info(f"正在收集股票 {stock_code} 的資料...")
-            print(f"📊 收集股票 {stock_code} 的資料...")
+        # 並行抓取，完成一檔就寫入一檔
+        for stock_code, _, broker_data in self.collector.iter_broker_trading(tasks, max_workers):
+            self.logger.info(f"正在處理股票 {stock_code} 的資料...")
             
             try:
-                # 收集券商分點資料
-                broker_data = self.collector.get_broker_trading_detail(stock_code, date)
-                
                 if broker_data is not None and not broker_data.empty:
                     print(f"✅ 股票 {stock_code}: 收集到 {len(broker_data)} 筆券商資料")
                     
@@ -95,7 +159,151 @@ class ChipAnalysisSystem:
         else:
             print(f"{Fore.YELLOW}⚠️  未收集到任何資料{Style.RESET_ALL}")
     
-    def analyze_stock(self, stock_code: str, date: str = None, days: int = 1):
+    def backfill(self, stock_codes: list, start_date: str, end_date: str = None, max_workers: int = None):
+        """
+        回補歷史籌碼資料，可隨時中斷並由中斷處接續
+        
+        每個 (股票, 日期) 抓到就立即寫入資料庫並記錄進度；資料庫已有資料或
+        確認查無資料的日期會直接略過，抓取失敗的日期下次執行時重試。
+        
+        Args:
+            stock_codes: 股票代碼列表
+            start_date: 起始日期 (YYYY-MM-DD)
+            end_date: 結束日期 (YYYY-MM-DD)，預設為今天
+            max_workers: 並行工作數，None 表示使用 MAX_WORKERS
+        """
+        from src.data_collector.twse_collector import FETCH_OK, FETCH_EMPTY, FETCH_ERROR
+        
+        if not end_date:
+            end_date = datetime.now().strftime('%Y-%m-%d')
+        
+        dates = self.collector.trading_dates(start_date, end_date)
+        
+        # 依進度表與既有資料找出尚未完成的 (股票, 日期)
+        pending = {}
+        for stock_code in stock_codes:
+            completed = self.database.get_completed_dates(stock_code, start_date, end_date)
+            pending[stock_code] = {date for date in dates if date not in completed}
+        
+        total = sum(len(stock_dates) for stock_dates in pending.values())
+        skipped = len(stock_codes) * len(dates) - total
+        print(f"{Fore.GREEN}🔄 回補 {start_date} ~ {end_date}：{len(stock_codes)} 檔股票、{len(dates)} 個交易日，"
+              f"待抓取 {total} 筆 (已完成 {skipped} 筆){Style.RESET_ALL}")
+        
+        if not total:
+            print(f"{Fore.GREEN}✅ 區間內資料皆已完成{Style.RESET_ALL}")
+            return
+        
+        counts = {FETCH_OK: 0, FETCH_EMPTY: 0, FETCH_ERROR: 0}
+        written = 0
+        
+        # 依日期順序逐日抓取，每完成一筆就寫入並記錄進度；
+        # 回補的日期多半早於既有資料，衍生統計表延後到最後一次重算
+        with self.database.deferred_refresh():
+            for date in dates:
+                tasks = [(stock_code, date) for stock_code in stock_codes if date in pending[stock_code]]
+                if not tasks:
+                    continue
+                
+                written += self._store_broker_results(tasks, max_workers, counts)
+                
+                print(f"[{sum(counts.values())}/{total}] {date} 完成 (寫入 {counts[FETCH_OK]}、查無資料 {counts[FETCH_EMPTY]}、"
+                      f"失敗 {counts[FETCH_ERROR]})")
+            
+            print("🔄 重算衍生統計表...")
+        
+        print(f"\n{Fore.GREEN}✅ 回補完成！共寫入 {written} 筆券商資料{Style.RESET_ALL}")
+        if counts[FETCH_ERROR]:
+            print(f"{Fore.YELLOW}⚠️  {counts[FETCH_ERROR]} 筆抓取失敗，重新執行相同指令即可重試{Style.RESET_ALL}")
+    
+    def _store_broker_results(self, tasks: list, max_workers: int, counts: dict) -> int:
+        """
+        並行抓取 (股票, 日期) 的券商分點資料，每完成一筆就寫入資料庫並記錄進度
+        
+        Args:
+            tasks: (股票代碼, 日期) 列表
+            max_workers: 並行工作數
+            counts: 依抓取狀態累計的筆數 (就地更新)
+            
+        Returns:
+            寫入的券商資料筆數
+        """
+        from src.data_collector.twse_collector import FETCH_OK, FETCH_ERROR
+        
+        written = 0
+        for stock_code, date, status, broker_data, error in self.collector.iter_broker_trading_status(tasks, max_workers):
+            row_count = 0
+            if status == FETCH_OK:
+                row_count = self.database.insert_broker_data(broker_data)
+                if not row_count:
+                    status, error = FETCH_ERROR, '寫入資料庫失敗'
+            
+            self.database.mark_collection_progress(stock_code, date, status, row_count, error)
+            counts[status] += 1
+            written += row_count
+        return written
+    
+    def collect_market(self, date: str = None, max_workers: int = None):
+        """
+        收集全市場 (上市、上櫃) 的當日資料
+        
+        每日行情每個市場只需一次請求；券商分點資料沒有全市場端點，只對當日有成交的
+        上市股票逐檔抓取，已完成的股票略過。櫃買中心沒有券商分點的公開 API，上櫃股票只收集行情。
+        
+        Args:
+            date: 指定日期，None 表示今天
+            max_workers: 並行工作數，None 表示使用 MAX_WORKERS
+        """
+        from src.data_collector.twse_collector import FETCH_OK, FETCH_EMPTY, FETCH_ERROR, MARKET_TWSE
+        
+        if not date:
+            date = datetime.now().strftime('%Y-%m-%d')
+        
+        try:
+            trading_day = self.collector.calendar.is_trading_day(date)
+        except ValueError as e:
+            print(f"{Fore.RED}❌ {e}{Style.RESET_ALL}")
+            return
+        
+        if not trading_day:
+            print(f"{Fore.YELLOW}⚠️  {date} 非交易日，略過收集{Style.RESET_ALL}")
+            return
+        
+        print(f"{Fore.GREEN}🔄 開始收集 {date} 全市場資料...{Style.RESET_ALL}")
+        
+        twse_quotes = None
+        for market, (status, quotes, error) in self.collector.get_market_snapshot(date).items():
+            name = MARKET_NAMES[market]
+            if status == FETCH_OK:
+                count = self.database.insert_daily_quotes(quotes)
+                traded = int((quotes['volume'] > 0).sum())
+                print(f"✅ {name}行情: {len(quotes)} 檔 (有成交 {traded} 檔)，已儲存 {count} 筆")
+                if market == MARKET_TWSE:
+                    twse_quotes = quotes
+            elif status == FETCH_EMPTY:
+                print(f"⚠️  {name}行情: 查無資料")
+            else:
+                print(f"❌ {name}行情: 抓取失敗 - {error}")
+        
+        if twse_quotes is None:
+            print(f"{Fore.YELLOW}⚠️  沒有上市行情，無法決定需抓取券商分點的股票{Style.RESET_ALL}")
+            return
+        
+        codes = self.collector.market_broker_codes(twse_quotes)
+        tasks = [(code, date) for code in codes if date not in self.database.get_completed_dates(code, date, date)]
+        print(f"🔄 券商分點: {len(codes)} 檔有成交的上市股票，待抓取 {len(tasks)} 檔 "
+              f"(已完成 {len(codes) - len(tasks)} 檔)")
+        
+        counts = {FETCH_OK: 0, FETCH_EMPTY: 0, FETCH_ERROR: 0}
+        written = self._store_broker_results(tasks, max_workers, counts)
+        
+        print(f"\n{Fore.GREEN}✅ 全市場收集完成！寫入 {counts[FETCH_OK]} 檔、{written} 筆券商資料 "
+              f"(查無資料 {counts[FETCH_EMPTY]} 檔){Style.RESET_ALL}")
+        if counts[FETCH_ERROR]:
+            print(f"{Fore.YELLOW}⚠️  {counts[FETCH_ERROR]} 檔抓取失敗，重新執行相同指令即可重試{Style.RESET_ALL}")
+    
+    def analyze_stock(self, stock_code: str, date: str = None, days: int = 1, streaming: bool = False,
+                      charts: bool = True, formats: list = None):
         """
         分析指定股票的籌碼資料
         
@@ -103,43 +311,68 @@ class ChipAnalysisSystem:
             stock_code: 股票代碼
             date: 分析日期
             days: 分析天數
+            streaming: 依日期分段讀取資料並以串流方式產生報告 (適合長區間)
+            charts: 是否產生 HTML 圖表 (False 時不載入 plotly)
+            formats: 報告輸出格式，預設為 OUTPUT_FORMAT
+            
+        Returns:
+            分析摘要 (批量分析彙整用)
         """
         print(f"{Fore.BLUE}📈 開始分析股票 {stock_code} 的籌碼...{Style.RESET_ALL}")
         
         try:
-            # 從資料庫讀取資料
+            formats = normalize_formats(OUTPUT_FORMAT if formats is None else formats)
+            # 只有 HTML 儀表板會用到圖表，其他格式不必建立
+            charts = charts and 'html' in formats
+            
+            # 分析區間
             if date:
-                data = self.database.get_broker_data(stock_code=stock_code, date=date)
+                start_date = end_date = date
             else:
                 # 分析最近N天的資料
                 end_date = datetime.now().strftime('%Y-%m-%d')
                 start_date = (datetime.now() - timedelta(days=days-1)).strftime('%Y-%m-%d')
-                data = self.database.get_broker_data(
+            
+            def load_chunks(net_volume_band=None):
+                for chunk in self.database.iter_broker_data(
+                    stock_code=stock_code, start_date=start_date, end_date=end_date,
+                    net_volume_band=net_volume_band
+                ):
+                    yield chunk.rename(columns=ANALYSIS_COLUMNS)
+            
+            if streaming:
+                report = self.analyzer.generate_streaming_report(load_chunks, stock_code, charts=charts)
+                record_count = report.get('基本統計', {}).get('總記錄數', 0)
+                
+                if not record_count:
+                    print(f"❌ 沒有找到股票 {stock_code} 的籌碼資料")
+                    return {'股票代碼': stock_code, '狀態': '無資料'}
+                
+                print(f"📊 串流分析 {record_count} 筆券商分點資料")
+            else:
+                # 券商、分點彙總在資料庫內完成，只讀取彙總結果與異常門檻外的資料
+                aggregates = self.database.get_analysis_aggregates(
                     stock_code=stock_code, 
                     start_date=start_date, 
                     end_date=end_date
                 )
+                record_count = aggregates.get('總記錄數', 0)
+                
+                if not record_count:
+                    print(f"❌ 沒有找到股票 {stock_code} 的籌碼資料")
+                    return {'股票代碼': stock_code, '狀態': '無資料'}
+                
+                print(f"📊 找到 {record_count} 筆券商分點資料")
+                
+                # 執行分析
+                report = self.analyzer.generate_aggregated_report(aggregates, load_chunks, stock_code, charts=charts)
             
-            if data.empty:
-                print(f"❌ 沒有找到股票 {stock_code} 的籌碼資料")
-                return
-            
-            print(f"📊 找到 {len(data)} 筆券商分點資料")
-            
-            # 轉換欄位名稱以符合分析器期望格式
-            data_for_analysis = data.rename(columns={
-                'broker_code': '券商',
-                'branch_name': '分點',
-                'buy_volume': '買進股數',
-                'sell_volume': '賣出股數',
-                'buy_amount': '買進金額',
-                'sell_amount': '賣出金額',
-                'net_volume': '淨買賣股數',
-                'net_amount': '淨買賣金額'
-            })
-            
-            # 執行分析
-            report = self.analyzer.generate_analysis_report(data_for_analysis, stock_code)
+            # 已有分點歷史基準時，改用各分點偏離自身基準的異常交易
+            if self.database.has_branch_baseline(stock_code):
+                unusual = self.database.get_unusual_trading(
+                    stock_code=stock_code, start_date=start_date, end_date=end_date
+                )
+                report['異常交易'] = unusual.rename(columns=UNUSUAL_COLUMNS)
             
             # 顯示分析結果
             self.display_analysis_results(report, stock_code)
@@ -148,23 +381,41 @@ class ChipAnalysisSystem:
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             filename = f"{stock_code}_analysis_{timestamp}"
             
-            self.analyzer.save_report_to_excel(report, filename)
-            print(f"💾 分析報告已儲存: {filename}.xlsx")
-            
-            # 儲存圖表
-            if '券商圖表' in report:
-                chart_file = OUTPUT_DIR / f"{filename}_broker_chart.html"
-                report['券商圖表'].write_html(chart_file)
-                print(f"📊 券商圖表已儲存: {chart_file}")
+            paths = self.analyzer.save_report(report, filename, formats)
+            for path in paths:
+                print(f"💾 報告已儲存: {path}")
             
-            if '淨買賣圖表' in report:
-                net_chart_file = OUTPUT_DIR / f"{filename}_net_trading_chart.html"
-                report['淨買賣圖表'].write_html(net_chart_file)
-                print(f"📊 淨買賣圖表已儲存: {net_chart_file}")
+            return self.summarize_report(report, stock_code, paths)
                 
         except Exception as e:
             self.logger.error(f"分析股票 {stock_code} 失敗: {e}")
             print(f"❌ 分析失敗: {e}")
+            return {'股票代碼': stock_code, '狀態': '失敗', '錯誤': str(e)}
+    
+    def summarize_report(self, report: dict, stock_code: str, paths: list) -> dict:
+        """將分析報告整理成批量彙整表的一列"""
+        stats = report.get('基本統計', {})
+        summary = {
+            '股票代碼': stock_code,
+            '狀態': '完成',
+            '總記錄數': stats.get('總記錄數', 0),
+            '券商數量': stats.get('券商數量', 0),
+            '分點數量': stats.get('分點數量', 0),
+            '異常交易筆數': len(report.get('異常交易', [])),
+            '報告檔案': ', '.join(path.name for path in paths)
+        }
+        
+        # 淨買超、淨賣超最大的主要券商
+        top_brokers = report.get('主要券商')
+        if top_brokers is not None and not top_brokers.empty:
+            buyer = top_brokers.loc[top_brokers['淨買賣金額'].idxmax()]
+            seller = top_brokers.loc[top_brokers['淨買賣金額'].idxmin()]
+            summary['最大買超券商'] = buyer['券商名稱'] if buyer['淨買賣金額'] > 0 else None
+            summary['最大買超金額'] = buyer['淨買賣金額'] if buyer['淨買賣金額'] > 0 else 0
+            summary['最大賣超券商'] = seller['券商名稱'] if seller['淨買賣金額'] < 0 else None
+            summary['最大賣超金額'] = seller['淨買賣金額'] if seller['淨買賣金額'] < 0 else 0
+        
+        return summary
     
     def display_analysis_results(self, report: dict, stock_code: str):
         """顯示分析結果"""
@@ -207,16 +458,60 @@ class ChipAnalysisSystem:
                 
                 print(f"   {broker}-{branch}: {net_volume:,} 張 (異常度: {anomaly_score:.2f})")
     
-    def batch_analysis(self, stock_codes: list, days: int = 7):
-        """批量分析多檔股票"""
-        print(f"{Fore.MAGENTA}🔄 開始批量分析 {len(stock_codes)} 檔股票（最近{days}天）...{Style.RESET_ALL}")
+    def batch_analysis(self, stock_codes: list, days: int = 7, workers: int = None, formats: list = None):
+        """
+        批量分析多檔股票
         
-        for i, stock_code in enumerate(stock_codes, 1):
-            print(f"\n[{i}/{len(stock_codes)}] 分析股票 {stock_code}")
-            self.analyze_stock(stock_code, days=days)
-            
+        Args:
+            stock_codes: 股票代碼列表
+            days: 分析天數
+            workers: 平行分析的行程數，預設為 BATCH_WORKERS (1 表示依序分析)
+            formats: 報告輸出格式，預設為 OUTPUT_FORMAT
+        """
+        workers = max(1, min(workers or BATCH_WORKERS, len(stock_codes)))
+        print(f"{Fore.MAGENTA}🔄 開始批量分析 {len(stock_codes)} 檔股票（最近{days}天，{workers} 個行程）...{Style.RESET_ALL}")
+        
+        summaries = {}
+        if workers == 1:
+            for i, stock_code in enumerate(stock_codes, 1):
+                print(f"\n[{i}/{len(stock_codes)}] 分析股票 {stock_code}")
+                summaries[stock_code] = self.analyze_stock(stock_code, days=days, formats=formats)
+        else:
+            # 每個子行程各自以唯讀模式開啟資料庫，查詢、圖表與報告輸出都在子行程完成
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker) as executor:
+                futures = {
+                    executor.submit(_run_batch_analysis, stock_code, days, formats): stock_code
+                    for stock_code in stock_codes
+                }
+                for i, future in enumerate(as_completed(futures), 1):
+                    stock_code = futures[future]
+                    try:
+                        summary, snapshot = future.result()
+                        # 子行程的計時與計數併入主行程的執行摘要
+                        get_metrics().merge(snapshot)
+                    except Exception as e:
+                        self.logger.error(f"分析股票 {stock_code} 失敗: {e}")
+                        summary = {'股票代碼': stock_code, '狀態': '失敗', '錯誤': str(e)}
+                    summaries[stock_code] = summary
+                    
+                    color = Fore.GREEN if summary.get('狀態') == '完成' else Fore.YELLOW
+                    print(f"[{i}/{len(stock_codes)}] {stock_code}: {color}{summary.get('狀態')}{Style.RESET_ALL}")
+        
+        self.save_batch_summary([summaries[stock_code] for stock_code in stock_codes])
         print(f"\n{Fore.GREEN}✅ 批量分析完成！{Style.RESET_ALL}")
     
+    def save_batch_summary(self, summaries: list):
+        """儲存批量分析的彙整表"""
+        # 無資料或失敗的股票沒有統計值，整數欄位保留為可空整數
+        summary_df = pd.DataFrame(summaries).convert_dtypes()
+        
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        summary_file = OUTPUT_DIR / f"batch_summary_{timestamp}.csv"
+        summary_df.to_csv(summary_file, index=False, encoding='utf-8-sig')
+        
+        completed = (summary_df['狀態'] == '完成').sum()
+        print(f"\n📋 完成 {completed}/{len(summary_df)} 檔，彙整表已儲存: {summary_file}")
+    
     def show_top_brokers(self, stock_code: str = None, days: int = 30):
         """顯示熱門券商排行"""
         print(f"{Fore.CYAN}🏆 查詢熱門券商排行（最近{days}天）{Style.RESET_ALL}")
@@ -244,34 +539,223 @@ class ChipAnalysisSystem:
             
             print(f"{idx+1:<4} {broker_code:<8} {broker_name:<12} {color}{action_symbol} {net_amount:>12,}{Style.RESET_ALL} {branch_count:<8} {trading_days:<8}")
 
+    def show_branch_footprint(self, broker_code: str, branch_name: str = None, days: int = 7, limit: int = 20):
+        """顯示券商分點最近N天在各股票的淨買賣"""
+        target = f"{broker_code} {branch_name}" if branch_name else broker_code
+        broker_name = BROKER_MAPPING.get(broker_code, '未知券商')
+        print(f"{Fore.CYAN}🔎 查詢 {target} ({broker_name}) 的跨股票足跡（最近{days}天）{Style.RESET_ALL}")
+        
+        footprint = self.database.get_branch_footprint(broker_code, branch_name, days=days, limit=None)
+        
+        if footprint.empty:
+            print("❌ 沒有找到此分點的交易資料")
+            return
+        
+        buys = footprint[footprint['total_net_amount'] > 0].head(limit)
+        sells = footprint[footprint['total_net_amount'] < 0].iloc[::-1].head(limit)
+        
+        print(f"\n共進出 {len(footprint)} 檔股票 (買超 {(footprint['total_net_amount'] > 0).sum()} 檔，"
+              f"賣超 {(footprint['total_net_amount'] < 0).sum()} 檔)")
+        
+        for title, rows, color in (('買超', buys, Fore.RED), ('賣超', sells, Fore.GREEN)):
+            if rows.empty:
+                continue
+            print(f"\n{title}:")
+            print("-" * 80)
+            print(f"{'股票代碼':<8} {'股票名稱':<10} {'淨買賣股數':>14} {'淨買賣金額':>16} {'交易天數':>8} {'最後交易日':>12}")
+            print("-" * 80)
+            for _, row in rows.iterrows():
+                stock_name = row['stock_name'] if isinstance(row['stock_name'], str) else ''
+                print(f"{row['stock_code']:<8} {stock_name:<10} {color}{row['total_net_volume']:>14,} "
+                      f"{row['total_net_amount']:>16,}{Style.RESET_ALL} {row['trading_days']:>8} {row['last_date']:>12}")
+
+    def show_branch_accumulation(self, broker_code: str, branch_name: str, stock_code: str, days: int = 7):
+        """顯示券商分點最近N天對某檔股票的累積淨買賣走勢"""
+        start_date = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+        end_date = datetime.now().strftime('%Y-%m-%d')
+        print(f"{Fore.CYAN}📐 查詢 {broker_code} {branch_name} 在 {stock_code} 的累積淨買賣（最近{days}天）{Style.RESET_ALL}")
+        
+        series = self.database.get_branch_accumulation_series(stock_code, broker_code, branch_name, start_date, end_date)
+        
+        if series.empty:
+            print("❌ 此分點在區間內沒有交易此股票")
+            return
+        
+        print("-" * 70)
+        print(f"{'日期':<12} {'淨買賣股數':>14} {'淨買賣金額':>16} {'累積股數':>14} {'累積金額':>16}")
+        print("-" * 70)
+        for _, row in series.iterrows():
+            color = Fore.RED if row['net_volume'] > 0 else Fore.GREEN
+            print(f"{row['date']:<12} {color}{row['net_volume']:>14,} {row['net_amount']:>16,}{Style.RESET_ALL} "
+                  f"{row['cum_net_volume']:>14,} {row['cum_net_amount']:>16,}")
+        
+        accumulation = self.database.get_branch_accumulation(stock_code, broker_code, branch_name, start_date, end_date)
+        print("-" * 70)
+        print(f"交易 {accumulation['trading_days']} 天，累積淨買賣 {accumulation['net_volume']:,} 股 "
+              f"({accumulation['net_amount']:,} 元)")
+        if accumulation['avg_cost'] is not None and accumulation['net_volume'] > 0:
+            print(f"淨買進均價約 {accumulation['avg_cost']:,.2f} 元")
+
+    def show_branch_pnl(self, stock_code: str = None, broker_code: str = None, branch_name: str = None,
+                        order_by: str = 'unrealized_pnl', ascending: bool = False, limit: int = 20):
+        """顯示分點持股成本與損益排行"""
+        target = stock_code or (f"{broker_code} {branch_name or ''}".strip() if broker_code else '全市場')
+        print(f"{Fore.CYAN}💰 查詢 {target} 的分點持股成本與損益{Style.RESET_ALL}")
+        
+        pnl = self.database.get_branch_pnl(stock_code, broker_code, branch_name, order_by, ascending, limit)
+        
+        if pnl.empty:
+            print("❌ 沒有找到持有部位的分點")
+            return
+        
+        print("-" * 118)
+        print(f"{'排名':<4} {'股票代碼':<8} {'券商代碼':<8} {'分點':<10} {'持有股數':>12} {'平均成本':>10} "
+              f"{'參考價':>10} {'未實現損益':>16} {'已實現損益':>16} {'交易天數':>8}")
+        print("-" * 118)
+        for idx, row in pnl.iterrows():
+            color = Fore.RED if row['unrealized_pnl'] > 0 else Fore.GREEN
+            print(f"{idx+1:<4} {row['stock_code']:<8} {row['broker_code']:<8} {row['branch_name']:<10} "
+                  f"{row['position']:>12,} {row['avg_cost']:>10,.2f} {row['mark_price']:>10,.2f} "
+                  f"{color}{row['unrealized_pnl']:>16,.0f}{Style.RESET_ALL} {row['realized_pnl']:>16,.0f} "
+                  f"{row['trading_days']:>8}")
+        print(f"\n參考價為各股票最後交易日 ({pnl['mark_date'].max()}) 的收盤價 (無行情時為成交均價)；持有股數為負表示淨賣出")
+    
+    def screen_market(self, date: str = None, days: int = 1, top_n: int = None,
+                      limit: int = 30, sort_by: str = '主力集中度'):
+        """全市場主力集中度篩選，顯示排名並儲存完整結果"""
+        from src.analyzer.market_screener import MarketScreener
+        
+        top_n = top_n or SCREEN_TOP_BRANCHES
+        print(f"{Fore.CYAN}🧭 全市場主力集中度篩選（{date or '今日'}，{days} 個交易日，前{top_n}大分點）{Style.RESET_ALL}")
+        
+        result = MarketScreener(self.database).screen(date=date, days=days, top_n=top_n, sort_by=sort_by)
+        
+        if result.empty:
+            print("❌ 沒有可篩選的券商資料")
+            return
+        
+        print(f"\n依 {sort_by} 排序，共 {len(result)} 檔股票:")
+        print("-" * 96)
+        print(f"{'排名':<4} {'股票代碼':<8} {'股票名稱':<10} {'成交股數':>14} {'主力集中度':>10} "
+              f"{'買賣家數差':>10} {'買賣家數比':>10} {'淨買賣HHI':>10}")
+        print("-" * 96)
+        for idx, row in result.head(limit).iterrows():
+            stock_name = row['股票名稱'] if isinstance(row['股票名稱'], str) else ''
+            color = Fore.RED if row['主力集中度'] > 0 else Fore.GREEN
+            print(f"{idx+1:<4} {row['股票代碼']:<8} {stock_name:<10} {row['成交股數']:>14,.0f} "
+                  f"{color}{row['主力集中度']:>10.2%}{Style.RESET_ALL} {row['買賣家數差']:>10} "
+                  f"{row['買賣家數比']:>10.2f} {row['淨買賣HHI']:>10.4f}")
+        
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        screen_file = OUTPUT_DIR / f"market_screen_{timestamp}.csv"
+        result.to_csv(screen_file, index=False, encoding='utf-8-sig')
+        print(f"\n📋 完整篩選結果已儲存: {screen_file}")
+
+# 平行批量分析時每個子行程各自持有的系統實例
+_batch_system = None
+
+def _init_batch_worker():
+    """子行程初始化：以唯讀模式開啟資料庫"""
+    global _batch_system
+    _batch_system = ChipAnalysisSystem(read_only=True, quiet=True)
+
+def _run_batch_analysis(stock_code: str, days: int, formats: list = None) -> tuple:
+    """
+    在子行程分析一檔股票，逐檔輸出改為只寫日誌，由主行程統一顯示進度
+
+    Returns:
+        (分析摘要, 本檔的執行指標快照)
+    """
+    get_metrics().reset()
+    with open(os.devnull, 'w', encoding='utf-8') as devnull, contextlib.redirect_stdout(devnull):
+        summary = _batch_system.analyze_stock(stock_code, days=days, formats=formats)
+    return summary, get_metrics().snapshot()
+
+def _format_list(value: str) -> list:
+    """解析 --format 參數 (逗號分隔的輸出格式)"""
+    try:
+        return normalize_formats(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
 def main():
     """主程式入口"""
     parser = argparse.ArgumentParser(description='台股券商分點籌碼統計分析系統')
+    parser.add_argument('--metrics', action='store_true',
+                        help='結束時顯示各階段耗時並寫入 JSON 執行摘要 (output/metrics/)')
     
     subparsers = parser.add_subparsers(dest='command', help='可用指令')
+    format_help = f"報告輸出格式，逗號分隔 ({'、'.join(REPORT_WRITERS)}；預設 {','.join(OUTPUT_FORMAT)})"
     
     # 收集資料指令
     collect_parser = subparsers.add_parser('collect', help='收集籌碼資料')
     collect_parser.add_argument('stocks', nargs='+', help='股票代碼 (可指定多個)')
     collect_parser.add_argument('-d', '--date', help='指定日期 (YYYY-MM-DD)')
     collect_parser.add_argument('--no-db', action='store_true', help='不儲存到資料庫')
+    collect_parser.add_argument('-w', '--workers', type=int, help=f'並行工作數 (預設{MAX_WORKERS})')
+    
+    # 全市場收集指令
+    market_parser = subparsers.add_parser('market', help='收集全市場 (上市、上櫃) 當日資料')
+    market_parser.add_argument('-d', '--date', help='指定日期 (YYYY-MM-DD)')
+    market_parser.add_argument('-w', '--workers', type=int, help=f'並行工作數 (預設{MAX_WORKERS})')
+    
+    # 歷史回補指令
+    backfill_parser = subparsers.add_parser('backfill', help='回補歷史籌碼資料 (可中斷後接續)')
+    backfill_parser.add_argument('stocks', nargs='*', default=DEFAULT_STOCK_CODES, help='股票代碼 (預設為預設股票清單)')
+    backfill_parser.add_argument('-s', '--start', required=True, help='起始日期 (YYYY-MM-DD)')
+    backfill_parser.add_argument('-e', '--end', help='結束日期 (YYYY-MM-DD，預設今天)')
+    backfill_parser.add_argument('-w', '--workers', type=int, help=f'並行工作數 (預設{MAX_WORKERS})')
     
     # 分析指令
     analyze_parser = subparsers.add_parser('analyze', help='分析籌碼資料')
     analyze_parser.add_argument('stock', help='股票代碼')
     analyze_parser.add_argument('-d', '--date', help='分析日期 (YYYY-MM-DD)')
     analyze_parser.add_argument('--days', type=int, default=1, help='分析天數 (預設1天)')
+    analyze_parser.add_argument('--stream', action='store_true', help='分段讀取資料進行串流分析 (適合長區間)')
+    analyze_parser.add_argument('--no-charts', action='store_true', help='不產生 HTML 圖表 (啟動較快)')
+    analyze_parser.add_argument('-f', '--format', type=_format_list, help=format_help)
     
     # 批量分析指令
     batch_parser = subparsers.add_parser('batch', help='批量分析多檔股票')
     batch_parser.add_argument('stocks', nargs='+', help='股票代碼列表')
     batch_parser.add_argument('--days', type=int, default=7, help='分析天數 (預設7天)')
+    batch_parser.add_argument('-w', '--workers', type=int, help=f'平行分析的行程數 (預設{BATCH_WORKERS})')
+    batch_parser.add_argument('-f', '--format', type=_format_list, help=format_help)
     
     # 熱門券商指令
     top_parser = subparsers.add_parser('top', help='顯示熱門券商排行')
     top_parser.add_argument('-s', '--stock', help='特定股票代碼')
     top_parser.add_argument('--days', type=int, default=30, help='查詢天數 (預設30天)')
     
+    # 分點足跡指令
+    branch_parser = subparsers.add_parser('branch', help='顯示券商分點在各股票的淨買賣')
+    branch_parser.add_argument('broker', help='券商代碼')
+    branch_parser.add_argument('branch', nargs='?', help='分點名稱 (未指定時彙總券商所有分點)')
+    branch_parser.add_argument('--days', type=int, default=7, help='查詢天數 (預設7天)')
+    branch_parser.add_argument('-n', '--limit', type=int, default=20, help='買超、賣超各顯示的股票數 (預設20)')
+    branch_parser.add_argument('-s', '--stock', help='顯示分點在此股票的每日累積淨買賣 (需指定分點)')
+    
+    # 分點持股成本指令
+    pnl_parser = subparsers.add_parser('pnl', help='顯示分點持股成本與未實現損益排行')
+    pnl_parser.add_argument('-s', '--stock', help='特定股票代碼 (未指定時為全市場)')
+    pnl_parser.add_argument('-b', '--broker', help='券商代碼')
+    pnl_parser.add_argument('--branch', help='分點名稱 (需同時指定券商代碼)')
+    pnl_parser.add_argument('--sort', default='unrealized', choices=list(PNL_SORT_COLUMNS),
+                            help='排序欄位: unrealized 未實現損益、realized 已實現損益、position 持有股數 (預設unrealized)')
+    pnl_parser.add_argument('--asc', action='store_true', help='由小到大排序 (例如未實現虧損最大的分點)')
+    pnl_parser.add_argument('-n', '--limit', type=int, default=20, help='顯示筆數 (預設20)')
+    
+    # 全市場篩選指令
+    screen_parser = subparsers.add_parser('screen', help='全市場主力集中度篩選')
+    screen_parser.add_argument('-d', '--date', help='最後一個交易日 (YYYY-MM-DD，預設今日)')
+    screen_parser.add_argument('--days', type=int, default=1, help='統計的交易日數 (預設1天)')
+    screen_parser.add_argument('--top', type=int, default=SCREEN_TOP_BRANCHES,
+                               help=f'主力取前N大分點 (預設{SCREEN_TOP_BRANCHES})')
+    screen_parser.add_argument('-n', '--limit', type=int, default=30, help='顯示的股票數 (預設30)')
+    screen_parser.add_argument('--sort', default='主力集中度',
+                               choices=['主力集中度', '淨買賣HHI', '主力買超股數', '買賣家數差', '買賣家數比'],
+                               help='排序指標 (預設主力集中度)')
+    
     # 互動式指令
     subparsers.add_parser('interactive', help='進入互動式模式')
     
@@ -281,22 +765,53 @@ def main():
         parser.print_help()
         return
     
+    # 選用 Parquet 後端但未安裝 pyarrow 時，在收集或分析開始前就結束
+    if STORAGE_BACKEND.lower() == 'parquet':
+        from src.utils.parquet_store import PYARROW_REQUIRED, pyarrow_available
+        if not pyarrow_available():
+            print(f"{Fore.RED}❌ STORAGE_BACKEND=parquet: {PYARROW_REQUIRED}{Style.RESET_ALL}")
+            return
+    
     # 初始化系統
     system = ChipAnalysisSystem()
     
     try:
         if args.command == 'collect':
-            system.collect_data(args.stocks, args.date, not args.no_db)
+            system.collect_data(args.stocks, args.date, not args.no_db, args.workers)
+        
+        elif args.command == 'market':
+            system.collect_market(args.date, args.workers)
+        
+        elif args.command == 'backfill':
+            system.backfill(args.stocks, args.start, args.end, args.workers)
         
         elif args.command == 'analyze':
-            system.analyze_stock(args.stock, args.date, args.days)
+            system.analyze_stock(args.stock, args.date, args.days, args.stream, not args.no_charts, args.format)
         
         elif args.command == 'batch':
-            system.batch_analysis(args.stocks, args.days)
+            system.batch_analysis(args.stocks, args.days, args.workers, args.format)
         
         elif args.command == 'top':
             system.show_top_brokers(args.stock, args.days)
         
+        elif args.command == 'branch':
+            if args.stock and args.branch:
+                system.show_branch_accumulation(args.broker, args.branch, args.stock, args.days)
+            elif args.stock:
+                print("❌ 查詢累積淨買賣需指定分點名稱")
+            else:
+                system.show_branch_footprint(args.broker, args.branch, args.days, args.limit)
+        
+        elif args.command == 'pnl':
+            if args.branch and not args.broker:
+                print("❌ 指定分點時需同時指定券商代碼 (-b)")
+            else:
+                system.show_branch_pnl(args.stock, args.broker, args.branch, PNL_SORT_COLUMNS[args.sort],
+                                       args.asc, args.limit)
+        
+        elif args.command == 'screen':
+            system.screen_market(args.date, args.days, args.top, args.limit, args.sort)
+        
         elif args.command == 'interactive':
             interactive_mode(system)
     
@@ -304,6 +819,12 @@ def main():
         print(f"\n{Fore.YELLOW}使用者中斷程式{Style.RESET_ALL}")
     except Exception as e:
         print(f"{Fore.RED}❌ 程式執行錯誤: {e}{Style.RESET_ALL}")
+    
+    if args.metrics:
+        print(f"\n{get_metrics().format_summary(args.command)}")
+        summary_path = get_metrics().export(args.command)
+        if summary_path:
+            print(f"📈 執行摘要已儲存: {summary_path}")
 
 def interactive_mode(system):
     """互動式模式"""
@@ -326,6 +847,9 @@ def interactive_mode(system):
    collect <股票代碼>     - 收集指定股票的籌碼資料
    analyze <股票代碼>     - 分析指定股票的籌碼
    top [股票代碼]         - 顯示熱門券商排行
+   branch <券商> [分點]   - 顯示券商分點在各股票的淨買賣
+   pnl [股票代碼]         - 分點持股成本與未實現損益排行
+   screen [日期]          - 全市場主力集中度篩選
    default               - 使用預設股票清單進行分析
    exit                  - 離開程式
    help                  - 顯示此說明
@@ -347,6 +871,18 @@ def interactive_mode(system):
                 stock_code = parts[1] if len(parts) > 1 else None
                 system.show_top_brokers(stock_code)
             
+            elif command == 'branch' and len(parts) > 1:
+                branch_name = parts[2] if len(parts) > 2 else None
+                system.show_branch_footprint(parts[1], branch_name)
+            
+            elif command == 'pnl':
+                stock_code = parts[1] if len(parts) > 1 else None
+                system.show_branch_pnl(stock_code)
+            
+            elif command == 'screen':
+                date = parts[1] if len(parts) > 1 else None
+                system.screen_market(date)
+            
             elif command == 'default':
                 print("🎯 使用預設股票清單進行分析...")
                 system.batch_analysis(DEFAULT_STOCK_CODES[:5])  # 分析前5檔
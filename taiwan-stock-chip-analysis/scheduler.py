@@ -18,7 +18,8 @@ colorama.init()
 sys.path.append(str(Path(__file__).parent))
 from config import *
 from src.data_collector.twse_collector import TWSECollector
-from src.utils.database import ChipDatabase
+from src.utils.database import open_database
+from src.utils.metrics import get_metrics
 
 class AutoScheduler:
     """自動排程器"""
@@ -37,7 +38,7 @@ class AutoScheduler:
         
         # 初始化組件
         self.collector = TWSECollector()
-        self.database = ChipDatabase()
+        self.database = open_database()
         
         # 預設要追蹤的股票清單
         self.watch_list = DEFAULT_STOCK_CODES
@@ -59,26 +60,27 @@ class AutoScheduler:
         start_time = datetime.now()
         self.logger.info("=" * 50)
         self.logger.info(f"開始每日資料收集任務: {start_time.strftime('%Y-%m-%d %H:%M:%S')}")
+        # 每次任務各自計算各階段耗時
+        get_metrics().reset()
         
         try:
             success_count = 0
             error_count = 0
             
-            # 取得交易日期 (排除週末)
+            # 取得交易日期 (排除週末與休市日)
             today = datetime.now()
-            if today.weekday() >= 5:  # 週末不收集
-                self.logger.info("今日為週末，跳過資料收集")
+            date_str = today.strftime('%Y-%m-%d')
+            if not self.collector.calendar.is_trading_day(date_str):
+                self.logger.info("今日非交易日，跳過資料收集")
                 return
             
-            date_str = today.strftime('%Y-%m-%d')
+            tasks = [(stock_code, date_str) for stock_code in self.watch_list]
             
-            for i, stock_code in enumerate(self.watch_list, 1):
+            # 並行抓取 (總速率由全域限速器控制)，完成一檔就寫入一檔
+            completed = self.collector.iter_broker_trading(tasks)
+            for i, (stock_code, _, broker_data) in enumerate(completed, 1):
                 try:
-                    print(f"{Fore.BLUE}[{i}/{len(self.watch_list)}] 收集股票 {stock_code}...{Style.RESET_ALL}")
-                    self.logger.info(f"正在收集股票 {stock_code} 的資料...")
-                    
-                    # 收集券商分點資料
-                    broker_data = self.collector.get_broker_trading_detail(stock_code, date_str)
+                    print(f"{Fore.BLUE}[{i}/{len(self.watch_list)}] 處理股票 {stock_code}...{Style.RESET_ALL}")
                     
                     if broker_data is not None and not broker_data.empty:
                         # 儲存到資料庫
@@ -91,9 +93,6 @@ class AutoScheduler:
                         print(f"{Fore.YELLOW}⚠️  股票 {stock_code}: 無資料{Style.RESET_ALL}")
                         self.logger.warning(f"股票 {stock_code} 無券商資料")
                     
-                    # 避免請求過快
-                    time.sleep(REQUEST_DELAY)
-                    
                 except Exception as e:
                     error_count += 1
                     print(f"{Fore.RED}❌ 股票 {stock_code}: 收集失敗 - {e}{Style.RESET_ALL}")
@@ -115,23 +114,44 @@ class AutoScheduler:
             
             self.logger.info(f"每日資料收集完成 - 成功: {success_count}, 失敗: {error_count}, 耗時: {duration}")
             
+            # 各階段耗時 (HTTP、限速等待、解析、寫入) 寫入日誌與 JSON 執行摘要，已設定時同時輸出 Prometheus 檔案
+            self.logger.info(get_metrics().format_summary('daily_collection'))
+            summary_path = get_metrics().export('daily_collection')
+            if summary_path:
+                self.logger.info(f"執行摘要已儲存: {summary_path}")
+            
         except Exception as e:
             self.logger.error(f"每日資料收集任務失敗: {e}")
             print(f"{Fore.RED}❌ 每日資料收集任務失敗: {e}{Style.RESET_ALL}")
     
     def generate_daily_summary(self, date: str, success_count: int, error_count: int):
-        """生成每日收集摘要"""
+        """
+        生成每日收集摘要
+        
+        各股票的每日統計 (daily_summary) 已在寫入券商資料時同步更新，
+        這裡只讀取當日結果並記錄收集狀況。
+        """
         try:
-            summary = {
-                'date': date,
-                'total_stocks': len(self.watch_list),
-                'success_count': success_count,
-                'error_count': error_count,
-                'collection_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            }
+            summaries = self.database.get_daily_summary(date=date)
+            
+            self.logger.info(
+                f"每日摘要 - {date}: 成功 {success_count} 檔, 失敗 {error_count} 檔, "
+                f"已產生 {len(summaries)} 檔股票統計"
+            )
+            
+            if not summaries.empty:
+                unusual = summaries[summaries['unusual_activity_count'] > 0]
+                for _, row in unusual.iterrows():
+                    self.logger.info(
+                        f"股票 {row['stock_code']}: {row['unusual_activity_count']} 筆異常交易, "
+                        f"主要買方 {row['top_buyer_broker']}, 主要賣方 {row['top_seller_broker']}"
+                    )
             
-            # 可以擴展儲存每日摘要到資料庫
-            self.logger.info(f"每日摘要 - {date}: 成功 {success_count} 檔, 失敗 {error_count} 檔")
+            # 依各分點自身歷史基準偵測到的異常交易 (寫入時已存入 unusual_trading)
+            baseline_unusual = self.database.get_unusual_trading(date=date)
+            if not baseline_unusual.empty:
+                for stock_code, count in baseline_unusual.groupby('stock_code').size().items():
+                    self.logger.info(f"股票 {stock_code}: {count} 筆分點異常 (偏離自身基準)")
             
         except Exception as e:
             self.logger.error(f"生成每日摘要失敗: {e}")
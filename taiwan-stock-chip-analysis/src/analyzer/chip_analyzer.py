@@ -4,26 +4,197 @@
 """
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import plotly.graph_objects as go
-import plotly.express as px
 from datetime import datetime, timedelta
 import logging
 import sys
 import os
-from typing import Dict, List, Tuple, Optional
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Tuple, Optional
 
 # 添加專案根目錄到路徑
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
 from config import *
+from src.analyzer.report_writers import REPORT_WRITERS, normalize_formats
+from src.utils.metrics import get_metrics, timed
+
+# 圖表套件載入較慢，只在建立圖表時才匯入
+if TYPE_CHECKING:
+    import plotly.graph_objects as go
+
+# 券商、分點層級的彙總欄位 (記憶體內分析與串流分析共用)
+BROKER_AGGREGATIONS = {
+    '買進股數': 'sum',
+    '賣出股數': 'sum',
+    '買進金額': 'sum',
+    '賣出金額': 'sum',
+    '淨買賣股數': 'sum',
+    '淨買賣金額': 'sum',
+    '分點': 'count'  # 分點數量
+}
+
+BRANCH_AGGREGATIONS = {
+    '買進股數': 'sum',
+    '賣出股數': 'sum',
+    '淨買賣股數': 'sum',
+    '淨買賣金額': 'sum'
+}
+
+FUSED_REQUIRED_COLUMNS = ['券商', '分點', '買進股數', '賣出股數', '買進金額', '賣出金額', '淨買賣股數', '淨買賣金額']
+
+def group_sums(values: np.ndarray, codes: np.ndarray, size: int) -> np.ndarray:
+    """以 bincount 依整數代碼加總，整數欄位轉回原型態 (加總在 2^53 內皆為精確值)"""
+    if values.dtype.kind == 'f':
+        values = np.nan_to_num(values)
+    totals = np.bincount(codes, weights=values, minlength=size)
+    return totals.astype(values.dtype) if values.dtype.kind in 'iu' else totals
+
+def fused_aggregate(df: pd.DataFrame) -> Dict:
+    """
+    單次掃描完成券商、分點彙總與淨買賣股數統計
+
+    券商與分點只各做一次 factorize 轉成整數代碼，所有加總都以 NumPy bincount 完成，
+    不再為每個分析項目重新以字串分組。
+
+    Args:
+        df: 券商資料 (分析器欄位格式，需包含 FUSED_REQUIRED_COLUMNS)
+
+    Returns:
+        {'券商彙總': 與 groupby('券商').agg(BROKER_AGGREGATIONS) 相同的 DataFrame,
+         '分點彙總': 與 groupby(['券商', '分點']).agg(BRANCH_AGGREGATIONS) 相同的 DataFrame,
+         '淨買賣統計': (筆數, 平均, 離均差平方和)}
+    """
+    broker_codes, brokers = pd.factorize(df['券商'], sort=True)
+    branch_codes, branches = pd.factorize(df['分點'], sort=True)
+
+    # 與 groupby 相同，代碼為空值的資料不列入分組
+    broker_valid = broker_codes >= 0
+    pair_valid = broker_valid & (branch_codes >= 0)
+    all_pairs_valid = pair_valid.all()
+
+    # (券商, 分點) 組合成單一整數鍵，鍵值大小順序即為 groupby 的排序
+    branch_size = max(len(branches), 1)
+    pair_keys = broker_codes.astype(np.int64) * branch_size + branch_codes
+    if not all_pairs_valid:
+        pair_keys = pair_keys[pair_valid]
+
+    key_space = len(brokers) * branch_size
+    if key_space <= 4 * len(pair_keys) + 1024:
+        # 鍵空間不大時直接在稠密鍵空間上加總，不必再雜湊一次
+        dense_counts = np.bincount(pair_keys, minlength=key_space)
+        pairs = np.flatnonzero(dense_counts)
+        pair_counts = dense_counts[pairs]
+        pair_sums = lambda values: group_sums(values, pair_keys, key_space)[pairs]
+    else:
+        pair_codes, pairs = pd.factorize(pair_keys, sort=True)
+        pair_counts = np.bincount(pair_codes, minlength=len(pairs))
+        pair_sums = lambda values: group_sums(values, pair_codes, len(pairs))
+    pair_brokers = pairs // branch_size
+
+    pair_totals = {}
+    broker_totals = {'券商': brokers}
+    for column in FUSED_REQUIRED_COLUMNS[2:]:
+        values = df[column].to_numpy()
+        if all_pairs_valid:
+            # 每筆資料都屬於某個分點時，券商加總直接由分點加總再彙總
+            pair_totals[column] = pair_sums(values)
+            broker_totals[column] = group_sums(pair_totals[column], pair_brokers, len(brokers))
+        else:
+            pair_totals[column] = pair_sums(values[pair_valid])
+            broker_totals[column] = group_sums(values[broker_valid], broker_codes[broker_valid], len(brokers))
+
+    # 分點數量 = 各券商非空分點的筆數
+    broker_totals['分點'] = np.bincount(pair_brokers, weights=pair_counts, minlength=len(brokers)).astype(np.int64)
+
+    branch_totals = {'券商': brokers.take(pair_brokers), '分點': branches.take(pairs % branch_size)}
+    branch_totals.update({column: pair_totals[column] for column in BRANCH_AGGREGATIONS})
+
+    # 淨買賣股數的筆數、平均與離均差平方和 (略過空值，與 pandas 相同)
+    net = df['淨買賣股數'].to_numpy(dtype=np.float64)
+    if np.isnan(net).any():
+        net = net[~np.isnan(net)]
+    count = len(net)
+    mean = float(net.mean()) if count else 0.0
+    deviation = net - mean
+    m2 = float(deviation @ deviation)
+
+    return {
+        '券商彙總': pd.DataFrame(broker_totals)[['券商'] + list(BROKER_AGGREGATIONS)],
+        '分點彙總': pd.DataFrame(branch_totals)[['券商', '分點'] + list(BRANCH_AGGREGATIONS)],
+        '淨買賣統計': (count, mean, m2)
+    }
+
+class StreamingReportBuilder:
+    """串流報告累加器：逐段併入券商、分點彙總與淨買賣股數的平均/變異數"""
+    
+    def __init__(self):
+        self.total_records = 0
+        self._brokers = None
+        self._branches = None
+        
+        # 淨買賣股數的筆數、平均與離均差平方和 (分段合併公式)
+        self._net_count = 0
+        self._net_mean = 0.0
+        self._net_m2 = 0.0
+    
+    def add_chunk(self, df: pd.DataFrame):
+        """併入一段資料 (分析器欄位格式)"""
+        if df.empty:
+            return
+        self.add_aggregates(fused_aggregate(df), len(df))
+    
+    def add_aggregates(self, aggregated: Dict, records: int):
+        """併入已彙總的結果 (fused_aggregate 或資料庫 get_analysis_aggregates 的格式)"""
+        if not records:
+            return
+        self.total_records += records
+        
+        brokers = aggregated['券商彙總'].set_index('券商')
+        branches = aggregated['分點彙總'].set_index(['券商', '分點'])
+        
+        # 合併後的大小只與券商、分點數量有關
+        if self._brokers is None:
+            self._brokers, self._branches = brokers, branches
+        else:
+            self._brokers = pd.concat([self._brokers, brokers]).groupby(level=0).sum()
+            self._branches = pd.concat([self._branches, branches]).groupby(level=[0, 1]).sum()
+        
+        chunk_count, chunk_mean, chunk_m2 = aggregated['淨買賣統計']
+        if not chunk_count:
+            return
+        
+        count = self._net_count + chunk_count
+        delta = chunk_mean - self._net_mean
+        self._net_mean += delta * chunk_count / count
+        self._net_m2 += chunk_m2 + delta * delta * self._net_count * chunk_count / count
+        self._net_count = count
+    
+    @property
+    def broker_count(self) -> int:
+        return 0 if self._brokers is None else len(self._brokers)
+    
+    @property
+    def branch_count(self) -> int:
+        return 0 if self._branches is None else len(self._branches)
+    
+    def broker_totals(self) -> pd.DataFrame:
+        """券商彙總 (與 analyze_top_brokers 的分組結果相同)"""
+        return self._brokers.reset_index()
+    
+    def branch_totals(self) -> pd.DataFrame:
+        """分點彙總 (與 analyze_branch_activity 的分組結果相同)"""
+        return self._branches.reset_index()
+    
+    def net_volume_stats(self) -> Tuple[float, float]:
+        """淨買賣股數的平均與樣本標準差"""
+        if self._net_count < 2:
+            return self._net_mean, float('nan')
+        return self._net_mean, float(np.sqrt(self._net_m2 / (self._net_count - 1)))
 
 class ChipAnalyzer:
     """籌碼分析器類別"""
     
     def __init__(self):
         self.logger = logging.getLogger(__name__)
-        plt.rcParams['font.sans-serif'] = ['Microsoft JhengHei']  # 設定中文字體
-        plt.rcParams['axes.unicode_minus'] = False
         
     def load_data(self, filepath: str) -> pd.DataFrame:
         """載入券商分點資料"""
@@ -54,10 +225,10 @@ class ChipAnalyzer:
             if missing_cols:
                 self.logger.warning(f"缺少欄位: {missing_cols}")
             
-            # 轉換數值型態
+            # 轉換數值型態 (收集器已解析為整數的欄位略過)
             numeric_columns = ['買進股數', '賣出股數', '買進金額', '賣出金額']
             for col in numeric_columns:
-                if col in df.columns:
+                if col in df.columns and not pd.api.types.is_numeric_dtype(df[col]):
                     df[col] = pd.to_numeric(df[col].astype(str).str.replace(',', ''), errors='coerce').fillna(0)
             
             # 計算淨買賣量和金額
@@ -93,28 +264,8 @@ class ChipAnalyzer:
         
         try:
             # 依券商群組統計
-            broker_stats = df.groupby('券商').agg({
-                '買進股數': 'sum',
-                '賣出股數': 'sum', 
-                '買進金額': 'sum',
-                '賣出金額': 'sum',
-                '淨買賣股數': 'sum',
-                '淨買賣金額': 'sum',
-                '分點': 'count'  # 分點數量
-            }).reset_index()
-            
-            # 重新命名欄位
-            broker_stats.rename(columns={'分點': '分點數量'}, inplace=True)
-            
-            # 計算總交易量 (買進 + 賣出)
-            broker_stats['總交易股數'] = broker_stats['買進股數'] + broker_stats['賣出股數']
-            broker_stats['總交易金額'] = broker_stats['買進金額'] + broker_stats['賣出金額']
-            
-            # 依總交易量排序
-            broker_stats = broker_stats.sort_values('總交易金額', ascending=False).head(top_n)
-            
-            # 加入券商名稱
-            broker_stats['券商名稱'] = broker_stats['券商'].map(BROKER_MAPPING).fillna('未知券商')
+            broker_stats = df.groupby('券商', observed=True).agg(BROKER_AGGREGATIONS).reset_index()
+            broker_stats = self._rank_brokers(broker_stats, top_n)
             
             self.logger.info(f"完成前 {top_n} 券商分析")
             return broker_stats
@@ -123,6 +274,22 @@ class ChipAnalyzer:
             self.logger.error(f"券商分析失敗: {e}")
             return pd.DataFrame()
     
+    def _rank_brokers(self, broker_stats: pd.DataFrame, top_n: int) -> pd.DataFrame:
+        """由券商彙總計算總交易量、排序並加入券商名稱"""
+        # 重新命名欄位
+        broker_stats = broker_stats.rename(columns={'分點': '分點數量'})
+        
+        # 計算總交易量 (買進 + 賣出)
+        broker_stats['總交易股數'] = broker_stats['買進股數'] + broker_stats['賣出股數']
+        broker_stats['總交易金額'] = broker_stats['買進金額'] + broker_stats['賣出金額']
+        
+        # 依總交易量排序
+        broker_stats = broker_stats.sort_values('總交易金額', ascending=False).head(top_n)
+        
+        # 加入券商名稱
+        broker_stats['券商名稱'] = broker_stats['券商'].astype(object).map(BROKER_MAPPING).fillna('未知券商')
+        return broker_stats
+    
     def analyze_branch_activity(self, df: pd.DataFrame, min_volume: int = None) -> pd.DataFrame:
         """
         分析分點活躍度
@@ -139,24 +306,8 @@ class ChipAnalyzer:
             
         try:
             # 依分點群組統計
-            branch_stats = df.groupby(['券商', '分點']).agg({
-                '買進股數': 'sum',
-                '賣出股數': 'sum',
-                '淨買賣股數': 'sum',
-                '淨買賣金額': 'sum'
-            }).reset_index()
-            
-            # 計算總交易量
-            branch_stats['總交易股數'] = branch_stats['買進股數'] + branch_stats['賣出股數']
-            
-            # 過濾小額交易
-            branch_stats = branch_stats[branch_stats['總交易股數'] >= min_volume]
-            
-            # 依淨買賣股數排序
-            branch_stats = branch_stats.sort_values('淨買賣股數', ascending=False)
-            
-            # 加入券商名稱
-            branch_stats['券商名稱'] = branch_stats['券商'].map(BROKER_MAPPING).fillna('未知券商')
+            branch_stats = df.groupby(['券商', '分點'], observed=True).agg(BRANCH_AGGREGATIONS).reset_index()
+            branch_stats = self._rank_branches(branch_stats, min_volume)
             
             self.logger.info(f"完成分點活躍度分析，共 {len(branch_stats)} 個有效分點")
             return branch_stats
@@ -165,17 +316,35 @@ class ChipAnalyzer:
             self.logger.error(f"分點分析失敗: {e}")
             return pd.DataFrame()
     
-    def detect_unusual_activity(self, df: pd.DataFrame, std_threshold: float = 2.0) -> pd.DataFrame:
+    def _rank_branches(self, branch_stats: pd.DataFrame, min_volume: int) -> pd.DataFrame:
+        """由分點彙總計算總交易量、過濾小額交易、排序並加入券商名稱"""
+        # 計算總交易量
+        branch_stats['總交易股數'] = branch_stats['買進股數'] + branch_stats['賣出股數']
+        
+        # 過濾小額交易
+        branch_stats = branch_stats[branch_stats['總交易股數'] >= min_volume]
+        
+        # 依淨買賣股數排序
+        branch_stats = branch_stats.sort_values('淨買賣股數', ascending=False)
+        
+        # 加入券商名稱
+        branch_stats['券商名稱'] = branch_stats['券商'].astype(object).map(BROKER_MAPPING).fillna('未知券商')
+        return branch_stats
+    
+    def detect_unusual_activity(self, df: pd.DataFrame, std_threshold: float = None) -> pd.DataFrame:
         """
         偵測異常交易活動
         
         Args:
             df: 券商資料
-            std_threshold: 標準差閾值
+            std_threshold: 標準差閾值，預設為 UNUSUAL_STD_THRESHOLD
             
         Returns:
             異常交易記錄
         """
+        if std_threshold is None:
+            std_threshold = UNUSUAL_STD_THRESHOLD
+            
         try:
             if df.empty or '淨買賣股數' not in df.columns:
                 return pd.DataFrame()
@@ -184,18 +353,7 @@ class ChipAnalyzer:
             mean_net = df['淨買賣股數'].mean()
             std_net = df['淨買賣股數'].std()
             
-            # 找出超過閾值的異常交易
-            threshold_upper = mean_net + (std_threshold * std_net)
-            threshold_lower = mean_net - (std_threshold * std_net)
-            
-            unusual_trades = df[
-                (df['淨買賣股數'] > threshold_upper) | 
-                (df['淨買賣股數'] < threshold_lower)
-            ].copy()
-            
-            # 計算異常程度
-            unusual_trades['異常程度'] = abs(unusual_trades['淨買賣股數'] - mean_net) / std_net
-            unusual_trades = unusual_trades.sort_values('異常程度', ascending=False)
+            unusual_trades = self._select_unusual(df, mean_net, std_net, std_threshold)
             
             self.logger.info(f"發現 {len(unusual_trades)} 筆異常交易")
             return unusual_trades
@@ -204,8 +362,26 @@ class ChipAnalyzer:
             self.logger.error(f"異常檢測失敗: {e}")
             return pd.DataFrame()
     
-    def create_broker_chart(self, broker_stats: pd.DataFrame, stock_code: str = "") -> go.Figure:
+    def _select_unusual(self, df: pd.DataFrame, mean_net: float, std_net: float,
+                        std_threshold: float) -> pd.DataFrame:
+        """依淨買賣股數的平均與標準差挑出異常交易並計算異常程度"""
+        # 找出超過閾值的異常交易
+        threshold_upper = mean_net + (std_threshold * std_net)
+        threshold_lower = mean_net - (std_threshold * std_net)
+        
+        unusual_trades = df[
+            (df['淨買賣股數'] > threshold_upper) | 
+            (df['淨買賣股數'] < threshold_lower)
+        ].copy()
+        
+        # 計算異常程度
+        unusual_trades['異常程度'] = abs(unusual_trades['淨買賣股數'] - mean_net) / std_net
+        return unusual_trades.sort_values('異常程度', ascending=False)
+    
+    def create_broker_chart(self, broker_stats: pd.DataFrame, stock_code: str = "") -> 'go.Figure':
         """建立券商交易圖表"""
+        import plotly.graph_objects as go
+        
         if broker_stats.empty:
             return go.Figure()
             
@@ -245,8 +421,10 @@ class ChipAnalyzer:
             self.logger.error(f"圖表建立失敗: {e}")
             return go.Figure()
     
-    def create_net_trading_chart(self, branch_stats: pd.DataFrame, top_n: int = 20) -> go.Figure:
+    def create_net_trading_chart(self, branch_stats: pd.DataFrame, top_n: int = 20) -> 'go.Figure':
         """建立淨買賣圖表"""
+        import plotly.graph_objects as go
+        
         if branch_stats.empty:
             return go.Figure()
             
@@ -281,38 +459,74 @@ class ChipAnalyzer:
             self.logger.error(f"圖表建立失敗: {e}")
             return go.Figure()
     
-    def generate_analysis_report(self, df: pd.DataFrame, stock_code: str = "") -> Dict:
+    def compute_report_tables(self, df: pd.DataFrame, std_threshold: float = None) -> Dict:
+        """
+        計算報告的統計表格 (基本統計、主要券商、活躍分點、異常交易)
+        
+        欄位齊全時以 fused_aggregate 單次掃描取得所有彙總，否則逐項分析。
+        
+        Returns:
+            報告表格字典 (不含圖表)
+        """
+        if std_threshold is None:
+            std_threshold = UNUSUAL_STD_THRESHOLD
+        
+        tables = {}
+        fused = not df.empty and all(col in df.columns for col in FUSED_REQUIRED_COLUMNS)
+        
+        if fused:
+            aggregated = fused_aggregate(df)
+            total_brokers = len(aggregated['券商彙總'])
+            total_branches = len(aggregated['分點彙總'])
+        else:
+            total_brokers = df['券商'].nunique() if '券商' in df.columns else 0
+            total_branches = len(df.groupby(['券商', '分點'], observed=True)) if all(col in df.columns for col in ['券商', '分點']) else 0
+        
+        # 基本統計
+        tables['基本統計'] = {
+            '總記錄數': len(df),
+            '券商數量': total_brokers,
+            '分點數量': total_branches,
+            '分析日期': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        }
+        
+        if df.empty:
+            return tables
+        
+        if fused:
+            count, mean_net, m2 = aggregated['淨買賣統計']
+            std_net = np.sqrt(m2 / (count - 1)) if count > 1 else np.nan
+            
+            tables['主要券商'] = self._rank_brokers(aggregated['券商彙總'], TOP_BROKERS_COUNT)
+            tables['活躍分點'] = self._rank_branches(aggregated['分點彙總'], MINIMUM_VOLUME_THRESHOLD)
+            tables['異常交易'] = self._select_unusual(df, mean_net, std_net, std_threshold)
+            self.logger.info(f"發現 {len(tables['異常交易'])} 筆異常交易")
+        else:
+            tables['主要券商'] = self.analyze_top_brokers(df, TOP_BROKERS_COUNT)
+            tables['活躍分點'] = self.analyze_branch_activity(df)
+            tables['異常交易'] = self.detect_unusual_activity(df, std_threshold)
+        
+        return tables
+    
+    @timed('analysis.report')
+    def generate_analysis_report(self, df: pd.DataFrame, stock_code: str = "", charts: bool = True) -> Dict:
         """
         產生分析報告
         
+        Args:
+            df: 券商資料 (分析器欄位格式)
+            stock_code: 股票代碼
+            charts: 是否建立圖表 (False 時不載入 plotly)
+        
         Returns:
             包含各種分析結果的字典
         """
         report = {}
         
         try:
-            # 基本統計
-            total_records = len(df)
-            total_brokers = df['券商'].nunique() if '券商' in df.columns else 0
-            total_branches = len(df.groupby(['券商', '分點'])) if all(col in df.columns for col in ['券商', '分點']) else 0
-            
-            report['基本統計'] = {
-                '總記錄數': total_records,
-                '券商數量': total_brokers,
-                '分點數量': total_branches,
-                '分析日期': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            }
-            
-            if not df.empty:
-                # 主要券商分析
-                report['主要券商'] = self.analyze_top_brokers(df)
-                
-                # 分點活躍度
-                report['活躍分點'] = self.analyze_branch_activity(df)
-                
-                # 異常交易
-                report['異常交易'] = self.detect_unusual_activity(df)
-                
+            report.update(self.compute_report_tables(df))
+            
+            if charts and not df.empty:
                 # 圖表
                 report['券商圖表'] = self.create_broker_chart(report['主要券商'], stock_code)
                 report['淨買賣圖表'] = self.create_net_trading_chart(report['活躍分點'])
@@ -324,33 +538,138 @@ class ChipAnalyzer:
             self.logger.error(f"報告產生失敗: {e}")
             return {'錯誤': str(e)}
     
-    def save_report_to_excel(self, report: Dict, filename: str):
-        """儲存報告到 Excel"""
+    @timed('analysis.report.streaming')
+    def generate_streaming_report(self, chunk_loader: Callable[..., Iterable[pd.DataFrame]],
+                                  stock_code: str = "", std_threshold: float = None,
+                                  charts: bool = True) -> Dict:
+        """
+        以分段資料產生分析報告，記憶體用量只與券商、分點數量有關，與區間長度無關
+        
+        Args:
+            chunk_loader: chunk_loader(net_volume_band=None) 回傳依日期排序的資料段；
+                指定 (下限, 上限) 時只需回傳淨買賣股數落在區間外的資料
+            stock_code: 股票代碼
+            std_threshold: 異常交易的標準差閾值，預設為 UNUSUAL_STD_THRESHOLD
+            charts: 是否建立圖表 (False 時不載入 plotly)
+            
+        Returns:
+            與 generate_analysis_report 相同結構的報告字典
+        """
+        try:
+            # 單次掃描累加所有彙總
+            builder = StreamingReportBuilder()
+            for chunk in chunk_loader():
+                builder.add_chunk(chunk)
+            
+            report = self._report_from_totals(builder, chunk_loader, stock_code, std_threshold, charts)
+            self.logger.info("串流分析報告產生完成")
+            return report
+            
+        except Exception as e:
+            self.logger.error(f"報告產生失敗: {e}")
+            return {'錯誤': str(e)}
+    
+    @timed('analysis.report.aggregated')
+    def generate_aggregated_report(self, aggregated: Dict,
+                                   outlier_loader: Callable[..., Iterable[pd.DataFrame]],
+                                   stock_code: str = "", std_threshold: float = None,
+                                   charts: bool = True) -> Dict:
+        """
+        以資料庫端完成的彙總產生分析報告，只有落在異常門檻外的資料需要讀進 pandas
+        
+        Args:
+            aggregated: 資料庫 get_analysis_aggregates 的結果
+            outlier_loader: outlier_loader(net_volume_band=(下限, 上限)) 回傳淨買賣股數落在區間外的資料
+            stock_code: 股票代碼
+            std_threshold: 異常交易的標準差閾值，預設為 UNUSUAL_STD_THRESHOLD
+            charts: 是否建立圖表 (False 時不載入 plotly)
+            
+        Returns:
+            與 generate_analysis_report 相同結構的報告字典
+        """
         try:
-            filepath = OUTPUT_DIR / f"{filename}.xlsx"
-            
-            with pd.ExcelWriter(filepath, engine='openpyxl') as writer:
-                # 基本統計
-                if '基本統計' in report:
-                    basic_stats = pd.DataFrame([report['基本統計']])
-                    basic_stats.to_excel(writer, sheet_name='基本統計', index=False)
-                
-                # 主要券商
-                if '主要券商' in report and not report['主要券商'].empty:
-                    report['主要券商'].to_excel(writer, sheet_name='主要券商', index=False)
-                
-                # 活躍分點
-                if '活躍分點' in report and not report['活躍分點'].empty:
-                    report['活躍分點'].to_excel(writer, sheet_name='活躍分點', index=False)
-                
-                # 異常交易
-                if '異常交易' in report and not report['異常交易'].empty:
-                    report['異常交易'].to_excel(writer, sheet_name='異常交易', index=False)
-            
-            self.logger.info(f"報告已儲存到 {filepath}")
+            builder = StreamingReportBuilder()
+            builder.add_aggregates(aggregated, aggregated.get('總記錄數', 0))
+            
+            report = self._report_from_totals(builder, outlier_loader, stock_code, std_threshold, charts)
+            self.logger.info("分析報告產生完成")
+            return report
             
         except Exception as e:
-            self.logger.error(f"儲存報告失敗: {e}")
+            self.logger.error(f"報告產生失敗: {e}")
+            return {'錯誤': str(e)}
+    
+    def _report_from_totals(self, builder: StreamingReportBuilder,
+                            outlier_loader: Callable[..., Iterable[pd.DataFrame]],
+                            stock_code: str, std_threshold: float = None, charts: bool = True) -> Dict:
+        """由累加完成的彙總排名券商、分點，並回頭讀取門檻外的資料找出異常交易"""
+        if std_threshold is None:
+            std_threshold = UNUSUAL_STD_THRESHOLD
+        
+        report = {}
+        report['基本統計'] = {
+            '總記錄數': builder.total_records,
+            '券商數量': builder.broker_count,
+            '分點數量': builder.branch_count,
+            '分析日期': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        }
+        
+        if builder.total_records:
+            report['主要券商'] = self._rank_brokers(builder.broker_totals(), TOP_BROKERS_COUNT)
+            report['活躍分點'] = self._rank_branches(builder.branch_totals(), MINIMUM_VOLUME_THRESHOLD)
+            
+            # 異常門檻要等全部資料看過才知道，只回頭讀取落在門檻外的資料
+            mean_net, std_net = builder.net_volume_stats()
+            band = (mean_net - std_threshold * std_net, mean_net + std_threshold * std_net)
+            if builder.total_records > 1 and std_net > 0:
+                outliers = [chunk for chunk in outlier_loader(net_volume_band=band) if not chunk.empty]
+            else:
+                outliers = []
+            
+            if outliers:
+                report['異常交易'] = self._select_unusual(
+                    pd.concat(outliers, ignore_index=True), mean_net, std_net, std_threshold
+                )
+            else:
+                report['異常交易'] = pd.DataFrame()
+            self.logger.info(f"發現 {len(report['異常交易'])} 筆異常交易")
+            
+            if charts:
+                # 圖表
+                report['券商圖表'] = self.create_broker_chart(report['主要券商'], stock_code)
+                report['淨買賣圖表'] = self.create_net_trading_chart(report['活躍分點'])
+        
+        return report
+    
+    def save_report(self, report: Dict, filename: str, formats=None) -> List[Path]:
+        """
+        依輸出格式儲存報告
+        
+        Args:
+            report: 分析報告
+            filename: 檔名 (不含副檔名)，存放於 OUTPUT_DIR
+            formats: 輸出格式 (csv、parquet、jsonl、html、excel，逗號分隔字串或列表)，預設為 OUTPUT_FORMAT
+            
+        Returns:
+            寫入的檔案列表 (個別格式失敗時只記錄錯誤)
+        """
+        base = OUTPUT_DIR / filename
+        paths = []
+        
+        for fmt in normalize_formats(OUTPUT_FORMAT if formats is None else formats):
+            try:
+                with get_metrics().timer(f'analysis.save.{fmt}'):
+                    paths += REPORT_WRITERS[fmt](report, base)
+            except Exception as e:
+                self.logger.error(f"儲存 {fmt} 報告失敗: {e}")
+        
+        if paths:
+            self.logger.info(f"報告已儲存到 {base}* ({len(paths)} 個檔案)")
+        return paths
+    
+    def save_report_to_excel(self, report: Dict, filename: str):
+        """儲存報告到 Excel"""
+        self.save_report(report, filename, ['excel'])
 
 if __name__ == "__main__":
     # 測試分析器
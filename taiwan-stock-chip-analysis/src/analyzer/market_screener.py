@@ -0,0 +1,167 @@
+"""
+全市場主力集中度篩選
+一次讀取全市場各 (股票, 分點) 的買賣合計，以 NumPy 分組運算同時算出所有股票的
+主力集中度、買賣家數差與淨買賣 HHI，不逐檔股票迴圈
+"""
+import pandas as pd
+import numpy as np
+from datetime import datetime, timedelta
+import logging
+import sys
+import os
+
+# 添加專案根目錄到路徑
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+from config import *
+from src.analyzer.chip_analyzer import group_sums
+from src.utils.metrics import timed
+from src.utils.trading_calendar import get_trading_calendar
+
+# 篩選結果欄位 (依輸出順序)
+SCREEN_COLUMNS = [
+    '股票代碼', '成交股數', '分點數', '買超分點數', '賣超分點數', '買賣家數差', '買賣家數比',
+    '主力買超股數', '主力賣超股數', '主力集中度', '淨買賣HHI'
+]
+
+# 可排序的指標；家數差、家數比越小表示買方越集中，由小到大排序
+SCREEN_SORT_ASCENDING = {
+    '主力集中度': False,
+    '淨買賣HHI': False,
+    '主力買超股數': False,
+    '買賣家數差': True,
+    '買賣家數比': True,
+}
+
+def _ratio(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    """逐元素相除，分母為 0 時為 NaN"""
+    result = np.full(len(numerator), np.nan)
+    np.divide(numerator, denominator, out=result, where=denominator != 0)
+    return result
+
+def concentration_metrics(totals: pd.DataFrame, top_n: int = None) -> pd.DataFrame:
+    """
+    計算每檔股票的主力集中度指標
+
+    股票只做一次 factorize，所有股票的分點依淨買賣股數以單次 lexsort 排序，
+    由排序位置取得各股內的名次，前 N 大買超 / 賣超與各項加總都以 bincount 完成。
+
+    - 主力集中度 = (前 N 大買超分點淨買股數 - 前 N 大賣超分點淨賣股數) / 成交股數
+    - 買賣家數差 = 買超分點數 - 賣超分點數 (負值表示買方集中在較少分點)
+    - 買賣家數比 = 買超分點數 / 賣超分點數
+    - 淨買賣HHI = 各分點淨買賣股數絕對值佔比的平方和 (越接近 1 越集中)
+
+    Args:
+        totals: 各 (股票, 分點) 的買賣合計 (get_market_branch_totals 的欄位格式)
+        top_n: 主力取前 N 大分點，預設為 SCREEN_TOP_BRANCHES
+
+    Returns:
+        每檔股票一列的 DataFrame (SCREEN_COLUMNS)，依股票代碼排序
+    """
+    top_n = top_n or SCREEN_TOP_BRANCHES
+    if totals.empty:
+        return pd.DataFrame(columns=SCREEN_COLUMNS)
+
+    codes, stocks = pd.factorize(totals['stock_code'], sort=True)
+    size = len(stocks)
+    net = np.nan_to_num(totals['net_volume'].to_numpy(dtype=np.float64))
+
+    # 依 (股票, 淨買賣股數由大到小) 排序，名次 = 排序位置 - 該股票的起始位置
+    order = np.lexsort((-net, codes))
+    sorted_codes = codes[order]
+    sorted_net = net[order]
+    branch_counts = np.bincount(codes, minlength=size)
+    starts = np.cumsum(branch_counts) - branch_counts
+    rank = np.arange(len(order)) - starts[sorted_codes]
+    rank_from_end = branch_counts[sorted_codes] - 1 - rank
+
+    top_buy = np.where((rank < top_n) & (sorted_net > 0), sorted_net, 0.0)
+    top_sell = np.where((rank_from_end < top_n) & (sorted_net < 0), -sorted_net, 0.0)
+    top_buy = np.bincount(sorted_codes, weights=top_buy, minlength=size)
+    top_sell = np.bincount(sorted_codes, weights=top_sell, minlength=size)
+
+    # 每筆成交都有一個買方分點，買進股數合計即為成交股數
+    volume = group_sums(totals['buy_volume'].to_numpy(), codes, size)
+    buyers = np.bincount(codes, weights=net > 0, minlength=size).astype(np.int64)
+    sellers = np.bincount(codes, weights=net < 0, minlength=size).astype(np.int64)
+
+    abs_net = np.abs(net)
+    abs_totals = np.bincount(codes, weights=abs_net, minlength=size)
+    shares = _ratio(abs_net, abs_totals[codes])
+    hhi = np.bincount(codes, weights=np.nan_to_num(shares) ** 2, minlength=size)
+
+    return pd.DataFrame({
+        '股票代碼': stocks,
+        '成交股數': volume,
+        '分點數': branch_counts,
+        '買超分點數': buyers,
+        '賣超分點數': sellers,
+        '買賣家數差': buyers - sellers,
+        '買賣家數比': _ratio(buyers, sellers),
+        '主力買超股數': top_buy,
+        '主力賣超股數': top_sell,
+        '主力集中度': _ratio(top_buy - top_sell, volume.astype(np.float64)),
+        '淨買賣HHI': np.where(abs_totals > 0, hhi, np.nan),
+    })
+
+class MarketScreener:
+    """全市場主力集中度篩選器"""
+
+    def __init__(self, database):
+        """
+        Args:
+            database: ChipDatabase 或 ParquetChipDatabase
+        """
+        self.database = database
+        self.logger = logging.getLogger(__name__)
+
+    def _window(self, date: str, days: int) -> tuple:
+        """取得以 date 為最後一日、共 days 個交易日的 (起始日, 結束日)"""
+        end_date = date or datetime.now().strftime('%Y-%m-%d')
+        if days <= 1:
+            return end_date, end_date
+
+        # 休市日最長約十天，多往前取兩週再取最後 days 個交易日
+        lookback = (datetime.strptime(end_date, '%Y-%m-%d') - timedelta(days=days * 2 + 14)).strftime('%Y-%m-%d')
+        trading_days = get_trading_calendar().trading_days(lookback, end_date)
+        return (trading_days[-days] if len(trading_days) >= days else lookback), end_date
+
+    @timed('analysis.screen.market')
+    def screen(self, date: str = None, days: int = 1, top_n: int = None,
+               min_volume: int = None, sort_by: str = '主力集中度') -> pd.DataFrame:
+        """
+        篩選全市場股票並依指標排序
+
+        Args:
+            date: 最後一個交易日 (YYYY-MM-DD)，預設為今日
+            days: 統計的交易日數
+            top_n: 主力取前 N 大分點，預設為 SCREEN_TOP_BRANCHES
+            min_volume: 成交股數低於此值的股票不列入，預設為 SCREEN_MIN_VOLUME
+            sort_by: 排序指標 (SCREEN_SORT_ASCENDING 之一)
+
+        Returns:
+            含股票名稱的篩選結果 DataFrame；無資料時回傳空 DataFrame
+        """
+        try:
+            min_volume = SCREEN_MIN_VOLUME if min_volume is None else min_volume
+            start_date, end_date = self._window(date, days)
+
+            totals = self.database.get_market_branch_totals(start_date=start_date, end_date=end_date)
+            if totals.empty:
+                self.logger.warning(f"{start_date} ~ {end_date} 無券商分點資料")
+                return pd.DataFrame()
+
+            result = concentration_metrics(totals, top_n)
+            result = result[result['成交股數'] >= min_volume].copy()
+
+            quotes = self.database.get_daily_quotes(start_date=start_date, end_date=end_date)
+            # get_daily_quotes 依日期遞減排序，保留每檔最新一日的股票名稱
+            names = quotes.drop_duplicates('stock_code', keep='first').set_index('stock_code')['stock_name'] if not quotes.empty else {}
+            result.insert(1, '股票名稱', result['股票代碼'].map(names))
+
+            result = result.sort_values(sort_by, ascending=SCREEN_SORT_ASCENDING[sort_by], ignore_index=True)
+            self.logger.info(f"{start_date} ~ {end_date} 篩選 {len(result)} 檔股票 (共 {len(totals)} 筆分點合計)")
+            return result
+
+        except Exception as e:
+            self.logger.error(f"全市場篩選失敗: {e}")
+            return pd.DataFrame()
@@ -0,0 +1,179 @@
+"""
+分析報告輸出
+依輸出格式 (OUTPUT_FORMAT) 將分析報告寫成 CSV、Parquet、JSON Lines、HTML 儀表板或 Excel；
+HTML 儀表板共用輸出目錄下的一份 plotly.js，不在每個檔案內嵌
+"""
+import html
+import os
+import sys
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Union
+
+import pandas as pd
+
+# 添加專案根目錄到路徑
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+from config import *
+
+# 報告中的表格與圖表 (依輸出順序)
+REPORT_TABLES = ['基本統計', '主要券商', '活躍分點', '異常交易']
+REPORT_CHARTS = ['券商圖表', '淨買賣圖表']
+
+# 格式別名
+FORMAT_ALIASES = {'json': 'jsonl', 'xlsx': 'excel'}
+
+# HTML 儀表板每個表格顯示的列數 (完整資料請輸出 csv、parquet)
+HTML_TABLE_ROWS = 50
+
+HTML_TEMPLATE = """<!DOCTYPE html>
+<html lang="zh-Hant">
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+{script}
+<style>
+body {{ font-family: sans-serif; margin: 2em; }}
+table {{ border-collapse: collapse; margin-bottom: 2em; font-size: 0.9em; }}
+th, td {{ border: 1px solid #ddd; padding: 4px 8px; text-align: right; }}
+th {{ background: #f4f4f4; }}
+</style>
+</head>
+<body>
+<h1>{title}</h1>
+{body}
+</body>
+</html>
+"""
+
+def report_tables(report: Dict) -> Dict[str, pd.DataFrame]:
+    """取出報告中有資料的表格 {名稱: DataFrame}，基本統計轉為單列表格"""
+    tables = {}
+    for name in REPORT_TABLES:
+        table = report.get(name)
+        if table is None:
+            continue
+        if isinstance(table, dict):
+            table = pd.DataFrame([table])
+        if not table.empty:
+            tables[name] = table
+    return tables
+
+def _table_path(base: Path, name: str, suffix: str) -> Path:
+    """每個表格一個檔案: <報告名稱>_<表格>.<副檔名>"""
+    return base.with_name(f"{base.name}_{name}{suffix}")
+
+def write_csv(report: Dict, base: Path) -> List[Path]:
+    """每個表格寫成一個 CSV (utf-8-sig，Excel 可直接開啟)"""
+    paths = []
+    for name, table in report_tables(report).items():
+        path = _table_path(base, name, '.csv')
+        table.to_csv(path, index=False, encoding='utf-8-sig')
+        paths.append(path)
+    return paths
+
+def write_parquet(report: Dict, base: Path) -> List[Path]:
+    """每個表格寫成一個 Parquet 檔"""
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise ImportError("需要安裝 pyarrow 套件才能輸出 Parquet 報告，請執行: pip install pyarrow")
+
+    paths = []
+    for name, table in report_tables(report).items():
+        path = _table_path(base, name, '.parquet')
+        table.to_parquet(path, index=False)
+        paths.append(path)
+    return paths
+
+def write_jsonl(report: Dict, base: Path) -> List[Path]:
+    """所有表格寫入同一個 JSON Lines 檔，每列以「表格」欄位標示所屬表格"""
+    path = base.with_suffix('.jsonl')
+    with open(path, 'w', encoding='utf-8') as f:
+        for name, table in report_tables(report).items():
+            records = table.copy()
+            records.insert(0, '表格', name)
+            lines = records.to_json(orient='records', lines=True, force_ascii=False, date_format='iso')
+            f.write(lines if lines.endswith('\n') else lines + '\n')
+    return [path]
+
+def write_excel(report: Dict, base: Path) -> List[Path]:
+    """寫成 Excel 活頁簿，每個表格一個工作表"""
+    path = base.with_suffix('.xlsx')
+    with pd.ExcelWriter(path, engine='openpyxl') as writer:
+        for name, table in report_tables(report).items():
+            table.to_excel(writer, sheet_name=name, index=False)
+    return [path]
+
+def _plotly_asset(directory: Path) -> str:
+    """
+    確保輸出目錄有一份 plotly.js (檔名含版本)，所有儀表板共用
+
+    Returns:
+        相對於輸出目錄的檔名
+    """
+    import plotly
+    from plotly.offline import get_plotlyjs
+
+    name = f"plotly-{plotly.__version__}.min.js"
+    path = directory / name
+    if not path.exists():
+        # 平行批量分析時可能同時寫入，先寫暫存檔再原子替換
+        tmp_path = path.with_name(f"{name}.{os.getpid()}.tmp")
+        tmp_path.write_text(get_plotlyjs(), encoding='utf-8')
+        os.replace(tmp_path, path)
+    return name
+
+def write_html(report: Dict, base: Path) -> List[Path]:
+    """
+    寫成單一 HTML 儀表板 (圖表與表格摘要)
+
+    圖表以 <script src> 引用輸出目錄下共用的 plotly.js，每個儀表板只有數十 KB
+    """
+    charts = [report[name] for name in REPORT_CHARTS if report.get(name) is not None]
+
+    body = [chart.to_html(full_html=False, include_plotlyjs=False) for chart in charts]
+    for name, table in report_tables(report).items():
+        shown = table.head(HTML_TABLE_ROWS)
+        caption = f"{name} (前 {HTML_TABLE_ROWS} 筆，共 {len(table)} 筆)" if len(table) > len(shown) else name
+        body.append(f"<h2>{html.escape(caption)}</h2>")
+        body.append(shown.to_html(index=False, border=0, na_rep=''))
+
+    script = f'<script src="{_plotly_asset(base.parent)}"></script>' if charts else ''
+
+    path = base.with_suffix('.html')
+    path.write_text(
+        HTML_TEMPLATE.format(title=html.escape(base.name), script=script, body='\n'.join(body)),
+        encoding='utf-8'
+    )
+    return [path]
+
+# 輸出格式 → 寫入函式 (report, 不含副檔名的輸出路徑) -> 寫入的檔案列表
+REPORT_WRITERS: Dict[str, Callable[[Dict, Path], List[Path]]] = {
+    'csv': write_csv,
+    'parquet': write_parquet,
+    'jsonl': write_jsonl,
+    'html': write_html,
+    'excel': write_excel,
+}
+
+def normalize_formats(formats: Union[str, Iterable[str]]) -> List[str]:
+    """
+    整理輸出格式設定 (逗號分隔字串或列表)，去除重複並轉換別名
+
+    Raises:
+        ValueError: 不支援的輸出格式
+    """
+    if isinstance(formats, str):
+        formats = formats.split(',')
+
+    normalized = []
+    for fmt in formats:
+        fmt = fmt.strip().lower()
+        if not fmt:
+            continue
+        fmt = FORMAT_ALIASES.get(fmt, fmt)
+        if fmt not in REPORT_WRITERS:
+            raise ValueError(f"不支援的輸出格式: {fmt} (可用: {', '.join(REPORT_WRITERS)})")
+        if fmt not in normalized:
+            normalized.append(fmt)
+    return normalized
@@ -1,33 +1,229 @@
 """
 台灣證券交易所 (TWSE) 資料收集器
-負責從證交所 API 抓取券商分點進出資料
+負責從證交所 API 抓取券商分點進出資料，以及上市、上櫃的全市場每日行情
 """
 import requests
+import numpy as np
 import pandas as pd
+import re
 import time
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 import sys
 import os
 
 # 添加專案根目錄到路徑
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
 from config import *
+from src.utils.rate_limiter import RateLimiter, get_rate_limiter
+from src.utils.http_cache import HTTPCache
+from src.utils.metrics import get_metrics
+from src.utils.trading_calendar import TradingCalendar, get_trading_calendar
+
+# 券商分點資料的抓取狀態
+FETCH_OK = 'ok'        # 取得資料
+FETCH_EMPTY = 'empty'  # 查無資料 (非交易日、未上市或尚未公布)
+FETCH_ERROR = 'error'  # 請求或解析失敗，可重試
+
+# 券商分點資料的數值欄位 (解析為 int64)，其餘欄位以 categorical 儲存
+BROKER_NUMERIC_FIELDS = ('買進股數', '賣出股數', '買進金額', '賣出金額')
+
+def _parse_int_column(values) -> np.ndarray:
+    """將含千分位逗號的數字字串轉為 int64 (無法轉換的值視為 0)"""
+    try:
+        return np.array([int(str(value).replace(',', '')) for value in values], dtype=np.int64)
+    except ValueError:
+        parsed = pd.to_numeric(
+            pd.Series(values, dtype=object).astype(str).str.replace(',', '', regex=False), errors='coerce'
+        )
+        return parsed.fillna(0).to_numpy(dtype=np.int64)
+
+def parse_broker_rows(fields: List[str], rows: List[List], date: str, stock_code: str) -> pd.DataFrame:
+    """
+    將券商分點 API 的 data 陣列直接解析為型別化的 DataFrame
+    
+    數值欄位解析為 int64；券商、分點等文字欄位為 categorical，重複的名稱只存一份；
+    日期與股票代碼整份回應相同，以只有一個類別的 categorical 儲存。
+    
+    Args:
+        fields: 欄位名稱 (API 的 fields)
+        rows: 資料列 (API 的 data)
+        date: 日期 (YYYYMMDD)
+        stock_code: 股票代碼
+        
+    Returns:
+        券商分點資料 DataFrame
+    """
+    columns = list(zip(*rows)) if rows else [()] * len(fields)
+    
+    data = {}
+    for field, values in zip(fields, columns):
+        if field in BROKER_NUMERIC_FIELDS:
+            data[field] = _parse_int_column(values)
+        else:
+            data[field] = pd.Categorical(values)
+    
+    codes = np.zeros(len(rows), dtype=np.int8)
+    data['date'] = pd.Categorical.from_codes(codes, [date])
+    data['stock_code'] = pd.Categorical.from_codes(codes, [stock_code])
+    return pd.DataFrame(data)
+
+# 全市場每日行情
+MARKET_TWSE = 'TWSE'  # 上市
+MARKET_TPEX = 'TPEX'  # 上櫃
+QUOTE_COLUMNS = ['date', 'stock_code', 'stock_name', 'market', 'open', 'high', 'low', 'close',
+                 'change', 'volume', 'amount', 'transactions']
+QUOTE_INTEGER_COLUMNS = ['volume', 'amount', 'transactions']
+QUOTE_PRICE_COLUMNS = ['open', 'high', 'low', 'close', 'change']
+
+# 證交所 STOCK_DAY_ALL 欄位 → 統一欄位
+TWSE_QUOTE_FIELDS = {
+    '證券代號': 'stock_code', '證券名稱': 'stock_name',
+    '成交股數': 'volume', '成交金額': 'amount', '成交筆數': 'transactions',
+    '開盤價': 'open', '最高價': 'high', '最低價': 'low', '收盤價': 'close', '漲跌價差': 'change',
+}
+
+# 櫃買中心 OpenAPI 上櫃股票收盤行情欄位 → 統一欄位
+TPEX_QUOTE_FIELDS = {
+    'SecuritiesCompanyCode': 'stock_code', 'CompanyName': 'stock_name',
+    'TradingShares': 'volume', 'TransactionAmount': 'amount', 'TransactionNumber': 'transactions',
+    'Open': 'open', 'High': 'high', 'Low': 'low', 'Close': 'close', 'Change': 'change',
+}
+
+def _normalize_quotes(raw: pd.DataFrame, field_map: Dict[str, str], market: str, date: str) -> pd.DataFrame:
+    """
+    將交易所的每日行情轉為統一欄位，並依股票代碼去除重複
+    
+    Args:
+        raw: 交易所回傳的行情資料
+        field_map: 原始欄位 → 統一欄位
+        market: MARKET_TWSE 或 MARKET_TPEX
+        date: 日期 (YYYYMMDD)
+        
+    Returns:
+        欄位為 QUOTE_COLUMNS 的 DataFrame
+    """
+    df = raw.rename(columns=field_map).reindex(columns=list(field_map.values()))
+    df['stock_code'] = df['stock_code'].fillna('').astype(str).str.strip()
+    df['stock_name'] = df['stock_name'].fillna('').astype(str).str.strip()
+    
+    # 去除千分位與正負號以外的符號，無成交的價格 (--) 為 NaN
+    for column in QUOTE_INTEGER_COLUMNS + QUOTE_PRICE_COLUMNS:
+        values = df[column].astype(str).str.replace(r'[^\d.+-]', '', regex=True)
+        df[column] = pd.to_numeric(values, errors='coerce')
+    for column in QUOTE_INTEGER_COLUMNS:
+        df[column] = df[column].fillna(0).astype('int64')
+    
+    df['date'] = f"{date[:4]}-{date[4:6]}-{date[6:]}"
+    df['market'] = market
+    
+    df = df[df['stock_code'] != ''].drop_duplicates('stock_code', keep='last')
+    return df[QUOTE_COLUMNS].reset_index(drop=True)
 
 class TWSECollector:
     """台灣證券交易所資料收集器"""
     
-    def __init__(self):
-        self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        })
+    def __init__(self, rate_limiter: RateLimiter = None, max_workers: int = None,
+                 cache: HTTPCache = None, calendar: TradingCalendar = None):
+        # 每個執行緒各自持有 Session (requests.Session 非執行緒安全)
+        self._local = threading.local()
+        
+        # 所有請求共用同一個權杖桶，並行時總請求速率仍受 REQUEST_RATE 限制
+        self.rate_limiter = rate_limiter or get_rate_limiter()
+        self.max_workers = max_workers or MAX_WORKERS
+        
+        # 回應快取 (HTTP_CACHE_ENABLED=false 時停用)
+        if cache is None and HTTP_CACHE_ENABLED:
+            cache = HTTPCache()
+        self.cache = cache
+        
+        # 交易日曆，非交易日不發出請求
+        self.calendar = calendar or get_trading_calendar()
         
         # 設定日誌
         logging.basicConfig(level=logging.INFO)
         self.logger = logging.getLogger(__name__)
+    
+    @property
+    def session(self) -> requests.Session:
+        """取得目前執行緒的 HTTP Session"""
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.headers.update({
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+            })
+            self._local.session = session
+        return session
+        
+    def _fetch_json(self, endpoint: str, url: str, params: Dict, date: str,
+                    stock_code: str = None) -> Any:
+        """
+        發送 GET 請求並回傳 JSON，經過磁碟快取
+        
+        快取仍有效時不發出請求 (也不佔用限速權杖)；過期時帶 If-None-Match /
+        If-Modified-Since 重新驗證，伺服器回 304 即沿用快取內容。
+        
+        Args:
+            endpoint: 端點名稱 (快取鍵)
+            url: 請求網址
+            params: 查詢參數
+            date: 資料日期 (YYYYMMDD，快取鍵)
+            stock_code: 股票代碼 (快取鍵)
+            
+        Returns:
+            解析後的 JSON
+        """
+        metrics = get_metrics()
         
+        entry = self.cache.get(endpoint, date, stock_code) if self.cache else None
+        if entry is not None and self.cache.is_fresh(entry):
+            self.logger.debug(f"使用快取: {endpoint} {stock_code or ''} {date}")
+            metrics.increment('http.cache_hits')
+            return entry['payload']
+        
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        
+        # 全域限速，記錄等待時間以區分限速與網路耗時
+        metrics.observe('http.rate_limit_wait', self.rate_limiter.acquire())
+        try:
+            with metrics.timer('http.request'):
+                response = self.session.get(url, params=params, headers=headers or None, timeout=TIMEOUT)
+        except requests.exceptions.RequestException:
+            metrics.increment('http.errors')
+            raise
+        metrics.increment('http.requests')
+        
+        if response.status_code == 304 and entry is not None:
+            metrics.increment('http.not_modified')
+            payload = entry['payload']
+        else:
+            response.raise_for_status()
+            metrics.increment('http.bytes_downloaded', len(response.content))
+            with metrics.timer('http.parse_json'):
+                payload = response.json()
+        
+        if self.cache:
+            # 過去交易日成功取得的資料不會再變動，永久保存；當日或查無資料的回應以 TTL 控制
+            immutable = (isinstance(payload, dict) and payload.get('stat') == 'OK'
+                         and self.cache.is_immutable_date(date))
+            self.cache.put(
+                endpoint, date, stock_code, payload,
+                etag=response.headers.get('ETag') or (entry or {}).get('etag'),
+                last_modified=response.headers.get('Last-Modified') or (entry or {}).get('last_modified'),
+                immutable=immutable
+            )
+        
+        return payload
+    
     def get_stock_day_trading(self, stock_code: str, date: str = None) -> Optional[Dict]:
         """
         取得個股當日交易資訊
@@ -53,10 +249,7 @@ class TWSECollector:
         
         try:
             self.logger.info(f"正在抓取股票 {stock_code} 於 {date} 的交易資料...")
-            response = self.session.get(url, params=params, timeout=TIMEOUT)
-            response.raise_for_status()
-            
-            data = response.json()
+            data = self._fetch_json('STOCK_DAY', url, params, date, stock_code)
             if data.get('stat') == 'OK':
                 return data
             else:
@@ -81,13 +274,27 @@ class TWSECollector:
         Returns:
             券商分點資料 DataFrame
         """
+        _, df, _ = self.fetch_broker_trading(stock_code, date)
+        return df
+    
+    def fetch_broker_trading(self, stock_code: str, date: str = None) -> Tuple[str, Optional[pd.DataFrame], Optional[str]]:
+        """
+        取得券商分點進出明細，並區分查無資料與抓取失敗
+        
+        Args:
+            stock_code: 股票代碼
+            date: 日期 (YYYY-MM-DD)
+            
+        Returns:
+            (狀態 FETCH_OK / FETCH_EMPTY / FETCH_ERROR, DataFrame 或 None, 錯誤訊息)
+        """
         if not date:
             date = datetime.now().strftime('%Y%m%d')
         else:
             date = date.replace('-', '')
             
         # TWSE 的券商分點資料 API
-        url = "https://www.twse.com.tw/exchangeReport/BFIAMU"
+        url = f"{TWSE_WEB_BASE}/exchangeReport/BFIAMU"
         params = {
             'response': 'json',
             'date': date,
@@ -96,29 +303,23 @@ class TWSECollector:
         
         try:
             self.logger.info(f"正在抓取股票 {stock_code} 券商分點資料...")
-            time.sleep(REQUEST_DELAY)  # 避免請求過快
-            
-            response = self.session.get(url, params=params, timeout=TIMEOUT)
-            response.raise_for_status()
-            
-            data = response.json()
+            data = self._fetch_json('BFIAMU', url, params, date, stock_code)
             
             if data.get('stat') == 'OK' and 'data' in data:
-                # 轉換為 DataFrame
-                df = pd.DataFrame(data['data'], columns=data.get('fields', []))
-                df['date'] = date
-                df['stock_code'] = stock_code
-                return df
+                # 直接解析為型別化的 DataFrame
+                with get_metrics().timer('collector.parse_rows'):
+                    df = parse_broker_rows(data.get('fields', []), data['data'], date, stock_code)
+                return FETCH_OK, df, None
             else:
                 self.logger.warning(f"無券商資料: {stock_code} - {date}")
-                return None
+                return FETCH_EMPTY, None, None
                 
         except requests.exceptions.RequestException as e:
             self.logger.error(f"請求失敗: {e}")
-            return None
+            return FETCH_ERROR, None, str(e)
         except Exception as e:
             self.logger.error(f"資料處理失敗: {e}")
-            return None
+            return FETCH_ERROR, None, str(e)
     
     def get_institutional_trading(self, date: str = None) -> Optional[pd.DataFrame]:
         """
@@ -143,10 +344,7 @@ class TWSECollector:
         
         try:
             self.logger.info(f"正在抓取三大法人買賣超資料 {date}...")
-            response = self.session.get(url, params=params, timeout=TIMEOUT)
-            response.raise_for_status()
-            
-            data = response.json()
+            data = self._fetch_json('BFI82U', url, params, date)
             if data.get('stat') == 'OK' and 'data' in data:
                 df = pd.DataFrame(data['data'], columns=data.get('fields', []))
                 df['date'] = date
@@ -159,7 +357,191 @@ class TWSECollector:
             self.logger.error(f"取得三大法人資料失敗: {e}")
             return None
     
-    def collect_batch_data(self, stock_codes: List[str], start_date: str, end_date: str) -> Dict[str, pd.DataFrame]:
+    def fetch_twse_daily_quotes(self, date: str = None) -> Tuple[str, Optional[pd.DataFrame], Optional[str]]:
+        """
+        取得上市股票當日全市場行情 (一次請求)
+        
+        Args:
+            date: 日期 (YYYY-MM-DD)
+            
+        Returns:
+            (狀態, 欄位為 QUOTE_COLUMNS 的 DataFrame 或 None, 錯誤訊息)
+        """
+        if not date:
+            date = datetime.now().strftime('%Y%m%d')
+        else:
+            date = date.replace('-', '')
+        
+        url = f"{TWSE_WEB_BASE}/rwd/zh/afterTrading/STOCK_DAY_ALL"
+        params = {
+            'response': 'json',
+            'date': date
+        }
+        
+        try:
+            self.logger.info(f"正在抓取上市股票 {date} 全市場行情...")
+            data = self._fetch_json('STOCK_DAY_ALL', url, params, date)
+            
+            if data.get('stat') == 'OK' and data.get('data'):
+                with get_metrics().timer('collector.parse_rows'):
+                    raw = pd.DataFrame(data['data'], columns=data.get('fields', []))
+                    quotes = _normalize_quotes(raw, TWSE_QUOTE_FIELDS, MARKET_TWSE, date)
+                return FETCH_OK, quotes, None
+            else:
+                self.logger.warning(f"無上市行情資料: {date}")
+                return FETCH_EMPTY, None, None
+                
+        except requests.exceptions.RequestException as e:
+            self.logger.error(f"請求失敗: {e}")
+            return FETCH_ERROR, None, str(e)
+        except Exception as e:
+            self.logger.error(f"資料處理失敗: {e}")
+            return FETCH_ERROR, None, str(e)
+    
+    def fetch_tpex_daily_quotes(self, date: str = None) -> Tuple[str, Optional[pd.DataFrame], Optional[str]]:
+        """
+        取得上櫃股票全市場收盤行情 (一次請求)
+        
+        櫃買中心 OpenAPI 只提供最近一個交易日，回應日期與指定日期不同時視為查無資料。
+        
+        Args:
+            date: 日期 (YYYY-MM-DD)
+            
+        Returns:
+            (狀態, 欄位為 QUOTE_COLUMNS 的 DataFrame 或 None, 錯誤訊息)
+        """
+        if not date:
+            date = datetime.now().strftime('%Y%m%d')
+        else:
+            date = date.replace('-', '')
+        
+        url = f"{TPEX_API_BASE}/tpex_mainboard_daily_close_quotes"
+        
+        try:
+            self.logger.info(f"正在抓取上櫃股票 {date} 全市場行情...")
+            data = self._fetch_json('TPEX_QUOTES', url, {}, date)
+            
+            raw = pd.DataFrame(data if isinstance(data, list) else [])
+            if not raw.empty and 'Date' in raw.columns:
+                # 日期為民國年 (如 1130102)
+                roc_dates = raw['Date'].astype(str).str.strip()
+                raw = raw[(roc_dates.str[:-4].astype(int) + 1911).astype(str) + roc_dates.str[-4:] == date]
+            
+            if raw.empty:
+                self.logger.warning(f"無上櫃行情資料: {date} (OpenAPI 僅提供最近交易日)")
+                return FETCH_EMPTY, None, None
+            
+            with get_metrics().timer('collector.parse_rows'):
+                quotes = _normalize_quotes(raw, TPEX_QUOTE_FIELDS, MARKET_TPEX, date)
+            return FETCH_OK, quotes, None
+                
+        except requests.exceptions.RequestException as e:
+            self.logger.error(f"請求失敗: {e}")
+            return FETCH_ERROR, None, str(e)
+        except Exception as e:
+            self.logger.error(f"資料處理失敗: {e}")
+            return FETCH_ERROR, None, str(e)
+    
+    def get_market_snapshot(self, date: str = None) -> Dict[str, Tuple[str, Optional[pd.DataFrame], Optional[str]]]:
+        """
+        取得上市、上櫃的全市場每日行情 (每個市場一次請求)
+        
+        Args:
+            date: 日期 (YYYY-MM-DD)
+            
+        Returns:
+            {MARKET_TWSE / MARKET_TPEX: (狀態, 行情 DataFrame 或 None, 錯誤訊息)}
+        """
+        return {
+            MARKET_TWSE: self.fetch_twse_daily_quotes(date),
+            MARKET_TPEX: self.fetch_tpex_daily_quotes(date),
+        }
+    
+    def market_broker_codes(self, quotes: pd.DataFrame) -> List[str]:
+        """
+        由上市行情挑出需要逐檔抓取券商分點的股票
+        
+        券商分點資料沒有全市場端點，只對當日有成交且代碼符合 MARKET_STOCK_PATTERN 的股票發出請求。
+        
+        Args:
+            quotes: fetch_twse_daily_quotes 的行情
+            
+        Returns:
+            股票代碼列表
+        """
+        if quotes is None or quotes.empty:
+            return []
+        
+        pattern = re.compile(MARKET_STOCK_PATTERN)
+        traded = quotes[(quotes['market'] == MARKET_TWSE) & (quotes['volume'] > 0)]
+        return [code for code in traded['stock_code'] if pattern.match(code)]
+    
+    def iter_broker_trading(self, tasks: List[Tuple[str, str]],
+                            max_workers: int = None) -> Iterator[Tuple[str, str, Optional[pd.DataFrame]]]:
+        """
+        並行抓取多組 (股票代碼, 日期) 的券商分點資料
+        
+        以有限的執行緒池同時發出請求，總請求速率由共用的權杖桶控制，
+        每完成一筆就立即回傳，呼叫端可邊收邊存。
+        
+        Args:
+            tasks: (股票代碼, 日期 YYYY-MM-DD) 列表
+            max_workers: 並行工作數，預設為 MAX_WORKERS
+            
+        Yields:
+            (股票代碼, 日期, DataFrame 或 None)
+        """
+        for stock_code, date, _, df, _ in self.iter_broker_trading_status(tasks, max_workers):
+            yield stock_code, date, df
+    
+    def iter_broker_trading_status(self, tasks: List[Tuple[str, str]], max_workers: int = None
+                                   ) -> Iterator[Tuple[str, str, str, Optional[pd.DataFrame], Optional[str]]]:
+        """
+        並行抓取券商分點資料，並回傳每筆的抓取狀態 (供回補記錄進度)
+        
+        Args:
+            tasks: (股票代碼, 日期 YYYY-MM-DD) 列表
+            max_workers: 並行工作數，預設為 MAX_WORKERS
+            
+        Yields:
+            (股票代碼, 日期, 狀態, DataFrame 或 None, 錯誤訊息)
+        """
+        if not tasks:
+            return
+        
+        workers = max(1, min(max_workers or self.max_workers, len(tasks)))
+        
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='twse') as executor:
+            futures = {
+                executor.submit(self.fetch_broker_trading, stock_code, date): (stock_code, date)
+                for stock_code, date in tasks
+            }
+            
+            for future in as_completed(futures):
+                stock_code, date = futures[future]
+                try:
+                    status, df, error = future.result()
+                except Exception as e:
+                    self.logger.error(f"抓取 {stock_code} - {date} 失敗: {e}")
+                    status, df, error = FETCH_ERROR, None, str(e)
+                yield stock_code, date, status, df, error
+    
+    def trading_dates(self, start_date: str, end_date: str) -> List[str]:
+        """
+        列出區間內需要抓取的日期 (交易日)
+        
+        Args:
+            start_date: 開始日期 (YYYY-MM-DD)
+            end_date: 結束日期 (YYYY-MM-DD)
+            
+        Returns:
+            日期列表 (YYYY-MM-DD，遞增)
+        """
+        # 跳過週末與休市日
+        return self.calendar.trading_days(start_date, end_date)
+    
+    def collect_batch_data(self, stock_codes: List[str], start_date: str, end_date: str,
+                           max_workers: int = None) -> Dict[str, pd.DataFrame]:
         """
         批量收集多檔股票的資料
         
@@ -167,34 +549,28 @@ class TWSECollector:
             stock_codes: 股票代碼列表
             start_date: 開始日期 (YYYY-MM-DD)
             end_date: 結束日期 (YYYY-MM-DD)
+            max_workers: 並行工作數，預設為 MAX_WORKERS
             
         Returns:
             {stock_code: DataFrame} 的字典
         """
-        results = {}
+        # 建立所有要抓取的 (股票, 日期) 組合
+        dates = self.trading_dates(start_date, end_date)
         
-        start_dt = datetime.strptime(start_date, '%Y-%m-%d')
-        end_dt = datetime.strptime(end_date, '%Y-%m-%d')
+        tasks = [(stock_code, date_str) for stock_code in stock_codes for date_str in dates]
+        self.logger.info(f"開始並行收集 {len(stock_codes)} 檔股票、{len(dates)} 個交易日的資料...")
         
-        for stock_code in stock_codes:
-            self.logger.info(f"開始收集股票 {stock_code} 的資料...")
-            stock_data = []
-            
-            current_date = start_dt
-            while current_date <= end_dt:
-                date_str = current_date.strftime('%Y-%m-%d')
-                
-                # 跳過週末
-                if current_date.weekday() < 5:  # Monday is 0, Sunday is 6
-                    broker_data = self.get_broker_trading_detail(stock_code, date_str)
-                    if broker_data is not None and not broker_data.empty:
-                        stock_data.append(broker_data)
-                
-                current_date += timedelta(days=1)
-                time.sleep(REQUEST_DELAY)  # 控制請求頻率
-            
+        collected: Dict[str, List[Tuple[str, pd.DataFrame]]] = {stock_code: [] for stock_code in stock_codes}
+        for stock_code, date_str, broker_data in self.iter_broker_trading(tasks, max_workers):
+            if broker_data is not None and not broker_data.empty:
+                collected[stock_code].append((date_str, broker_data))
+        
+        results = {}
+        for stock_code, stock_data in collected.items():
             if stock_data:
-                results[stock_code] = pd.concat(stock_data, ignore_index=True)
+                # 完成順序不固定，依日期排序後再合併
+                stock_data.sort(key=lambda item: item[0])
+                results[stock_code] = pd.concat([df for _, df in stock_data], ignore_index=True)
                 self.logger.info(f"股票 {stock_code} 收集完成，共 {len(results[stock_code])} 筆資料")
             else:
                 self.logger.warning(f"股票 {stock_code} 無資料")
@@ -2,28 +2,558 @@
 資料庫操作工具
 用於儲存和查詢籌碼分析資料
 """
+import math
 import sqlite3
+import numpy as np
 import pandas as pd
 import logging
+import re
+import threading
+from contextlib import contextmanager
 from pathlib import Path
 import sys
 import os
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Iterator, Tuple
 
 # 添加專案根目錄到路徑
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
 from config import *
+from src.utils.metrics import get_metrics, timed
+
+# DataFrame 欄位 → broker_trading 欄位
+BROKER_TEXT_COLUMNS = [
+    ('date', 'date'),
+    ('stock_code', 'stock_code'),
+    ('券商', 'broker_code'),
+    ('分點', 'branch_name'),
+]
+BROKER_NUMERIC_COLUMNS = [
+    ('買進股數', 'buy_volume'),
+    ('賣出股數', 'sell_volume'),
+    ('買進金額', 'buy_amount'),
+    ('賣出金額', 'sell_amount'),
+]
+BROKER_INSERT_COLUMNS = [column for _, column in BROKER_TEXT_COLUMNS + BROKER_NUMERIC_COLUMNS]
+
+# 全市場每日行情欄位 (與 TWSECollector 的 QUOTE_COLUMNS 相同)
+QUOTE_INSERT_COLUMNS = ['date', 'stock_code', 'stock_name', 'market', 'open', 'high', 'low', 'close',
+                        'change', 'volume', 'amount', 'transactions']
+
+# 資料庫結構版本 (PRAGMA user_version)，結構變更時遞增
+SCHEMA_VERSION = 9
+# 最後一次新增衍生統計表的版本，由更舊版本升級時需由 broker_trading 重建
+DERIVED_SCHEMA_VERSION = 8
+
+# 本行程內已完成初始化的資料庫路徑
+_initialized_paths = set()
+_schema_lock = threading.Lock()
+
+# 重算 affected_days 的每日摘要 (參數: 標準差倍數的平方)
+DAILY_SUMMARY_REFRESH_SQL = '''
+    INSERT OR REPLACE INTO daily_summary
+    (date, stock_code, total_volume, total_amount, broker_count, branch_count,
+     top_buyer_broker, top_seller_broker, unusual_activity_count)
+    WITH day_rows AS (
+        SELECT b.date, b.stock_code, b.broker_code, b.buy_volume, b.sell_volume,
+               b.buy_amount, b.sell_amount,
+               b.buy_volume - b.sell_volume AS net_volume,
+               b.buy_amount - b.sell_amount AS net_amount
+        FROM affected_days k
+        CROSS JOIN broker_trading b ON b.date = k.date AND b.stock_code = k.stock_code
+    ),
+    stats AS (
+        SELECT date, stock_code,
+               SUM(buy_volume + sell_volume) AS total_volume,
+               SUM(buy_amount + sell_amount) AS total_amount,
+               COUNT(DISTINCT broker_code) AS broker_count,
+               COUNT(*) AS branch_count,
+               AVG(net_volume) AS mean_net,
+               SUM(CAST(net_volume AS REAL) * net_volume) AS sum_sq
+        FROM day_rows
+        GROUP BY date, stock_code
+    ),
+    brokers AS (
+        SELECT date, stock_code, broker_code, SUM(net_amount) AS net_amount
+        FROM day_rows
+        GROUP BY date, stock_code, broker_code
+    ),
+    ranked AS (
+        SELECT date, stock_code, broker_code, net_amount,
+               ROW_NUMBER() OVER (PARTITION BY date, stock_code
+                                  ORDER BY net_amount DESC, broker_code) AS buy_rank,
+               ROW_NUMBER() OVER (PARTITION BY date, stock_code
+                                  ORDER BY net_amount ASC, broker_code) AS sell_rank
+        FROM brokers
+    ),
+    unusual AS (
+        -- (x - mean)^2 > k^2 * 樣本變異數，等同 |x - mean| > k * std
+        SELECT r.date, r.stock_code,
+               SUM(CASE WHEN s.branch_count > 1
+                         AND (r.net_volume - s.mean_net) * (r.net_volume - s.mean_net)
+                             > ? * (s.sum_sq - s.branch_count * s.mean_net * s.mean_net)
+                                 / (s.branch_count - 1)
+                        THEN 1 ELSE 0 END) AS unusual_count
+        FROM day_rows r
+        JOIN stats s ON s.date = r.date AND s.stock_code = r.stock_code
+        GROUP BY r.date, r.stock_code
+    )
+    SELECT s.date, s.stock_code, s.total_volume, s.total_amount,
+           s.broker_count, s.branch_count,
+           (SELECT broker_code FROM ranked b
+             WHERE b.date = s.date AND b.stock_code = s.stock_code
+               AND b.buy_rank = 1 AND b.net_amount > 0),
+           (SELECT broker_code FROM ranked b
+             WHERE b.date = s.date AND b.stock_code = s.stock_code
+               AND b.sell_rank = 1 AND b.net_amount < 0),
+           u.unusual_count
+    FROM stats s
+    JOIN unusual u ON u.date = s.date AND u.stock_code = s.stock_code
+'''
+
+# 重建時 broker_trading 已整日刪除的 (日期, 股票) 不會產生新摘要，需刪除舊的每日摘要
+DAILY_SUMMARY_STALE_DELETE_SQL = '''
+    DELETE FROM daily_summary
+    WHERE (date, stock_code) IN (
+        SELECT k.date, k.stock_code FROM affected_days k
+        WHERE NOT EXISTS (
+            SELECT 1 FROM broker_trading b WHERE b.date = k.date AND b.stock_code = k.stock_code
+        )
+    )
+'''
+
+# 將 affected_days 的個股彙總加到 (sign='+') 或扣出 (sign='-') 全市場彙總
+BROKER_ROLLUP_APPLY_SQL = '''
+    INSERT INTO broker_daily_rollup
+    (date, broker_code, buy_volume, sell_volume, buy_amount, sell_amount, row_count)
+    SELECT r.date, r.broker_code,
+           {sign} SUM(r.buy_volume), {sign} SUM(r.sell_volume),
+           {sign} SUM(r.buy_amount), {sign} SUM(r.sell_amount),
+           {sign} SUM(r.row_count)
+    FROM affected_days k
+    CROSS JOIN broker_stock_daily_rollup r ON r.stock_code = k.stock_code AND r.date = k.date
+    WHERE 1
+    GROUP BY r.date, r.broker_code
+    ON CONFLICT (date, broker_code) DO UPDATE SET
+        buy_volume = buy_volume + excluded.buy_volume,
+        sell_volume = sell_volume + excluded.sell_volume,
+        buy_amount = buy_amount + excluded.buy_amount,
+        sell_amount = sell_amount + excluded.sell_amount,
+        row_count = row_count + excluded.row_count
+'''
+
+# 重算 affected_days 的個股彙總
+STOCK_ROLLUP_DELETE_SQL = '''
+    DELETE FROM broker_stock_daily_rollup
+    WHERE (stock_code, date) IN (SELECT stock_code, date FROM affected_days)
+'''
+
+STOCK_ROLLUP_INSERT_SQL = '''
+    INSERT INTO broker_stock_daily_rollup
+    (stock_code, date, broker_code, buy_volume, sell_volume, buy_amount, sell_amount, row_count)
+    SELECT b.stock_code, b.date, b.broker_code,
+           SUM(b.buy_volume), SUM(b.sell_volume), SUM(b.buy_amount), SUM(b.sell_amount),
+           COUNT(*)
+    FROM affected_days k
+    CROSS JOIN broker_trading b ON b.date = k.date AND b.stock_code = k.stock_code
+    GROUP BY b.stock_code, b.date, b.broker_code
+'''
+
+# 移除已無資料的全市場彙總列
+BROKER_ROLLUP_PRUNE_SQL = '''
+    DELETE FROM broker_daily_rollup
+    WHERE row_count <= 0 AND date IN (SELECT date FROM affected_days)
+'''
+
+# 記錄 affected_days 有交易的分點
+BRANCH_PRESENCE_INSERT_SQL = '''
+    INSERT OR IGNORE INTO broker_branch_daily (date, broker_code, branch_name)
+    SELECT DISTINCT b.date, b.broker_code, b.branch_name
+    FROM affected_days k
+    CROSS JOIN broker_trading b ON b.date = k.date AND b.stock_code = k.stock_code
+'''
+
+# 分點異常基準: 以 baseline_step 的 (日期, 股票) 當日交易，對照前一日為止的基準評分
+# (參數: 最少累積天數、標準差倍數的平方)
+BASELINE_SCORE_SQL = '''
+    INSERT INTO unusual_trading
+    (date, stock_code, broker_code, branch_name, net_volume, net_amount, anomaly_score, anomaly_type)
+    SELECT b.date, b.stock_code, b.broker_code, b.branch_name,
+           b.buy_volume - b.sell_volume, b.buy_amount - b.sell_amount,
+           ABS(b.buy_volume - b.sell_volume - s.ewm_mean) / sqrt(s.ewm_var),
+           CASE WHEN b.buy_volume - b.sell_volume > s.ewm_mean THEN '異常買超' ELSE '異常賣超' END
+    FROM baseline_step k
+    CROSS JOIN broker_trading b ON b.date = k.date AND b.stock_code = k.stock_code
+    JOIN branch_baseline s
+      ON s.stock_code = b.stock_code AND s.broker_code = b.broker_code AND s.branch_name = b.branch_name
+    WHERE s.observations >= ? AND s.ewm_var > 0
+      AND (b.buy_volume - b.sell_volume - s.ewm_mean) * (b.buy_volume - b.sell_volume - s.ewm_mean)
+          > ? * s.ewm_var
+'''
+
+# 以當日淨買賣股數更新指數加權平均與變異數，並保留更新前的狀態供同日重新寫入時還原
+# (參數 ?1: 平滑係數 alpha = 2 / (跨度 + 1))
+BASELINE_UPDATE_SQL = '''
+    INSERT INTO branch_baseline
+    (stock_code, broker_code, branch_name, ewm_mean, ewm_var, observations, last_date)
+    SELECT b.stock_code, b.broker_code, b.branch_name, b.buy_volume - b.sell_volume, 0.0, 1, b.date
+    FROM baseline_step k
+    CROSS JOIN broker_trading b ON b.date = k.date AND b.stock_code = k.stock_code
+    WHERE 1
+    ON CONFLICT (stock_code, broker_code, branch_name) DO UPDATE SET
+        prev_mean = ewm_mean,
+        prev_var = ewm_var,
+        prev_date = last_date,
+        ewm_mean = ewm_mean + ?1 * (excluded.ewm_mean - ewm_mean),
+        ewm_var = (1 - ?1) * (ewm_var + ?1 * (excluded.ewm_mean - ewm_mean) * (excluded.ewm_mean - ewm_mean)),
+        observations = observations + 1,
+        last_date = excluded.last_date
+'''
+
+# 同一日重新寫入: 還原 baseline_step 當日的基準更新與評分 (參數: 當日日期)
+BASELINE_ROLLBACK_NEW_SQL = '''
+    DELETE FROM branch_baseline
+    WHERE stock_code IN (SELECT stock_code FROM baseline_step)
+      AND last_date = ? AND observations = 1
+'''
+
+BASELINE_ROLLBACK_SQL = '''
+    UPDATE branch_baseline
+    SET ewm_mean = prev_mean, ewm_var = prev_var, last_date = prev_date,
+        observations = observations - 1
+    WHERE stock_code IN (SELECT stock_code FROM baseline_step)
+      AND last_date = ?
+'''
+
+BASELINE_UNUSUAL_DELETE_SQL = '''
+    DELETE FROM unusual_trading
+    WHERE date = ? AND stock_code IN (SELECT stock_code FROM baseline_step)
+'''
+
+BASELINE_PROGRESS_SQL = '''
+    INSERT INTO baseline_progress (stock_code, last_date)
+    SELECT stock_code, date FROM baseline_step
+    WHERE 1
+    ON CONFLICT (stock_code) DO UPDATE SET last_date = excluded.last_date
+'''
+
+# 寫入早於基準最後日期的資料時，該股票的基準需依日期順序重播
+BASELINE_REPLAY_STOCKS_SQL = '''
+    SELECT DISTINCT k.stock_code
+    FROM affected_days k
+    JOIN baseline_progress p ON p.stock_code = k.stock_code
+    WHERE k.date < p.last_date
+'''
+
+# 分點持股成本 (平均成本法): 以 baseline_step 當日交易更新部位、成本與已實現損益，與分點基準同步逐日處理
+# 當日買賣相抵的部分以當日賣出均價 - 買進均價實現損益；淨買賣股數以買進 (或賣出) 均價計入部位，
+# 與原部位同向時加碼，反向時先以平均成本沖銷 (超過原部位的部分以當日均價反向建立新部位)。
+# 部位與成本皆帶正負號 (空方部位為負)，平均成本 = 成本 / 部位
+COST_BASIS_UPDATE_SQL = '''
+    INSERT INTO branch_cost_basis
+    (stock_code, broker_code, branch_name, position, cost_basis, realized_pnl, trading_days, last_date)
+    SELECT stock_code, broker_code, branch_name, net_volume, net_cost, intraday_pnl, 1, date
+    FROM (
+        SELECT b.stock_code, b.broker_code, b.branch_name, b.date,
+               b.buy_volume - b.sell_volume AS net_volume,
+               CASE WHEN b.buy_volume > b.sell_volume
+                        THEN (b.buy_volume - b.sell_volume) * CAST(b.buy_amount AS REAL) / b.buy_volume
+                    WHEN b.buy_volume < b.sell_volume
+                        THEN (b.buy_volume - b.sell_volume) * CAST(b.sell_amount AS REAL) / b.sell_volume
+                    ELSE 0.0 END AS net_cost,
+               CASE WHEN b.buy_volume > 0 AND b.sell_volume > 0
+                        THEN MIN(b.buy_volume, b.sell_volume)
+                             * (CAST(b.sell_amount AS REAL) / b.sell_volume - CAST(b.buy_amount AS REAL) / b.buy_volume)
+                    ELSE 0.0 END AS intraday_pnl
+        FROM baseline_step k
+        CROSS JOIN broker_trading b ON b.date = k.date AND b.stock_code = k.stock_code
+        WHERE k.stock_code NOT IN (SELECT stock_code FROM cost_replay)
+           OR (b.stock_code, b.broker_code, b.branch_name) IN (
+               SELECT stock_code, broker_code, branch_name FROM cost_replay_branches)
+    )
+    WHERE 1
+    ON CONFLICT (stock_code, broker_code, branch_name) DO UPDATE SET
+        prev_position = position,
+        prev_cost = cost_basis,
+        prev_realized = realized_pnl,
+        prev_date = last_date,
+        position = position + excluded.position,
+        cost_basis = CASE
+            WHEN position * excluded.position >= 0 THEN cost_basis + excluded.cost_basis
+            WHEN ABS(excluded.position) <= ABS(position) THEN cost_basis * (position + excluded.position) / position
+            ELSE (position + excluded.position) * excluded.cost_basis / excluded.position END,
+        realized_pnl = realized_pnl + excluded.realized_pnl + CASE
+            WHEN position * excluded.position >= 0 THEN 0.0
+            WHEN ABS(excluded.position) <= ABS(position) THEN excluded.position * cost_basis / position - excluded.cost_basis
+            ELSE position * excluded.cost_basis / excluded.position - cost_basis END,
+        trading_days = trading_days + 1,
+        last_date = excluded.last_date
+'''
+
+# 同一日重新寫入: 還原 baseline_step 當日的持股成本更新 (參數: 當日日期)；重播中的股票不需還原
+COST_BASIS_ROLLBACK_NEW_SQL = '''
+    DELETE FROM branch_cost_basis
+    WHERE stock_code IN (SELECT stock_code FROM baseline_step EXCEPT SELECT stock_code FROM cost_replay)
+      AND last_date = ? AND trading_days = 1
+'''
+
+COST_BASIS_ROLLBACK_SQL = '''
+    UPDATE branch_cost_basis
+    SET position = prev_position, cost_basis = prev_cost, realized_pnl = prev_realized,
+        last_date = prev_date, trading_days = trading_days - 1
+    WHERE stock_code IN (SELECT stock_code FROM baseline_step EXCEPT SELECT stock_code FROM cost_replay)
+      AND last_date = ?
+'''
+
+# 寫入早於既有資料的日期時，平均成本只與分點自己的交易順序有關，cost_replay 股票中只重播
+# 在 affected_days 有交易的分點 (寫入只會新增或取代資料列，其餘分點的交易不變)
+COST_REPLAY_BRANCHES_SQL = '''
+    INSERT OR IGNORE INTO cost_replay_branches (stock_code, broker_code, branch_name)
+    SELECT DISTINCT b.stock_code, b.broker_code, b.branch_name
+    FROM cost_replay r
+    JOIN affected_days k ON k.stock_code = r.stock_code
+    CROSS JOIN broker_trading b ON b.date = k.date AND b.stock_code = k.stock_code
+'''
+
+# 重建時 broker_trading 的資料可能已被刪除: 最後更新日不早於最早受影響日期的分點也需重播
+COST_REPLAY_STALE_BRANCHES_SQL = '''
+    INSERT OR IGNORE INTO cost_replay_branches (stock_code, broker_code, branch_name)
+    SELECT c.stock_code, c.broker_code, c.branch_name
+    FROM cost_replay r
+    CROSS JOIN branch_cost_basis c ON c.stock_code = r.stock_code
+    WHERE c.last_date >= (SELECT MIN(date) FROM affected_days WHERE stock_code = r.stock_code)
+'''
+
+COST_REPLAY_DELETE_SQL = '''
+    DELETE FROM branch_cost_basis
+    WHERE (stock_code, broker_code, branch_name) IN (
+        SELECT stock_code, broker_code, branch_name FROM cost_replay_branches
+    )
+'''
+
+# 分點累積淨買賣 (前綴和): 以 cumulative_delta 記錄 affected_days 某一日 (參數 ?1) 各分點的
+# 新淨買賣與相對於原有紀錄的差額，先寫入新資料
+CUMULATIVE_DELTA_NEW_SQL = '''
+    INSERT INTO cumulative_delta
+    (stock_code, broker_code, branch_name, net_volume, net_amount, delta_volume, delta_amount, delta_days)
+    SELECT b.stock_code, b.broker_code, b.branch_name,
+           b.buy_volume - b.sell_volume, b.buy_amount - b.sell_amount,
+           b.buy_volume - b.sell_volume, b.buy_amount - b.sell_amount, 1
+    FROM affected_days k
+    CROSS JOIN broker_trading b ON b.date = k.date AND b.stock_code = k.stock_code
+    WHERE k.date = ?1
+'''
+
+# 再扣除當日原有的紀錄 (原有但已不再出現的分點 net_volume 保持 NULL)
+CUMULATIVE_DELTA_OLD_SQL = '''
+    INSERT INTO cumulative_delta
+    (stock_code, broker_code, branch_name, net_volume, net_amount, delta_volume, delta_amount, delta_days)
+    SELECT c.stock_code, c.broker_code, c.branch_name, NULL, NULL, -c.net_volume, -c.net_amount, -1
+    FROM branch_cumulative c
+    WHERE c.date = ?1 AND c.stock_code IN (SELECT stock_code FROM affected_days WHERE date = ?1)
+    ON CONFLICT (stock_code, broker_code, branch_name) DO UPDATE SET
+        delta_volume = delta_volume + excluded.delta_volume,
+        delta_amount = delta_amount + excluded.delta_amount,
+        delta_days = delta_days + excluded.delta_days
+'''
+
+CUMULATIVE_DELETE_SQL = '''
+    DELETE FROM branch_cumulative
+    WHERE date = ?1 AND stock_code IN (SELECT stock_code FROM affected_days WHERE date = ?1)
+'''
+
+# 當日的累積值 = 前一筆紀錄的累積值 + 當日淨買賣
+CUMULATIVE_INSERT_SQL = '''
+    INSERT INTO branch_cumulative
+    (stock_code, broker_code, branch_name, date, net_volume, net_amount,
+     cum_net_volume, cum_net_amount, cum_days)
+    SELECT d.stock_code, d.broker_code, d.branch_name, ?1, d.net_volume, d.net_amount,
+           d.net_volume + COALESCE(p.cum_net_volume, 0),
+           d.net_amount + COALESCE(p.cum_net_amount, 0),
+           1 + COALESCE(p.cum_days, 0)
+    FROM cumulative_delta d
+    LEFT JOIN branch_cumulative p
+      ON p.stock_code = d.stock_code AND p.broker_code = d.broker_code AND p.branch_name = d.branch_name
+     AND p.date = (
+        SELECT MAX(q.date) FROM branch_cumulative q
+        WHERE q.stock_code = d.stock_code AND q.broker_code = d.broker_code
+          AND q.branch_name = d.branch_name AND q.date < ?1
+     )
+    WHERE d.net_volume IS NOT NULL
+'''
+
+# 受影響的股票在該日之後是否已有紀錄 (依序寫入新的一天時沒有，可略過差額傳遞)
+CUMULATIVE_LATER_SQL = '''
+    SELECT EXISTS (
+        SELECT 1 FROM branch_cumulative
+        WHERE stock_code IN (SELECT stock_code FROM affected_days WHERE date = ?1) AND date > ?1
+    )
+'''
+
+# 寫入較早的日期 (或重新寫入) 時，將差額傳遞到同一分點之後的紀錄
+CUMULATIVE_SHIFT_SQL = '''
+    UPDATE branch_cumulative
+    SET (cum_net_volume, cum_net_amount, cum_days) = (
+        SELECT cum_net_volume + d.delta_volume, cum_net_amount + d.delta_amount, cum_days + d.delta_days
+        FROM cumulative_delta d
+        WHERE d.stock_code = branch_cumulative.stock_code AND d.broker_code = branch_cumulative.broker_code
+          AND d.branch_name = branch_cumulative.branch_name
+    )
+    WHERE (stock_code, broker_code, branch_name) IN (
+        SELECT stock_code, broker_code, branch_name FROM cumulative_delta
+        WHERE delta_volume != 0 OR delta_amount != 0 OR delta_days != 0
+    )
+      AND date > ?1
+'''
+
+# 區間累積: 區間內最後一筆的累積值 - 區間內第一筆之前的累積值
+# (參數: 股票、券商、分點、結束日期，股票、券商、分點、起始日期)
+CUMULATIVE_RANGE_SQL = '''
+    SELECT e.cum_net_volume - s.base_volume AS net_volume,
+           e.cum_net_amount - s.base_amount AS net_amount,
+           e.cum_days - s.base_days AS trading_days
+    FROM (
+        SELECT cum_net_volume, cum_net_amount, cum_days FROM branch_cumulative
+        WHERE stock_code = ? AND broker_code = ? AND branch_name = ? AND date <= ?
+        ORDER BY date DESC LIMIT 1
+    ) e,
+    (
+        SELECT cum_net_volume - net_volume AS base_volume,
+               cum_net_amount - net_amount AS base_amount,
+               cum_days - 1 AS base_days
+        FROM branch_cumulative
+        WHERE stock_code = ? AND broker_code = ? AND branch_name = ? AND date >= ?
+        ORDER BY date LIMIT 1
+    ) s
+'''
+
+# 分析用分點彙總: 欄位直接使用分析器 (ChipAnalyzer) 的中文欄位名稱，另含每個分點的筆數
+ANALYSIS_BRANCH_TOTALS_SQL = '''
+    SELECT broker_code AS "券商", branch_name AS "分點", COUNT(*) AS "筆數",
+           SUM(buy_volume) AS "買進股數", SUM(sell_volume) AS "賣出股數",
+           SUM(buy_amount) AS "買進金額", SUM(sell_amount) AS "賣出金額",
+           SUM(buy_volume - sell_volume) AS "淨買賣股數",
+           SUM(buy_amount - sell_amount) AS "淨買賣金額"
+    FROM broker_trading
+    {where_clause}
+    GROUP BY broker_code, branch_name
+    ORDER BY broker_code, branch_name
+'''
+
+# 淨買賣股數的離均差平方和 (?1 為平均，其餘為篩選條件)
+ANALYSIS_NET_M2_SQL = '''
+    SELECT COALESCE(SUM((buy_volume - sell_volume - ?1) * (buy_volume - sell_volume - ?1)), 0.0)
+    FROM broker_trading
+    {where_clause}
+'''
+
+# 分析器的券商彙總欄位 (分點為資料筆數) 與分點彙總欄位
+ANALYSIS_BROKER_COLUMNS = ['買進股數', '賣出股數', '買進金額', '賣出金額', '淨買賣股數', '淨買賣金額', '分點']
+ANALYSIS_BRANCH_COLUMNS = ['買進股數', '賣出股數', '淨買賣股數', '淨買賣金額']
+
+# get_branch_pnl 可排序的欄位
+BRANCH_PNL_ORDER_COLUMNS = ('unrealized_pnl', 'realized_pnl', 'position')
+
+# 查詢計畫稽核時不允許整表掃描的資料表
+AUDITED_TABLES = {
+    'broker_trading', 'daily_summary', 'unusual_trading',
+    'broker_daily_rollup', 'broker_stock_daily_rollup', 'broker_branch_daily',
+    'daily_quotes', 'branch_baseline', 'baseline_progress', 'branch_cumulative', 'branch_cost_basis',
+}
+
+def _full_scans(query: str, plan: List[str]) -> List[str]:
+    """從 EXPLAIN QUERY PLAN 的結果找出對稽核資料表的整表 (或整個索引) 掃描"""
+    # 查詢計畫只顯示別名，先由查詢文字建立 別名 → 資料表 對照
+    aliases = {table: table for table in AUDITED_TABLES}
+    for table, alias in re.findall(r'\b(?:FROM|JOIN)\s+(\w+)\s+(?:AS\s+)?(\w+)', query, re.IGNORECASE):
+        if table in AUDITED_TABLES:
+            aliases[alias] = table
+    
+    scans = []
+    for detail in plan:
+        match = re.match(r'SCAN (?:TABLE )?(\w+)', detail)
+        if match and match.group(1) in aliases:
+            scans.append(detail)
+    return scans
+
+def _text_column(df: pd.DataFrame, column: str) -> np.ndarray:
+    """取出文字欄位 (缺少時補空字串，categorical 欄位直接由代碼對應)"""
+    if column not in df.columns:
+        return np.full(len(df), '', dtype=object)
+    
+    values = df[column]
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        # 只轉換不重複的類別，空值 (代碼 -1) 對應到最後的空字串
+        categories = np.append(values.cat.categories.astype(str).to_numpy(dtype=object), '')
+        return categories[values.cat.codes.to_numpy()]
+    return values.fillna('').astype(str).to_numpy(dtype=object)
+
+def _numeric_column(df: pd.DataFrame, column: str) -> np.ndarray:
+    """取出數值欄位並轉為 int64 (去除千分位逗號，無法轉換視為 0)"""
+    if column not in df.columns:
+        return np.zeros(len(df), dtype=np.int64)
+    
+    values = df[column]
+    if not pd.api.types.is_numeric_dtype(values):
+        values = pd.to_numeric(values.astype(str).str.replace(',', '', regex=False), errors='coerce')
+    return values.fillna(0).to_numpy(dtype=np.int64)
+
+def _normalize_dates(dates: np.ndarray) -> np.ndarray:
+    """統一日期格式為 YYYY-MM-DD (API 回傳 YYYYMMDD)，只轉換不重複的日期值"""
+    codes, uniques = pd.factorize(dates)
+    normalized = pd.Series(uniques, dtype=object).str.replace(
+        r'^(\d{4})(\d{2})(\d{2})$', r'\1-\2-\3', regex=True
+    ).to_numpy(dtype=object)
+    return normalized[codes]
+
+def _analysis_aggregates(branches: pd.DataFrame) -> Dict:
+    """
+    由分點彙總 (含筆數) 整理出分析器需要的彙總，格式同 chip_analyzer.fused_aggregate
+    
+    Returns:
+        {'總記錄數': 筆數, '券商彙總': DataFrame, '分點彙總': DataFrame,
+         '淨買賣統計': (筆數, 平均, None)}，離均差平方和由呼叫端以平均另行計算
+    """
+    records = int(branches['筆數'].sum())
+    mean = float(branches['淨買賣股數'].sum()) / records if records else 0.0
+    
+    brokers = branches.drop(columns='分點').rename(columns={'筆數': '分點'})
+    brokers = brokers.groupby('券商', sort=True).sum().reset_index()
+    
+    return {
+        '總記錄數': records,
+        '券商彙總': brokers[['券商'] + ANALYSIS_BROKER_COLUMNS],
+        '分點彙總': branches[['券商', '分點'] + ANALYSIS_BRANCH_COLUMNS].reset_index(drop=True),
+        '淨買賣統計': (records, mean, None)
+    }
 
 class ChipDatabase:
     """籌碼分析資料庫管理器"""
     
-    def __init__(self, db_path: str = None):
+    def __init__(self, db_path: str = None, read_only: bool = False):
+        """
+        Args:
+            db_path: 資料庫路徑，預設為 DB_PATH
+            read_only: 以唯讀模式開啟 (供平行分析的子行程使用，不建立或升級資料表)
+        """
         if db_path is None:
             db_path = PROJECT_ROOT / DB_PATH
         
         self.db_path = Path(db_path)
+        self.read_only = read_only
         self.logger = logging.getLogger(__name__)
         
+        # 每個執行緒各自持有一條長期連線
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        
+        # deferred_refresh 區塊內寫入時不重算衍生表 (可巢狀)
+        self._defer_depth = 0
+        
+        # 唯讀連線只讀取既有資料庫
+        if read_only:
+            return
+        
         # 確保資料庫目錄存在
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
         
@@ -31,17 +561,100 @@ class ChipDatabase:
         self.init_database()
     
     def get_connection(self) -> sqlite3.Connection:
-        """取得資料庫連線"""
-        conn = sqlite3.connect(self.db_path)
+        """
+        取得目前執行緒的資料庫連線
+        
+        連線在第一次使用時建立並重複使用，開啟 WAL 讓寫入與讀取可以同時進行，
+        並保留 sqlite3 的 prepared statement 快取。
+        """
+        conn = getattr(self._local, 'conn', None)
+        
+        # fork 出來的子行程不可沿用父行程的連線
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        
+        # 連線只由建立它的執行緒使用；不檢查執行緒是為了讓 close() 能由任一執行緒關閉所有連線
+        if self.read_only:
+            conn = sqlite3.connect(
+                f"{self.db_path.resolve().as_uri()}?mode=ro",
+                uri=True,
+                timeout=DB_BUSY_TIMEOUT,
+                cached_statements=DB_STATEMENT_CACHE_SIZE,
+                check_same_thread=False
+            )
+        else:
+            conn = sqlite3.connect(
+                self.db_path,
+                timeout=DB_BUSY_TIMEOUT,
+                cached_statements=DB_STATEMENT_CACHE_SIZE,
+                check_same_thread=False
+            )
         conn.row_factory = sqlite3.Row  # 使結果可以用欄位名稱存取
+        # 部分 SQLite 編譯未啟用數學函式，異常程度的計算需要 sqrt
+        conn.create_function('sqrt', 1, math.sqrt, deterministic=True)
+        
+        # 日誌模式記錄在資料庫檔內，唯讀連線沿用既有的 WAL 設定
+        if not self.read_only:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute(f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}')
+        conn.execute(f'PRAGMA mmap_size={DB_MMAP_SIZE}')
+        
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        with self._connections_lock:
+            self._connections.append(conn)
+        
         return conn
     
+    def close(self):
+        """關閉所有執行緒的連線"""
+        with self._connections_lock:
+            for conn in self._connections:
+                try:
+                    conn.close()
+                except sqlite3.Error as e:
+                    self.logger.warning(f"關閉資料庫連線失敗: {e}")
+            self._connections.clear()
+        self._local = threading.local()
+    
     def init_database(self):
-        """初始化資料庫表格"""
+        """初始化資料庫表格 (結構已是最新版本時略過)"""
+        path_key = str(self.db_path.resolve())
+        
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
+            with _schema_lock:
+                if path_key in _initialized_paths:
+                    return
+                
+                conn = self.get_connection()
+                
+                version = conn.execute('PRAGMA user_version').fetchone()[0]
+                if version >= SCHEMA_VERSION:
+                    _initialized_paths.add(path_key)
+                    return
+                
+                self._create_schema(conn)
+                
+                # 既有資料庫升級後，由 broker_trading 補建衍生表
+                # (最初版本的資料庫沒有設定 user_version，第 0 版但已有資料時同樣需要重建)
+                if version < DERIVED_SCHEMA_VERSION and \
+                        conn.execute('SELECT 1 FROM broker_trading LIMIT 1').fetchone():
+                    self.logger.info(f"資料庫結構由第 {version} 版升級，重建衍生統計表...")
+                    self.rebuild_derived_tables()
+                
+                _initialized_paths.add(path_key)
+            
+            self.logger.info("資料庫初始化完成")
             
+        except sqlite3.Error as e:
+            self.logger.error(f"資料庫初始化失敗: {e}")
+    
+    def _create_schema(self, conn: sqlite3.Connection):
+        """建立 (或升級) 資料表與索引"""
+        with conn:
+            cursor = conn.cursor()
             # 券商分點交易表
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS broker_trading (
@@ -96,67 +709,418 @@ class ChipDatabase:
             ''')
             
             # 建立索引
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_broker_date_stock ON broker_trading(date, stock_code)')
+            # 依日期查詢使用 UNIQUE(date, stock_code, ...) 的自動索引，(date, stock_code) 索引已多餘
+            cursor.execute('DROP INDEX IF EXISTS idx_broker_date_stock')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_daily_date_stock ON daily_summary(date, stock_code)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_daily_stock_date ON daily_summary(stock_code, date)')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_unusual_date_stock ON unusual_trading(date, stock_code)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_unusual_stock_date ON unusual_trading(stock_code, date)')
             
-            conn.commit()
-            conn.close()
+            # 個股優先的涵蓋索引: 個股區間查詢 (含 date DESC, 淨買賣 DESC 排序) 不需回表也不需排序。
+            # 查詢淨買賣請用 buy_volume - sell_volume 運算式: 參照虛擬生成欄位時，
+            # SQLite 會視為用到整列所有欄位而無法使用涵蓋索引。
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_broker_stock_date ON broker_trading(
+                    stock_code, date, (buy_volume - sell_volume), broker_code, branch_name,
+                    buy_volume, sell_volume, buy_amount, sell_amount
+                )
+            ''')
             
-            self.logger.info("資料庫初始化完成")
+            # 券商 / 分點優先的涵蓋索引: 依券商或分點查詢跨股票的進出
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_broker_broker_branch ON broker_trading(
+                    broker_code, branch_name, date, stock_code,
+                    buy_volume, sell_volume, buy_amount, sell_amount
+                )
+            ''')
             
-        except sqlite3.Error as e:
-            self.logger.error(f"資料庫初始化失敗: {e}")
+            # 券商每日彙總 (全市場)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS broker_daily_rollup (
+                    date TEXT NOT NULL,
+                    broker_code TEXT NOT NULL,
+                    buy_volume INTEGER DEFAULT 0,
+                    sell_volume INTEGER DEFAULT 0,
+                    buy_amount INTEGER DEFAULT 0,
+                    sell_amount INTEGER DEFAULT 0,
+                    row_count INTEGER DEFAULT 0,
+                    PRIMARY KEY (date, broker_code)
+                ) WITHOUT ROWID
+            ''')
+            
+            # 券商每日個股彙總
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS broker_stock_daily_rollup (
+                    stock_code TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    broker_code TEXT NOT NULL,
+                    buy_volume INTEGER DEFAULT 0,
+                    sell_volume INTEGER DEFAULT 0,
+                    buy_amount INTEGER DEFAULT 0,
+                    sell_amount INTEGER DEFAULT 0,
+                    row_count INTEGER DEFAULT 0,
+                    PRIMARY KEY (stock_code, date, broker_code)
+                ) WITHOUT ROWID
+            ''')
+            
+            # 券商每日有交易的分點 (全市場，用於計算區間內不重複分點數)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS broker_branch_daily (
+                    date TEXT NOT NULL,
+                    broker_code TEXT NOT NULL,
+                    branch_name TEXT NOT NULL,
+                    PRIMARY KEY (date, broker_code, branch_name)
+                ) WITHOUT ROWID
+            ''')
+            
+            # 歷史回補進度 (每個股票、日期的抓取結果，中斷後由此接續)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS collection_progress (
+                    stock_code TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    row_count INTEGER DEFAULT 0,
+                    attempts INTEGER DEFAULT 1,
+                    error TEXT,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (stock_code, date)
+                ) WITHOUT ROWID
+            ''')
+            
+            # 全市場每日行情 (上市、上櫃)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS daily_quotes (
+                    date TEXT NOT NULL,
+                    stock_code TEXT NOT NULL,
+                    stock_name TEXT,
+                    market TEXT NOT NULL,
+                    open REAL,
+                    high REAL,
+                    low REAL,
+                    close REAL,
+                    change REAL,
+                    volume INTEGER DEFAULT 0,
+                    amount INTEGER DEFAULT 0,
+                    transactions INTEGER DEFAULT 0,
+                    PRIMARY KEY (date, stock_code)
+                ) WITHOUT ROWID
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_quotes_stock_date ON daily_quotes(stock_code, date)')
+            
+            # 分點異常基準 (各股票、分點淨買賣股數的指數加權平均與變異數，prev_* 為前一次更新前的狀態)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS branch_baseline (
+                    stock_code TEXT NOT NULL,
+                    broker_code TEXT NOT NULL,
+                    branch_name TEXT NOT NULL,
+                    ewm_mean REAL NOT NULL,
+                    ewm_var REAL NOT NULL,
+                    observations INTEGER NOT NULL,
+                    last_date TEXT NOT NULL,
+                    prev_mean REAL,
+                    prev_var REAL,
+                    prev_date TEXT,
+                    PRIMARY KEY (stock_code, broker_code, branch_name)
+                ) WITHOUT ROWID
+            ''')
+            
+            # 各股票的基準已更新到哪一天
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS baseline_progress (
+                    stock_code TEXT PRIMARY KEY,
+                    last_date TEXT NOT NULL
+                ) WITHOUT ROWID
+            ''')
+            
+            # 延後重算衍生表的 (日期, 股票): 回補期間累積，結束時 (或下一次寫入時) 一併重算
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS derived_pending (
+                    date TEXT NOT NULL,
+                    stock_code TEXT NOT NULL,
+                    PRIMARY KEY (date, stock_code)
+                ) WITHOUT ROWID
+            ''')
+            
+            # 分點累積淨買賣 (前綴和): 每個分點每個有交易的日子一列，任意區間的淨買賣只需查兩筆
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS branch_cumulative (
+                    stock_code TEXT NOT NULL,
+                    broker_code TEXT NOT NULL,
+                    branch_name TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    net_volume INTEGER NOT NULL,
+                    net_amount INTEGER NOT NULL,
+                    cum_net_volume INTEGER NOT NULL,
+                    cum_net_amount INTEGER NOT NULL,
+                    cum_days INTEGER NOT NULL,
+                    PRIMARY KEY (stock_code, broker_code, branch_name, date)
+                ) WITHOUT ROWID
+            ''')
+            # 寫入時依 (股票, 日期) 找出當日原有的紀錄 (涵蓋索引，不需回表)
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_cumulative_stock_date ON branch_cumulative(
+                    stock_code, date, net_volume, net_amount
+                )
+            ''')
+            
+            # 分點持股成本 (平均成本法的部位、成本與已實現損益，每個股票、分點一列；prev_* 為前一次更新前的狀態)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS branch_cost_basis (
+                    stock_code TEXT NOT NULL,
+                    broker_code TEXT NOT NULL,
+                    branch_name TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    cost_basis REAL NOT NULL,
+                    realized_pnl REAL NOT NULL,
+                    trading_days INTEGER NOT NULL,
+                    last_date TEXT NOT NULL,
+                    prev_position INTEGER,
+                    prev_cost REAL,
+                    prev_realized REAL,
+                    prev_date TEXT,
+                    PRIMARY KEY (stock_code, broker_code, branch_name)
+                ) WITHOUT ROWID
+            ''')
+            # 依分點查詢各股票的持股成本
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_cost_basis_branch ON branch_cost_basis(broker_code, branch_name)
+            ''')
+            
+            cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+    
+    def _ensure_temp_tables(self, conn: sqlite3.Connection):
+        """建立寫入流程使用的暫存表 (每條連線各自一份)"""
+        # 暫存表以唯一鍵去除同批重複資料 (後者覆蓋前者，與逐筆 REPLACE 相同)
+        conn.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS staging_broker_trading (
+                date TEXT NOT NULL,
+                stock_code TEXT NOT NULL,
+                broker_code TEXT NOT NULL,
+                branch_name TEXT NOT NULL,
+                buy_volume INTEGER,
+                sell_volume INTEGER,
+                buy_amount INTEGER,
+                sell_amount INTEGER,
+                PRIMARY KEY (date, stock_code, broker_code, branch_name)
+            )
+        ''')
+        
+        # 本次寫入影響的 (日期, 股票)，衍生表只重算這些範圍
+        conn.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS affected_days (
+                date TEXT NOT NULL,
+                stock_code TEXT NOT NULL,
+                PRIMARY KEY (date, stock_code)
+            )
+        ''')
+        
+        # 分點基準依日期逐日更新: 待處理的 (日期, 股票) 與目前處理的那一天
+        for table in ('baseline_days', 'baseline_step'):
+            conn.execute(f'''
+                CREATE TEMP TABLE IF NOT EXISTS {table} (
+                    date TEXT NOT NULL,
+                    stock_code TEXT NOT NULL,
+                    PRIMARY KEY (date, stock_code)
+                )
+            ''')
+        
+        # 持股成本重播中的股票與其中受影響的分點
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS cost_replay (stock_code TEXT PRIMARY KEY)')
+        conn.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS cost_replay_branches (
+                stock_code TEXT NOT NULL,
+                broker_code TEXT NOT NULL,
+                branch_name TEXT NOT NULL,
+                PRIMARY KEY (stock_code, broker_code, branch_name)
+            )
+        ''')
+        
+        # 分點累積淨買賣: 處理中那一天各分點的新淨買賣與差額
+        conn.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS cumulative_delta (
+                stock_code TEXT NOT NULL,
+                broker_code TEXT NOT NULL,
+                branch_name TEXT NOT NULL,
+                net_volume INTEGER,
+                net_amount INTEGER,
+                delta_volume INTEGER NOT NULL,
+                delta_amount INTEGER NOT NULL,
+                delta_days INTEGER NOT NULL,
+                PRIMARY KEY (stock_code, broker_code, branch_name)
+            )
+        ''')
     
-    def insert_broker_data(self, df: pd.DataFrame) -> int:
+    def insert_broker_data(self, df: pd.DataFrame, chunk_size: int = None) -> int:
         """
         插入券商分點資料
         
         Args:
             df: 包含券商分點資料的 DataFrame
+            chunk_size: 每批寫入筆數，預設為 DB_INSERT_CHUNK_SIZE
+            
+        Returns:
+            寫入的記錄數量 (新增 + 取代)
+        """
+        stats = self.bulk_insert_broker_data(df, chunk_size)
+        return stats['inserted'] + stats['replaced']
+    
+    @timed('db.insert.broker_data')
+    def bulk_insert_broker_data(self, df: pd.DataFrame, chunk_size: int = None) -> Dict[str, int]:
+        """
+        以欄位為單位批量寫入券商分點資料
+        
+        一次轉換整個 DataFrame 為型別化的 NumPy 欄位，分批寫入暫存表後，
+        在同一個交易內合併到 broker_trading。
+        
+        Args:
+            df: 包含券商分點資料的 DataFrame
+            chunk_size: 每批寫入筆數，預設為 DB_INSERT_CHUNK_SIZE
             
         Returns:
-            插入的記錄數量
+            {'inserted': 新增筆數, 'replaced': 取代既有資料筆數}
         """
+        stats = {'inserted': 0, 'replaced': 0}
+        if df is None or df.empty:
+            return stats
+        
+        chunk_size = chunk_size or DB_INSERT_CHUNK_SIZE
+        
         try:
+            # 一次轉換所有欄位
+            columns = [_text_column(df, source) for source, _ in BROKER_TEXT_COLUMNS]
+            columns[0] = _normalize_dates(columns[0])
+            columns += [_numeric_column(df, source) for source, _ in BROKER_NUMERIC_COLUMNS]
+            
             conn = self.get_connection()
             
-            # 準備資料
-            records = []
-            for _, row in df.iterrows():
-                record = (
-                    row.get('date', ''),
-                    row.get('stock_code', ''),
-                    row.get('券商', ''),
-                    row.get('分點', ''),
-                    int(row.get('買進股數', 0)),
-                    int(row.get('賣出股數', 0)),
-                    int(row.get('買進金額', 0)),
-                    int(row.get('賣出金額', 0))
-                )
-                records.append(record)
+            self._ensure_temp_tables(conn)
             
-            # 執行批量插入
-            cursor = conn.cursor()
-            cursor.executemany('''
-                INSERT OR REPLACE INTO broker_trading 
-                (date, stock_code, broker_code, branch_name, buy_volume, sell_volume, buy_amount, sell_amount)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', records)
+            column_list = ', '.join(BROKER_INSERT_COLUMNS)
+            placeholders = ', '.join('?' * len(BROKER_INSERT_COLUMNS))
             
-            inserted_count = cursor.rowcount
-            conn.commit()
-            conn.close()
+            with conn:
+                cursor = conn.cursor()
+                cursor.execute('DELETE FROM staging_broker_trading')
+                
+                for start in range(0, len(df), chunk_size):
+                    batch = [column[start:start + chunk_size].tolist() for column in columns]
+                    cursor.executemany(
+                        f'INSERT OR REPLACE INTO staging_broker_trading ({column_list}) VALUES ({placeholders})',
+                        zip(*batch)
+                    )
+                
+                # 計算實際新增 / 取代的筆數
+                total = cursor.execute('SELECT COUNT(*) FROM staging_broker_trading').fetchone()[0]
+                replaced = cursor.execute('''
+                    SELECT COUNT(*)
+                    FROM staging_broker_trading s
+                    JOIN broker_trading b
+                      ON b.date = s.date AND b.stock_code = s.stock_code
+                     AND b.broker_code = s.broker_code AND b.branch_name = s.branch_name
+                ''').fetchone()[0]
+                
+                cursor.execute(f'''
+                    INSERT OR REPLACE INTO broker_trading ({column_list})
+                    SELECT {column_list} FROM staging_broker_trading
+                ''')
+                
+                # 更新受影響 (日期, 股票) 的衍生統計表；延後重算時只記錄下來
+                target = 'derived_pending' if self._defer_depth else 'affected_days'
+                cursor.execute(f'''
+                    INSERT OR IGNORE INTO {target} (date, stock_code)
+                    SELECT DISTINCT date, stock_code FROM staging_broker_trading
+                ''')
+                if not self._defer_depth:
+                    self._refresh_derived_tables(cursor)
+                cursor.execute('DELETE FROM staging_broker_trading')
             
-            self.logger.info(f"成功插入 {inserted_count} 筆券商資料")
-            return inserted_count
+            stats['inserted'] = total - replaced
+            stats['replaced'] = replaced
+            get_metrics().increment('db.rows_written', total)
+            self.logger.info(f"成功寫入 {total} 筆券商資料 (新增 {stats['inserted']}，取代 {replaced})")
+            return stats
             
         except Exception as e:
             self.logger.error(f"插入券商資料失敗: {e}")
-            return 0
+            return stats
+    
+    def _broker_data_filters(self, stock_code: str = None, date: str = None,
+                             start_date: str = None, end_date: str = None,
+                             broker_code: str = None, branch_name: str = None,
+                             net_volume_band: Tuple[float, float] = None) -> tuple:
+        """
+        建立 broker_trading 查詢的 WHERE 子句 (where_clause, params)
+        
+        net_volume_band 為 (下限, 上限) 時只取淨買賣股數落在區間外的資料。
+        """
+        # 建立查詢條件
+        conditions = []
+        params = []
+        
+        if stock_code:
+            conditions.append("stock_code = ?")
+            params.append(stock_code)
+        
+        if broker_code:
+            conditions.append("broker_code = ?")
+            params.append(broker_code)
+            
+            if branch_name:
+                conditions.append("branch_name = ?")
+                params.append(branch_name)
+        
+        if date:
+            conditions.append("date = ?")
+            params.append(date)
+        elif start_date and end_date:
+            conditions.append("date BETWEEN ? AND ?")
+            params.extend([start_date, end_date])
+        elif start_date:
+            conditions.append("date >= ?")
+            params.append(start_date)
+        elif end_date:
+            conditions.append("date <= ?")
+            params.append(end_date)
+        
+        if net_volume_band is not None:
+            conditions.append("(buy_volume - sell_volume < ? OR buy_volume - sell_volume > ?)")
+            params.extend([float(net_volume_band[0]), float(net_volume_band[1])])
+        
+        where_clause = " WHERE " + " AND ".join(conditions) if conditions else ""
+        return where_clause, params
+    
+    def _build_broker_data_query(self, stock_code: str = None, date: str = None,
+                                 start_date: str = None, end_date: str = None,
+                                 broker_code: str = None, branch_name: str = None,
+                                 net_volume_band: Tuple[float, float] = None,
+                                 date_ascending: bool = False) -> tuple:
+        """
+        建立 get_broker_data / iter_broker_data 的查詢 (query, params)
+        
+        net_volume_band 為 (下限, 上限) 時只取淨買賣股數落在區間外的資料；
+        date_ascending 時只依日期遞增排序，供分段讀取使用。
+        """
+        where_clause, params = self._broker_data_filters(
+            stock_code, date, start_date, end_date, broker_code, branch_name, net_volume_band
+        )
+        order_clause = "date" if date_ascending else "date DESC, buy_volume - sell_volume DESC"
+        
+        # 淨買賣以運算式計算 (而非生成欄位)，才能使用涵蓋索引
+        query = f'''
+            SELECT date, stock_code, broker_code, branch_name,
+                   buy_volume, sell_volume, buy_amount, sell_amount,
+                   buy_volume - sell_volume AS net_volume,
+                   buy_amount - sell_amount AS net_amount
+            FROM broker_trading
+            {where_clause}
+            ORDER BY {order_clause}
+        '''
+        return query, params
     
+    @timed('db.query.get_broker_data')
     def get_broker_data(self, stock_code: str = None, date: str = None, 
-                       start_date: str = None, end_date: str = None) -> pd.DataFrame:
+                       start_date: str = None, end_date: str = None,
+                       broker_code: str = None, branch_name: str = None) -> pd.DataFrame:
         """
         查詢券商分點資料
         
@@ -165,6 +1129,8 @@ class ChipDatabase:
             date: 特定日期
             start_date: 起始日期
             end_date: 結束日期
+            broker_code: 券商代碼
+            branch_name: 分點名稱 (需同時指定券商代碼)
             
         Returns:
             券商分點資料 DataFrame
@@ -172,40 +1138,10 @@ class ChipDatabase:
         try:
             conn = self.get_connection()
             
-            # 建立查詢條件
-            conditions = []
-            params = []
-            
-            if stock_code:
-                conditions.append("stock_code = ?")
-                params.append(stock_code)
-            
-            if date:
-                conditions.append("date = ?")
-                params.append(date)
-            elif start_date and end_date:
-                conditions.append("date BETWEEN ? AND ?")
-                params.extend([start_date, end_date])
-            elif start_date:
-                conditions.append("date >= ?")
-                params.append(start_date)
-            elif end_date:
-                conditions.append("date <= ?")
-                params.append(end_date)
-            
-            where_clause = " WHERE " + " AND ".join(conditions) if conditions else ""
-            
-            query = f'''
-                SELECT date, stock_code, broker_code, branch_name,
-                       buy_volume, sell_volume, buy_amount, sell_amount,
-                       net_volume, net_amount
-                FROM broker_trading
-                {where_clause}
-                ORDER BY date DESC, net_volume DESC
-            '''
-            
+            query, params = self._build_broker_data_query(
+                stock_code, date, start_date, end_date, broker_code, branch_name
+            )
             df = pd.read_sql_query(query, conn, params=params)
-            conn.close()
             
             self.logger.info(f"查詢到 {len(df)} 筆券商資料")
             return df
@@ -214,88 +1150,773 @@ class ChipDatabase:
             self.logger.error(f"查詢券商資料失敗: {e}")
             return pd.DataFrame()
     
-    def insert_daily_summary(self, summary_data: Dict[str, Any]) -> bool:
-        """插入每日統計摘要"""
+    def iter_broker_data(self, stock_code: str = None, start_date: str = None,
+                         end_date: str = None, chunk_size: int = None,
+                         net_volume_band: Tuple[float, float] = None) -> Iterator[pd.DataFrame]:
+        """
+        依日期順序分段讀取券商分點資料，長區間分析時記憶體用量固定
+        
+        Args:
+            stock_code: 股票代碼
+            start_date: 起始日期
+            end_date: 結束日期
+            chunk_size: 每段筆數，預設為 ANALYSIS_CHUNK_SIZE
+            net_volume_band: (下限, 上限)，只讀取淨買賣股數落在區間外的資料
+            
+        Yields:
+            券商分點資料 DataFrame (欄位與 get_broker_data 相同)
+        """
+        chunk_size = chunk_size or ANALYSIS_CHUNK_SIZE
+        
         try:
             conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                INSERT OR REPLACE INTO daily_summary 
-                (date, stock_code, total_volume, total_amount, broker_count, branch_count,
-                 top_buyer_broker, top_seller_broker, unusual_activity_count)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                summary_data.get('date'),
-                summary_data.get('stock_code'),
-                summary_data.get('total_volume', 0),
-                summary_data.get('total_amount', 0),
-                summary_data.get('broker_count', 0),
-                summary_data.get('branch_count', 0),
-                summary_data.get('top_buyer_broker'),
-                summary_data.get('top_seller_broker'),
-                summary_data.get('unusual_activity_count', 0)
-            ))
-            
-            conn.commit()
-            conn.close()
-            
-            self.logger.info("每日摘要插入成功")
-            return True
             
+            query, params = self._build_broker_data_query(
+                stock_code, start_date=start_date, end_date=end_date,
+                net_volume_band=net_volume_band, date_ascending=True
+            )
+            for chunk in pd.read_sql_query(query, conn, params=params, chunksize=chunk_size):
+                yield chunk
+                
         except Exception as e:
-            self.logger.error(f"插入每日摘要失敗: {e}")
-            return False
+            self.logger.error(f"分段查詢券商資料失敗: {e}")
     
-    def get_top_brokers(self, stock_code: str = None, days: int = 30, limit: int = 20) -> pd.DataFrame:
+    @timed('db.query.get_analysis_aggregates')
+    def get_analysis_aggregates(self, stock_code: str = None, date: str = None,
+                                start_date: str = None, end_date: str = None) -> Dict:
         """
-        查詢熱門券商排行
+        在資料庫內完成券商、分點彙總與淨買賣股數統計，回傳分析器欄位格式的結果
+        
+        只傳回與券商、分點數量成正比的彙總表，不必把整個區間的原始資料讀進 pandas。
         
         Args:
             stock_code: 股票代碼
-            days: 查詢天數
-            limit: 回傳數量限制
+            date: 特定日期
+            start_date: 起始日期
+            end_date: 結束日期
             
         Returns:
-            券商排行 DataFrame
+            {'總記錄數': 筆數, '券商彙總': DataFrame, '分點彙總': DataFrame,
+             '淨買賣統計': (筆數, 平均, 離均差平方和)}，格式同 chip_analyzer.fused_aggregate；
+            查詢失敗時回傳空字典
         """
         try:
             conn = self.get_connection()
             
-            # 計算起始日期
-            from datetime import datetime, timedelta
-            end_date = datetime.now().strftime('%Y-%m-%d')
-            start_date = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
-            
-            conditions = ["date BETWEEN ? AND ?"]
-            params = [start_date, end_date]
+            where_clause, params = self._broker_data_filters(stock_code, date, start_date, end_date)
+            branches = pd.read_sql_query(
+                ANALYSIS_BRANCH_TOTALS_SQL.format(where_clause=where_clause), conn, params=params
+            )
+            aggregates = _analysis_aggregates(branches)
             
-            if stock_code:
-                conditions.append("stock_code = ?")
-                params.append(stock_code)
+            # 平均已由分點彙總得出，離均差平方和只需再掃描一次
+            count, mean, _ = aggregates['淨買賣統計']
+            m2 = 0.0
+            if count:
+                m2 = conn.execute(
+                    ANALYSIS_NET_M2_SQL.format(where_clause=where_clause), [mean] + params
+                ).fetchone()[0]
+            aggregates['淨買賣統計'] = (count, mean, float(m2))
             
-            where_clause = " WHERE " + " AND ".join(conditions)
+            self.logger.info(f"彙總 {count} 筆券商資料 ({len(branches)} 個分點)")
+            return aggregates
             
+        except Exception as e:
+            self.logger.error(f"彙總券商資料失敗: {e}")
+            return {}
+    
+    def _build_market_branch_totals_query(self, date: str = None, start_date: str = None,
+                                          end_date: str = None) -> tuple:
+        """建立 get_market_branch_totals 的查詢 (query, params)"""
+        where_clause, params = self._broker_data_filters(date=date, start_date=start_date, end_date=end_date)
+        
+        if date or (start_date and start_date == end_date):
+            # 單日每個 (股票, 分點) 只有一列，不需分組
             query = f'''
-                SELECT broker_code,
-                       SUM(buy_volume) as total_buy_volume,
-                       SUM(sell_volume) as total_sell_volume,
-                       SUM(buy_amount) as total_buy_amount,
-                       SUM(sell_amount) as total_sell_amount,
-                       SUM(net_volume) as total_net_volume,
-                       SUM(net_amount) as total_net_amount,
-                       COUNT(DISTINCT branch_name) as branch_count,
-                       COUNT(*) as trading_days
+                SELECT stock_code, buy_volume, buy_volume - sell_volume AS net_volume
                 FROM broker_trading
                 {where_clause}
-                GROUP BY broker_code
-                ORDER BY ABS(total_net_amount) DESC
-                LIMIT ?
             '''
-            
+        else:
+            query = f'''
+                SELECT stock_code, SUM(buy_volume) AS buy_volume,
+                       SUM(buy_volume - sell_volume) AS net_volume
+                FROM broker_trading
+                {where_clause}
+                GROUP BY stock_code, broker_code, branch_name
+            '''
+        return query, params
+    
+    @timed('db.query.get_market_branch_totals')
+    def get_market_branch_totals(self, date: str = None, start_date: str = None,
+                                 end_date: str = None) -> pd.DataFrame:
+        """
+        查詢全市場各 (股票, 分點) 在區間內的買進與淨買賣股數，供全市場篩選一次計算所有股票
+        
+        每個 (股票, 分點) 一列；篩選指標只依各分點的數值計算，不讀取分點鍵與金額欄位，
+        全市場單日上百萬列時可減少近半的讀取時間。
+        
+        Args:
+            date: 特定日期
+            start_date: 起始日期
+            end_date: 結束日期
+            
+        Returns:
+            DataFrame (stock_code, buy_volume, net_volume)
+        """
+        try:
+            conn = self.get_connection()
+            
+            query, params = self._build_market_branch_totals_query(date, start_date, end_date)
+            df = pd.read_sql_query(query, conn, params=params)
+            
+            self.logger.info(f"查詢到 {len(df)} 筆全市場分點合計")
+            return df
+        
+        except Exception as e:
+            self.logger.error(f"查詢全市場分點合計失敗: {e}")
+            return pd.DataFrame()
+    
+    def insert_daily_summary(self, summary_data: Dict[str, Any]) -> bool:
+        """插入每日統計摘要"""
+        try:
+            conn = self.get_connection()
+            
+            with conn:
+                conn.execute('''
+                    INSERT OR REPLACE INTO daily_summary 
+                    (date, stock_code, total_volume, total_amount, broker_count, branch_count,
+                     top_buyer_broker, top_seller_broker, unusual_activity_count)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (
+                    summary_data.get('date'),
+                    summary_data.get('stock_code'),
+                    summary_data.get('total_volume', 0),
+                    summary_data.get('total_amount', 0),
+                    summary_data.get('broker_count', 0),
+                    summary_data.get('branch_count', 0),
+                    summary_data.get('top_buyer_broker'),
+                    summary_data.get('top_seller_broker'),
+                    summary_data.get('unusual_activity_count', 0)
+                ))
+            
+            self.logger.info("每日摘要插入成功")
+            return True
+            
+        except Exception as e:
+            self.logger.error(f"插入每日摘要失敗: {e}")
+            return False
+    
+    @timed('db.insert.daily_quotes')
+    def insert_daily_quotes(self, df: pd.DataFrame) -> int:
+        """
+        寫入全市場每日行情 (同一日期、股票以新資料取代)
+        
+        Args:
+            df: 欄位為 QUOTE_INSERT_COLUMNS 的行情 DataFrame
+            
+        Returns:
+            寫入筆數
+        """
+        if df is None or df.empty:
+            return 0
+        
+        try:
+            quotes = df[QUOTE_INSERT_COLUMNS].astype(object).where(df[QUOTE_INSERT_COLUMNS].notna(), None)
+            column_list = ', '.join(QUOTE_INSERT_COLUMNS)
+            placeholders = ', '.join('?' * len(QUOTE_INSERT_COLUMNS))
+            
+            conn = self.get_connection()
+            with conn:
+                conn.executemany(
+                    f'INSERT OR REPLACE INTO daily_quotes ({column_list}) VALUES ({placeholders})',
+                    quotes.itertuples(index=False, name=None)
+                )
+            
+            self.logger.info(f"成功寫入 {len(quotes)} 筆每日行情")
+            return len(quotes)
+            
+        except Exception as e:
+            self.logger.error(f"插入每日行情失敗: {e}")
+            return 0
+    
+    def _build_daily_quotes_query(self, date: str = None, stock_code: str = None,
+                                  start_date: str = None, end_date: str = None,
+                                  market: str = None) -> tuple:
+        """建立 get_daily_quotes 的查詢 (query, params)"""
+        conditions = []
+        params = []
+        
+        if stock_code:
+            conditions.append("stock_code = ?")
+            params.append(stock_code)
+        
+        if date:
+            conditions.append("date = ?")
+            params.append(date)
+        else:
+            if start_date:
+                conditions.append("date >= ?")
+                params.append(start_date)
+            if end_date:
+                conditions.append("date <= ?")
+                params.append(end_date)
+        
+        if market:
+            conditions.append("market = ?")
+            params.append(market)
+        
+        where_clause = " WHERE " + " AND ".join(conditions) if conditions else ""
+        
+        query = f'''
+            SELECT {', '.join(QUOTE_INSERT_COLUMNS)}
+            FROM daily_quotes
+            {where_clause}
+            ORDER BY date DESC, stock_code
+        '''
+        return query, params
+    
+    @timed('db.query.get_daily_quotes')
+    def get_daily_quotes(self, date: str = None, stock_code: str = None,
+                         start_date: str = None, end_date: str = None,
+                         market: str = None) -> pd.DataFrame:
+        """
+        查詢全市場每日行情
+        
+        Args:
+            date: 特定日期
+            stock_code: 股票代碼
+            start_date: 起始日期
+            end_date: 結束日期
+            market: 'TWSE' (上市) 或 'TPEX' (上櫃)
+            
+        Returns:
+            每日行情 DataFrame
+        """
+        try:
+            conn = self.get_connection()
+            
+            query, params = self._build_daily_quotes_query(date, stock_code, start_date, end_date, market)
+            return pd.read_sql_query(query, conn, params=params)
+            
+        except Exception as e:
+            self.logger.error(f"查詢每日行情失敗: {e}")
+            return pd.DataFrame()
+    
+    def _refresh_derived_tables(self, cursor: sqlite3.Cursor, rebuild: bool = False):
+        """
+        重算 affected_days 內 (日期, 股票) 的所有衍生統計表，完成後清空 affected_days
+        
+        先前延後重算 (derived_pending) 的 (日期, 股票) 一併併入，每檔股票的
+        分點基準與持股成本在同一次處理中最多只重播一次。
+        
+        Args:
+            cursor: 交易中的 cursor
+            rebuild: 由 rebuild_derived_tables 呼叫 (broker_trading 的資料列可能已被刪除)
+        """
+        cursor.execute('INSERT OR IGNORE INTO affected_days (date, stock_code) SELECT date, stock_code FROM derived_pending')
+        cursor.execute('DELETE FROM derived_pending')
+        
+        self._refresh_daily_summary(cursor, rebuild)
+        self._refresh_broker_rollups(cursor)
+        self._refresh_branch_state(cursor, rebuild)
+        self._refresh_branch_cumulative(cursor)
+        cursor.execute('DELETE FROM affected_days')
+    
+    def _refresh_daily_summary(self, cursor: sqlite3.Cursor, rebuild: bool = False):
+        """
+        依 broker_trading 重新計算 affected_days 的每日摘要
+        
+        只讀取受影響日期與股票的資料列 (走 date, stock_code 索引)，
+        異常筆數沿用 ChipAnalyzer.detect_unusual_activity 的標準差規則。
+        
+        Args:
+            cursor: 交易中的 cursor
+            rebuild: 重建時一併刪除 broker_trading 已無資料的每日摘要
+        """
+        if rebuild:
+            cursor.execute(DAILY_SUMMARY_STALE_DELETE_SQL)
+        cursor.execute(DAILY_SUMMARY_REFRESH_SQL, (UNUSUAL_STD_THRESHOLD ** 2,))
+    
+    def _refresh_broker_rollups(self, cursor: sqlite3.Cursor):
+        """
+        更新 affected_days 的券商每日彙總表
+        
+        個股彙總直接由 broker_trading 重算；全市場彙總以差額更新
+        (先扣掉這些股票舊的個股彙總，再加上新的)，不需重讀當日其他股票。
+        
+        Args:
+            cursor: 交易中的 cursor
+        """
+        # 扣除舊的個股彙總
+        cursor.execute(BROKER_ROLLUP_APPLY_SQL.format(sign='-'))
+        
+        # 重算個股彙總
+        cursor.execute(STOCK_ROLLUP_DELETE_SQL)
+        cursor.execute(STOCK_ROLLUP_INSERT_SQL)
+        
+        # 加上新的個股彙總
+        cursor.execute(BROKER_ROLLUP_APPLY_SQL.format(sign='+'))
+        cursor.execute(BROKER_ROLLUP_PRUNE_SQL)
+        
+        # 記錄當日有交易的分點
+        cursor.execute(BRANCH_PRESENCE_INSERT_SQL)
+    
+    def _refresh_branch_state(self, cursor: sqlite3.Cursor, rebuild: bool = False):
+        """
+        以 affected_days 的交易更新分點異常基準與持股成本，並將異常交易寫入 unusual_trading
+        
+        依日期順序逐日處理: 先以前一日為止的基準評分 (|淨買賣 - 基準平均| > k * 基準標準差)，
+        再以當日資料更新基準與持股成本，每日只讀取當日的資料列。
+        兩者都與交易順序有關: 同一日重新寫入時先還原該日的更新；
+        寫入更早的日期時，該股票的基準依日期順序重播，持股成本只重置並重播
+        受影響的分點 (cost_replay_branches)，其餘分點的持股成本保持不變。
+        
+        Args:
+            cursor: 交易中的 cursor
+            rebuild: 重建模式，最後更新日在受影響日期之後的分點也一併重播
+        """
+        alpha = 2.0 / (BASELINE_SPAN_DAYS + 1)
+        
+        cursor.execute('DELETE FROM baseline_days')
+        cursor.execute('INSERT INTO baseline_days (date, stock_code) SELECT date, stock_code FROM affected_days')
+        cursor.execute('DELETE FROM cost_replay')
+        cursor.execute('DELETE FROM cost_replay_branches')
+        
+        replay_stocks = [row[0] for row in cursor.execute(BASELINE_REPLAY_STOCKS_SQL).fetchall()]
+        if replay_stocks:
+            cursor.executemany('INSERT INTO cost_replay (stock_code) VALUES (?)', [(code,) for code in replay_stocks])
+            cursor.execute(COST_REPLAY_BRANCHES_SQL)
+            if rebuild:
+                cursor.execute(COST_REPLAY_STALE_BRANCHES_SQL)
+            cursor.execute(COST_REPLAY_DELETE_SQL)
+        for stock_code in replay_stocks:
+            cursor.execute('DELETE FROM branch_baseline WHERE stock_code = ?', (stock_code,))
+            cursor.execute('DELETE FROM unusual_trading WHERE stock_code = ?', (stock_code,))
+            cursor.execute('DELETE FROM baseline_progress WHERE stock_code = ?', (stock_code,))
+            cursor.execute('''
+                INSERT OR IGNORE INTO baseline_days (date, stock_code)
+                SELECT date, stock_code FROM daily_summary WHERE stock_code = ?
+            ''', (stock_code,))
+        if replay_stocks:
+            self.logger.info(f"寫入早於既有基準的資料，重播 {len(replay_stocks)} 檔股票的分點基準與持股成本")
+        
+        dates = [row[0] for row in cursor.execute('SELECT DISTINCT date FROM baseline_days ORDER BY date').fetchall()]
+        for date in dates:
+            cursor.execute('DELETE FROM baseline_step')
+            cursor.execute('''
+                INSERT INTO baseline_step (date, stock_code)
+                SELECT date, stock_code FROM baseline_days WHERE date = ?
+            ''', (date,))
+            
+            cursor.execute(BASELINE_ROLLBACK_NEW_SQL, (date,))
+            cursor.execute(BASELINE_ROLLBACK_SQL, (date,))
+            cursor.execute(BASELINE_UNUSUAL_DELETE_SQL, (date,))
+            cursor.execute(COST_BASIS_ROLLBACK_NEW_SQL, (date,))
+            cursor.execute(COST_BASIS_ROLLBACK_SQL, (date,))
+            
+            cursor.execute(BASELINE_SCORE_SQL, (BASELINE_MIN_DAYS, UNUSUAL_STD_THRESHOLD ** 2))
+            cursor.execute(BASELINE_UPDATE_SQL, (alpha,))
+            cursor.execute(COST_BASIS_UPDATE_SQL)
+            cursor.execute(BASELINE_PROGRESS_SQL)
+        
+        cursor.execute('DELETE FROM baseline_step')
+        cursor.execute('DELETE FROM baseline_days')
+        cursor.execute('DELETE FROM cost_replay')
+        cursor.execute('DELETE FROM cost_replay_branches')
+    
+    def _refresh_branch_cumulative(self, cursor: sqlite3.Cursor):
+        """
+        以 affected_days 的交易更新分點累積淨買賣 (前綴和)
+        
+        依日期順序逐日處理: 當日各分點的累積值 = 前一筆累積值 + 當日淨買賣；
+        當日淨買賣與原有紀錄的差額再加到同一分點之後的紀錄。
+        依序寫入新的一天時之後沒有紀錄，只需讀寫當日的資料列。
+        
+        Args:
+            cursor: 交易中的 cursor
+        """
+        dates = [row[0] for row in cursor.execute('SELECT DISTINCT date FROM affected_days ORDER BY date').fetchall()]
+        for date in dates:
+            cursor.execute('DELETE FROM cumulative_delta')
+            cursor.execute(CUMULATIVE_DELTA_NEW_SQL, (date,))
+            cursor.execute(CUMULATIVE_DELTA_OLD_SQL, (date,))
+            
+            cursor.execute(CUMULATIVE_DELETE_SQL, (date,))
+            cursor.execute(CUMULATIVE_INSERT_SQL, (date,))
+            if cursor.execute(CUMULATIVE_LATER_SQL, (date,)).fetchone()[0]:
+                cursor.execute(CUMULATIVE_SHIFT_SQL, (date,))
+        
+        cursor.execute('DELETE FROM cumulative_delta')
+    
+    def rebuild_derived_tables(self, start_date: str = None, end_date: str = None) -> int:
+        """
+        由 broker_trading 重建衍生統計表 (每日摘要、券商彙總、分點異常基準、持股成本、分點累積淨買賣)
+        
+        用於既有資料、結構升級或手動修正 broker_trading 之後。
+        
+        Args:
+            start_date: 起始日期
+            end_date: 結束日期
+            
+        Returns:
+            重建的 (日期, 股票) 數量
+        """
+        try:
+            conditions = []
+            params = []
+            if start_date:
+                conditions.append("date >= ?")
+                params.append(start_date)
+            if end_date:
+                conditions.append("date <= ?")
+                params.append(end_date)
+            
+            where_clause = " WHERE " + " AND ".join(conditions) if conditions else ""
+            
+            conn = self.get_connection()
+            self._ensure_temp_tables(conn)
+            
+            with conn:
+                cursor = conn.cursor()
+                cursor.execute(f'''
+                    INSERT OR IGNORE INTO affected_days (date, stock_code)
+                    SELECT DISTINCT date, stock_code FROM broker_trading{where_clause}
+                ''', params)
+                # 已從 broker_trading 刪除的日子也需重算，才能由彙總與累積淨買賣中扣除
+                cursor.execute(f'''
+                    INSERT OR IGNORE INTO affected_days (date, stock_code)
+                    SELECT date, stock_code FROM daily_summary{where_clause}
+                ''', params)
+                rebuilt = cursor.execute('SELECT COUNT(*) FROM affected_days').fetchone()[0]
+                self._refresh_derived_tables(cursor, rebuild=True)
+            
+            self.logger.info(f"重建 {rebuilt} 組 (日期, 股票) 的衍生統計")
+            return rebuilt
+            
+        except Exception as e:
+            self.logger.error(f"重建衍生統計失敗: {e}")
+            return 0
+    
+    @contextmanager
+    def deferred_refresh(self):
+        """
+        區塊內寫入的券商資料先不重算衍生統計表，離開區塊時一次重算
+        
+        回補通常寫入早於既有資料的日期，逐筆寫入時每次都會重播該股票全部歷史的
+        分點基準與持股成本；延後到最後一次處理，每檔股票只重播一次。
+        待重算的 (日期, 股票) 記錄在 derived_pending，中途中斷時由下一次寫入補算。
+        """
+        self._defer_depth += 1
+        try:
+            yield self
+        finally:
+            self._defer_depth -= 1
+            if not self._defer_depth:
+                self.refresh_pending_derived()
+    
+    def refresh_pending_derived(self) -> int:
+        """
+        重算 derived_pending 中延後處理的衍生統計表
+        
+        Returns:
+            重算的 (日期, 股票) 數量
+        """
+        try:
+            conn = self.get_connection()
+            self._ensure_temp_tables(conn)
+            
+            with conn:
+                cursor = conn.cursor()
+                pending = cursor.execute('SELECT COUNT(*) FROM derived_pending').fetchone()[0]
+                if pending:
+                    self._refresh_derived_tables(cursor)
+            
+            if pending:
+                self.logger.info(f"重算 {pending} 組延後處理的 (日期, 股票) 衍生統計")
+            return pending
+            
+        except Exception as e:
+            self.logger.error(f"重算延後的衍生統計失敗: {e}")
+            return 0
+    
+    def _build_daily_summary_query(self, stock_code: str = None, date: str = None,
+                                   start_date: str = None, end_date: str = None) -> tuple:
+        """建立 get_daily_summary 的查詢 (query, params)"""
+        conditions = []
+        params = []
+        
+        if stock_code:
+            conditions.append("stock_code = ?")
+            params.append(stock_code)
+        
+        if date:
+            conditions.append("date = ?")
+            params.append(date)
+        else:
+            if start_date:
+                conditions.append("date >= ?")
+                params.append(start_date)
+            if end_date:
+                conditions.append("date <= ?")
+                params.append(end_date)
+        
+        where_clause = " WHERE " + " AND ".join(conditions) if conditions else ""
+        
+        query = f'''
+            SELECT date, stock_code, total_volume, total_amount, broker_count, branch_count,
+                   top_buyer_broker, top_seller_broker, unusual_activity_count
+            FROM daily_summary
+            {where_clause}
+            ORDER BY date DESC, total_amount DESC
+        '''
+        return query, params
+    
+    @timed('db.query.get_daily_summary')
+    def get_daily_summary(self, stock_code: str = None, date: str = None,
+                          start_date: str = None, end_date: str = None) -> pd.DataFrame:
+        """
+        查詢預先計算的每日摘要
+        
+        Args:
+            stock_code: 股票代碼
+            date: 特定日期
+            start_date: 起始日期
+            end_date: 結束日期
+            
+        Returns:
+            每日摘要 DataFrame
+        """
+        try:
+            conn = self.get_connection()
+            
+            query, params = self._build_daily_summary_query(stock_code, date, start_date, end_date)
+            return pd.read_sql_query(query, conn, params=params)
+            
+        except Exception as e:
+            self.logger.error(f"查詢每日摘要失敗: {e}")
+            return pd.DataFrame()
+    
+    def _build_unusual_trading_query(self, stock_code: str = None, date: str = None,
+                                     start_date: str = None, end_date: str = None) -> tuple:
+        """建立 get_unusual_trading 的查詢 (query, params)"""
+        conditions = []
+        params = []
+        
+        if stock_code:
+            conditions.append("stock_code = ?")
+            params.append(stock_code)
+        
+        if date:
+            conditions.append("date = ?")
+            params.append(date)
+        else:
+            if start_date:
+                conditions.append("date >= ?")
+                params.append(start_date)
+            if end_date:
+                conditions.append("date <= ?")
+                params.append(end_date)
+        
+        where_clause = " WHERE " + " AND ".join(conditions) if conditions else ""
+        
+        query = f'''
+            SELECT date, stock_code, broker_code, branch_name, net_volume, net_amount,
+                   anomaly_score, anomaly_type
+            FROM unusual_trading
+            {where_clause}
+            ORDER BY date DESC, anomaly_score DESC
+        '''
+        return query, params
+    
+    @timed('db.query.get_unusual_trading')
+    def get_unusual_trading(self, stock_code: str = None, date: str = None,
+                            start_date: str = None, end_date: str = None) -> pd.DataFrame:
+        """
+        查詢依分點異常基準偵測到的異常交易
+        
+        Args:
+            stock_code: 股票代碼
+            date: 特定日期
+            start_date: 起始日期
+            end_date: 結束日期
+            
+        Returns:
+            異常交易 DataFrame (異常程度為偏離分點自身基準的標準差倍數)
+        """
+        try:
+            conn = self.get_connection()
+            
+            query, params = self._build_unusual_trading_query(stock_code, date, start_date, end_date)
+            return pd.read_sql_query(query, conn, params=params)
+            
+        except Exception as e:
+            self.logger.error(f"查詢異常交易失敗: {e}")
+            return pd.DataFrame()
+    
+    def has_branch_baseline(self, stock_code: str) -> bool:
+        """股票是否已有累積足夠天數 (BASELINE_MIN_DAYS) 的分點基準"""
+        try:
+            conn = self.get_connection()
+            row = conn.execute('''
+                SELECT EXISTS (
+                    SELECT 1 FROM branch_baseline WHERE stock_code = ? AND observations >= ?
+                )
+            ''', (stock_code, BASELINE_MIN_DAYS)).fetchone()
+            return bool(row[0])
+            
+        except Exception as e:
+            self.logger.error(f"查詢分點基準失敗: {e}")
+            return False
+    
+    def _top_brokers_window(self, days: int) -> tuple:
+        """計算熱門券商查詢的日期區間 (start_date, end_date)"""
+        from datetime import datetime, timedelta
+        end_date = datetime.now().strftime('%Y-%m-%d')
+        start_date = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+        return start_date, end_date
+    
+    def _build_top_brokers_query(self, stock_code: str = None, days: int = 30, limit: int = 20) -> tuple:
+        """
+        建立 get_top_brokers 的查詢 (query, params)
+        
+        券商金額與筆數由每日彙總表加總。分點數 COUNT(DISTINCT branch_name) 無法由彙總列相加：
+        全市場查詢讀取 broker_branch_daily；單一股票則讀取 broker_trading 在區間內的原始列
+        (僅走 idx_broker_stock_date 涵蓋索引)，讀取量不受 N 列彙總的上限約束。
+        """
+        start_date, end_date = self._top_brokers_window(days)
+        
+        if stock_code:
+            rollup_query = '''
+                SELECT broker_code, buy_volume, sell_volume, buy_amount, sell_amount, row_count
+                FROM broker_stock_daily_rollup
+                WHERE stock_code = ? AND date BETWEEN ? AND ?
+            '''
+            branch_query = '''
+                SELECT broker_code, branch_name
+                FROM broker_trading
+                WHERE stock_code = ? AND date BETWEEN ? AND ?
+            '''
+            window_params = [stock_code, start_date, end_date]
+        else:
+            rollup_query = '''
+                SELECT broker_code, buy_volume, sell_volume, buy_amount, sell_amount, row_count
+                FROM broker_daily_rollup
+                WHERE date BETWEEN ? AND ?
+            '''
+            branch_query = '''
+                SELECT broker_code, branch_name
+                FROM broker_branch_daily
+                WHERE date BETWEEN ? AND ?
+            '''
+            window_params = [start_date, end_date]
+        
+        query = f'''
+            WITH totals AS (
+                SELECT broker_code,
+                       SUM(buy_volume) as total_buy_volume,
+                       SUM(sell_volume) as total_sell_volume,
+                       SUM(buy_amount) as total_buy_amount,
+                       SUM(sell_amount) as total_sell_amount,
+                       SUM(buy_volume) - SUM(sell_volume) as total_net_volume,
+                       SUM(buy_amount) - SUM(sell_amount) as total_net_amount,
+                       SUM(row_count) as trading_days
+                FROM ({rollup_query})
+                GROUP BY broker_code
+            ),
+            branches AS (
+                SELECT broker_code, COUNT(DISTINCT branch_name) as branch_count
+                FROM ({branch_query})
+                GROUP BY broker_code
+            )
+            SELECT t.broker_code,
+                   t.total_buy_volume, t.total_sell_volume,
+                   t.total_buy_amount, t.total_sell_amount,
+                   t.total_net_volume, t.total_net_amount,
+                   b.branch_count, t.trading_days
+            FROM totals t
+            JOIN branches b ON b.broker_code = t.broker_code
+            ORDER BY ABS(t.total_net_amount) DESC, t.broker_code
+            LIMIT ?
+        '''
+        
+        params = window_params + window_params + [limit]
+        return query, params
+    
+    @timed('db.query.get_top_brokers')
+    def get_top_brokers(self, stock_code: str = None, days: int = 30, limit: int = 20) -> pd.DataFrame:
+        """
+        查詢熱門券商排行
+        
+        由寫入時維護的券商每日彙總表加總，每個券商最多讀取 N 天的彙總列
+        (單一股票的分點數仍由原始列計算，見 _build_top_brokers_query)；
+        結果與直接彙總 broker_trading (get_top_brokers_raw) 相同，同金額時依券商代碼排序。
+        
+        Args:
+            stock_code: 股票代碼
+            days: 查詢天數
+            limit: 回傳數量限制
+            
+        Returns:
+            券商排行 DataFrame
+        """
+        try:
+            conn = self.get_connection()
+            
+            query, params = self._build_top_brokers_query(stock_code, days, limit)
+            df = pd.read_sql_query(query, conn, params=params)
+            
+            return df
+            
+        except Exception as e:
+            self.logger.error(f"查詢熱門券商失敗: {e}")
+            return pd.DataFrame()
+    
+    def get_top_brokers_raw(self, stock_code: str = None, days: int = 30, limit: int = 20) -> pd.DataFrame:
+        """
+        直接彙總 broker_trading 查詢熱門券商排行 (不使用彙總表，供驗證比對)
+        
+        Args:
+            stock_code: 股票代碼
+            days: 查詢天數
+            limit: 回傳數量限制
+            
+        Returns:
+            券商排行 DataFrame
+        """
+        try:
+            conn = self.get_connection()
+            
+            start_date, end_date = self._top_brokers_window(days)
+            
+            conditions = ["date BETWEEN ? AND ?"]
+            params = [start_date, end_date]
+            
+            if stock_code:
+                conditions.append("stock_code = ?")
+                params.append(stock_code)
+            
+            where_clause = " WHERE " + " AND ".join(conditions)
+            
+            query = f'''
+                SELECT broker_code,
+                       SUM(buy_volume) as total_buy_volume,
+                       SUM(sell_volume) as total_sell_volume,
+                       SUM(buy_amount) as total_buy_amount,
+                       SUM(sell_amount) as total_sell_amount,
+                       SUM(buy_volume) - SUM(sell_volume) as total_net_volume,
+                       SUM(buy_amount) - SUM(sell_amount) as total_net_amount,
+                       COUNT(DISTINCT branch_name) as branch_count,
+                       COUNT(*) as trading_days
+                FROM broker_trading
+                {where_clause}
+                GROUP BY broker_code
+                ORDER BY ABS(total_net_amount) DESC, broker_code
+                LIMIT ?
+            '''
+            
             params.append(limit)
             df = pd.read_sql_query(query, conn, params=params)
-            conn.close()
             
             return df
             
@@ -303,6 +1924,441 @@ class ChipDatabase:
             self.logger.error(f"查詢熱門券商失敗: {e}")
             return pd.DataFrame()
     
+    def _build_branch_footprint_query(self, broker_code: str, branch_name: str = None,
+                                      days: int = 30, limit: int = None) -> tuple:
+        """
+        建立 get_branch_footprint 的查詢 (query, params)
+        
+        以券商 / 分點優先的涵蓋索引 idx_broker_broker_branch 依 (券商, 分點, 日期區間) 定位；
+        未指定分點時，先由 broker_branch_daily 取得券商在區間內有交易的分點，再逐一定位。
+        """
+        start_date, end_date = self._top_brokers_window(days)
+        
+        if branch_name:
+            source = '''
+                FROM broker_trading b
+                WHERE b.broker_code = ? AND b.branch_name = ? AND b.date BETWEEN ? AND ?
+            '''
+            params = [broker_code, branch_name, start_date, end_date]
+        else:
+            source = '''
+                FROM (
+                    SELECT DISTINCT branch_name FROM broker_branch_daily
+                    WHERE date BETWEEN ? AND ? AND broker_code = ?
+                ) d
+                CROSS JOIN broker_trading b
+                    ON b.broker_code = ? AND b.branch_name = d.branch_name AND b.date BETWEEN ? AND ?
+            '''
+            params = [start_date, end_date, broker_code, broker_code, start_date, end_date]
+        
+        query = f'''
+            SELECT f.stock_code,
+                   (SELECT q.stock_name FROM daily_quotes q
+                    WHERE q.stock_code = f.stock_code ORDER BY q.date DESC LIMIT 1) as stock_name,
+                   f.total_buy_volume, f.total_sell_volume,
+                   f.total_buy_amount, f.total_sell_amount,
+                   f.total_net_volume, f.total_net_amount,
+                   f.trading_days, f.first_date, f.last_date
+            FROM (
+                SELECT b.stock_code,
+                       SUM(b.buy_volume) as total_buy_volume,
+                       SUM(b.sell_volume) as total_sell_volume,
+                       SUM(b.buy_amount) as total_buy_amount,
+                       SUM(b.sell_amount) as total_sell_amount,
+                       SUM(b.buy_volume) - SUM(b.sell_volume) as total_net_volume,
+                       SUM(b.buy_amount) - SUM(b.sell_amount) as total_net_amount,
+                       COUNT(DISTINCT b.date) as trading_days,
+                       MIN(b.date) as first_date,
+                       MAX(b.date) as last_date
+                {source}
+                GROUP BY b.stock_code
+            ) f
+            ORDER BY f.total_net_amount DESC
+            LIMIT ?
+        '''
+        
+        params.append(-1 if limit is None else limit)
+        return query, params
+    
+    @timed('db.query.get_branch_footprint')
+    def get_branch_footprint(self, broker_code: str, branch_name: str = None,
+                             days: int = 30, limit: int = None) -> pd.DataFrame:
+        """
+        查詢券商分點的跨股票足跡: 最近 N 天在各股票的累計買賣與淨部位
+        
+        由券商 / 分點優先的涵蓋索引讀取，只讀取該分點在區間內的資料，不掃描整個 broker_trading。
+        
+        Args:
+            broker_code: 券商代碼
+            branch_name: 分點名稱，未指定時彙總券商所有分點
+            days: 查詢天數
+            limit: 回傳股票數量限制，None 表示全部
+        
+        Returns:
+            各股票的足跡 DataFrame，依淨買賣金額由買超到賣超排序
+        """
+        try:
+            conn = self.get_connection()
+            
+            query, params = self._build_branch_footprint_query(broker_code, branch_name, days, limit)
+            return pd.read_sql_query(query, conn, params=params)
+        
+        except Exception as e:
+            self.logger.error(f"查詢分點足跡失敗: {e}")
+            return pd.DataFrame()
+    
+    def _build_branch_accumulation_query(self, stock_code: str, broker_code: str, branch_name: str,
+                                         start_date: str = None, end_date: str = None) -> tuple:
+        """建立 get_branch_accumulation 的查詢 (query, params)，未指定的日期視為不設限"""
+        start_date = start_date or '0000-00-00'
+        end_date = end_date or '9999-99-99'
+        key = [stock_code, broker_code, branch_name]
+        return CUMULATIVE_RANGE_SQL, key + [end_date] + key + [start_date]
+    
+    def _build_branch_accumulation_series_query(self, stock_code: str, broker_code: str, branch_name: str,
+                                                start_date: str = None, end_date: str = None) -> tuple:
+        """建立 get_branch_accumulation_series 的查詢 (query, params)"""
+        conditions = ["stock_code = ?", "broker_code = ?", "branch_name = ?"]
+        params = [stock_code, broker_code, branch_name]
+        
+        if start_date:
+            conditions.append("date >= ?")
+            params.append(start_date)
+        if end_date:
+            conditions.append("date <= ?")
+            params.append(end_date)
+        
+        # 累積值扣除區間第一筆之前的累積，由區間起點從 0 開始累積
+        query = f'''
+            SELECT date, net_volume, net_amount,
+                   cum_net_volume - FIRST_VALUE(cum_net_volume - net_volume) OVER w AS cum_net_volume,
+                   cum_net_amount - FIRST_VALUE(cum_net_amount - net_amount) OVER w AS cum_net_amount
+            FROM branch_cumulative
+            WHERE {" AND ".join(conditions)}
+            WINDOW w AS (ORDER BY date)
+            ORDER BY date
+        '''
+        return query, params
+    
+    @timed('db.query.get_branch_accumulation')
+    def get_branch_accumulation(self, stock_code: str, broker_code: str, branch_name: str,
+                                start_date: str = None, end_date: str = None) -> Dict[str, Any]:
+        """
+        查詢分點在區間內對某檔股票的累積淨買賣
+        
+        由寫入時維護的累積淨買賣 (前綴和) 表查兩筆紀錄相減，與區間長度無關。
+        
+        Args:
+            stock_code: 股票代碼
+            broker_code: 券商代碼
+            branch_name: 分點名稱
+            start_date: 起始日期 (未指定表示自最早的資料)
+            end_date: 結束日期 (未指定表示到最新的資料)
+        
+        Returns:
+            {'net_volume': 淨買賣股數, 'net_amount': 淨買賣金額, 'trading_days': 交易天數,
+             'avg_cost': 淨買賣金額 / 淨買賣股數 (淨買賣股數為 0 時為 None)}
+        """
+        result = {'net_volume': 0, 'net_amount': 0, 'trading_days': 0, 'avg_cost': None}
+        
+        try:
+            conn = self.get_connection()
+            
+            query, params = self._build_branch_accumulation_query(
+                stock_code, broker_code, branch_name, start_date, end_date
+            )
+            row = conn.execute(query, params).fetchone()
+            if row is not None:
+                result['net_volume'], result['net_amount'], result['trading_days'] = row[0], row[1], row[2]
+                if result['net_volume']:
+                    result['avg_cost'] = result['net_amount'] / result['net_volume']
+            return result
+        
+        except Exception as e:
+            self.logger.error(f"查詢分點累積淨買賣失敗: {e}")
+            return result
+    
+    @timed('db.query.get_branch_accumulation_series')
+    def get_branch_accumulation_series(self, stock_code: str, broker_code: str, branch_name: str,
+                                       start_date: str = None, end_date: str = None) -> pd.DataFrame:
+        """
+        查詢分點對某檔股票的每日累積淨買賣走勢 (累積值自區間起點起算)
+        
+        Args:
+            stock_code: 股票代碼
+            broker_code: 券商代碼
+            branch_name: 分點名稱
+            start_date: 起始日期
+            end_date: 結束日期
+        
+        Returns:
+            DataFrame (date, net_volume, net_amount, cum_net_volume, cum_net_amount)
+        """
+        try:
+            conn = self.get_connection()
+            
+            query, params = self._build_branch_accumulation_series_query(
+                stock_code, broker_code, branch_name, start_date, end_date
+            )
+            return pd.read_sql_query(query, conn, params=params)
+        
+        except Exception as e:
+            self.logger.error(f"查詢分點累積走勢失敗: {e}")
+            return pd.DataFrame()
+    
+    def _build_branch_pnl_query(self, stock_code: str = None, broker_code: str = None,
+                                branch_name: str = None, order_by: str = 'unrealized_pnl',
+                                ascending: bool = False, limit: int = 20) -> tuple:
+        """建立 get_branch_pnl 的查詢 (query, params)"""
+        if order_by not in BRANCH_PNL_ORDER_COLUMNS:
+            raise ValueError(f"不支援的排序欄位: {order_by}")
+        
+        conditions = ["c.position != 0"]
+        params = []
+        
+        if stock_code:
+            conditions.append("c.stock_code = ?")
+            params.append(stock_code)
+        
+        if broker_code:
+            conditions.append("c.broker_code = ?")
+            params.append(broker_code)
+            if branch_name:
+                conditions.append("c.branch_name = ?")
+                params.append(branch_name)
+        
+        # 參考價: 股票最後交易日的收盤價，沒有行情時以當日全體分點的成交均價代替
+        query = f'''
+            SELECT c.stock_code, c.broker_code, c.branch_name, c.position,
+                   c.cost_basis / c.position AS avg_cost,
+                   m.mark_price, m.mark_date,
+                   c.position * m.mark_price - c.cost_basis AS unrealized_pnl,
+                   c.realized_pnl, c.trading_days, c.last_date
+            FROM branch_cost_basis c
+            JOIN (
+                SELECT p.stock_code, p.last_date AS mark_date,
+                       COALESCE(NULLIF(q.close, 0), CAST(d.total_amount AS REAL) / NULLIF(d.total_volume, 0)) AS mark_price
+                FROM baseline_progress p
+                JOIN daily_summary d ON d.date = p.last_date AND d.stock_code = p.stock_code
+                LEFT JOIN daily_quotes q ON q.date = p.last_date AND q.stock_code = p.stock_code
+            ) m ON m.stock_code = c.stock_code
+            WHERE {" AND ".join(conditions)}
+            ORDER BY {order_by} {"ASC" if ascending else "DESC"}
+            LIMIT ?
+        '''
+        params.append(limit)
+        return query, params
+    
+    @timed('db.query.get_branch_pnl')
+    def get_branch_pnl(self, stock_code: str = None, broker_code: str = None, branch_name: str = None,
+                       order_by: str = 'unrealized_pnl', ascending: bool = False, limit: int = 20) -> pd.DataFrame:
+        """
+        查詢分點的持股成本與損益 (寫入時以平均成本法逐日更新，不需重播歷史)
+        
+        Args:
+            stock_code: 股票代碼 (未指定表示全市場)
+            broker_code: 券商代碼
+            branch_name: 分點名稱 (需同時指定券商代碼)
+            order_by: 排序欄位 (unrealized_pnl、realized_pnl 或 position)
+            ascending: 由小到大排序 (例如找出未實現虧損最大的分點)
+            limit: 最多回傳筆數
+        
+        Returns:
+            DataFrame (stock_code, broker_code, branch_name, position, avg_cost, mark_price, mark_date,
+            unrealized_pnl, realized_pnl, trading_days, last_date)，只包含仍有部位的分點；
+            部位為負表示區間內賣出多於買進
+        """
+        try:
+            conn = self.get_connection()
+            
+            query, params = self._build_branch_pnl_query(
+                stock_code, broker_code, branch_name, order_by, ascending, limit
+            )
+            return pd.read_sql_query(query, conn, params=params)
+        
+        except Exception as e:
+            self.logger.error(f"查詢分點持股成本失敗: {e}")
+            return pd.DataFrame()
+    
+    def explain_query_plan(self, query: str, params=()) -> List[str]:
+        """
+        取得查詢的 EXPLAIN QUERY PLAN 明細
+        
+        Args:
+            query: SQL 查詢
+            params: 查詢參數
+            
+        Returns:
+            查詢計畫每一步的說明
+        """
+        conn = self.get_connection()
+        rows = conn.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall()
+        return [row['detail'] for row in rows]
+    
+    def _hot_queries(self) -> Dict[str, tuple]:
+        """本模組的熱門查詢與寫入時的衍生表更新語句 {名稱: (query, params)}"""
+        from datetime import datetime, timedelta
+        today = datetime.now().strftime('%Y-%m-%d')
+        month_ago = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
+        stock_window = self._broker_data_filters(stock_code='2330', start_date=month_ago, end_date=today)
+        
+        return {
+            'get_broker_data 個股區間': self._build_broker_data_query(
+                stock_code='2330', start_date=month_ago, end_date=today),
+            'get_broker_data 個股單日': self._build_broker_data_query(stock_code='2330', date=today),
+            'get_broker_data 全市場單日': self._build_broker_data_query(date=today),
+            'get_broker_data 券商區間': self._build_broker_data_query(
+                broker_code='9800', start_date=month_ago, end_date=today),
+            'get_broker_data 分點區間': self._build_broker_data_query(
+                broker_code='9800', branch_name='總公司', start_date=month_ago, end_date=today),
+            'iter_broker_data 個股區間': self._build_broker_data_query(
+                stock_code='2330', start_date=month_ago, end_date=today, date_ascending=True),
+            'iter_broker_data 異常區間': self._build_broker_data_query(
+                stock_code='2330', start_date=month_ago, end_date=today,
+                net_volume_band=(-1000.0, 1000.0), date_ascending=True),
+            'get_analysis_aggregates 分點彙總': (
+                ANALYSIS_BRANCH_TOTALS_SQL.format(where_clause=stock_window[0]), stock_window[1]),
+            'get_analysis_aggregates 離均差': (
+                ANALYSIS_NET_M2_SQL.format(where_clause=stock_window[0]), [0.0] + stock_window[1]),
+            'get_market_branch_totals 單日': self._build_market_branch_totals_query(date=today),
+            'get_market_branch_totals 區間': self._build_market_branch_totals_query(
+                start_date=month_ago, end_date=today),
+            'get_branch_footprint 分點': self._build_branch_footprint_query('9800', '總公司', days=7),
+            'get_branch_footprint 券商': self._build_branch_footprint_query('9800', days=7),
+            'get_top_brokers 全市場': self._build_top_brokers_query(days=30),
+            'get_top_brokers 個股': self._build_top_brokers_query(stock_code='2330', days=30),
+            'get_daily_summary 個股': self._build_daily_summary_query(
+                stock_code='2330', start_date=month_ago, end_date=today),
+            'get_daily_summary 單日': self._build_daily_summary_query(date=today),
+            'get_unusual_trading 個股': self._build_unusual_trading_query(
+                stock_code='2330', start_date=month_ago, end_date=today),
+            'get_unusual_trading 單日': self._build_unusual_trading_query(date=today),
+            'get_branch_accumulation': self._build_branch_accumulation_query(
+                '2330', '9800', '總公司', month_ago, today),
+            'get_branch_accumulation_series': self._build_branch_accumulation_series_query(
+                '2330', '9800', '總公司', month_ago, today),
+            'get_branch_pnl 個股': self._build_branch_pnl_query(stock_code='2330'),
+            'get_branch_pnl 分點': self._build_branch_pnl_query(broker_code='9800', branch_name='總公司'),
+            'get_branch_pnl 券商': self._build_branch_pnl_query(broker_code='9800'),
+            'get_daily_quotes 單日': self._build_daily_quotes_query(date=today),
+            'get_daily_quotes 個股': self._build_daily_quotes_query(
+                stock_code='2330', start_date=month_ago, end_date=today),
+            '寫入: 每日摘要': (DAILY_SUMMARY_REFRESH_SQL, (UNUSUAL_STD_THRESHOLD ** 2,)),
+            '重建: 刪除無資料的每日摘要': (DAILY_SUMMARY_STALE_DELETE_SQL, ()),
+            '寫入: 扣除全市場彙總': (BROKER_ROLLUP_APPLY_SQL.format(sign='-'), ()),
+            '寫入: 刪除個股彙總': (STOCK_ROLLUP_DELETE_SQL, ()),
+            '寫入: 重算個股彙總': (STOCK_ROLLUP_INSERT_SQL, ()),
+            '寫入: 清除空彙總': (BROKER_ROLLUP_PRUNE_SQL, ()),
+            '寫入: 分點出現紀錄': (BRANCH_PRESENCE_INSERT_SQL, ()),
+            '寫入: 基準重播判斷': (BASELINE_REPLAY_STOCKS_SQL, ()),
+            '寫入: 基準還原新分點': (BASELINE_ROLLBACK_NEW_SQL, (today,)),
+            '寫入: 基準還原': (BASELINE_ROLLBACK_SQL, (today,)),
+            '寫入: 刪除當日異常': (BASELINE_UNUSUAL_DELETE_SQL, (today,)),
+            '寫入: 基準評分': (BASELINE_SCORE_SQL, (BASELINE_MIN_DAYS, UNUSUAL_STD_THRESHOLD ** 2)),
+            '寫入: 基準更新': (BASELINE_UPDATE_SQL, (2.0 / (BASELINE_SPAN_DAYS + 1),)),
+            '寫入: 持股成本還原新分點': (COST_BASIS_ROLLBACK_NEW_SQL, (today,)),
+            '寫入: 持股成本還原': (COST_BASIS_ROLLBACK_SQL, (today,)),
+            '寫入: 持股成本更新': (COST_BASIS_UPDATE_SQL, ()),
+            '寫入: 持股成本重播分點': (COST_REPLAY_BRANCHES_SQL, ()),
+            '重建: 持股成本重播分點': (COST_REPLAY_STALE_BRANCHES_SQL, ()),
+            '寫入: 持股成本重置': (COST_REPLAY_DELETE_SQL, ()),
+            '寫入: 基準進度': (BASELINE_PROGRESS_SQL, ()),
+            '寫入: 累積差額 (新)': (CUMULATIVE_DELTA_NEW_SQL, (today,)),
+            '寫入: 累積差額 (舊)': (CUMULATIVE_DELTA_OLD_SQL, (today,)),
+            '寫入: 刪除當日累積': (CUMULATIVE_DELETE_SQL, (today,)),
+            '寫入: 當日累積': (CUMULATIVE_INSERT_SQL, (today,)),
+            '寫入: 之後的累積紀錄': (CUMULATIVE_LATER_SQL, (today,)),
+            '寫入: 傳遞累積差額': (CUMULATIVE_SHIFT_SQL, (today,)),
+        }
+    
+    def audit_query_plans(self) -> Dict[str, List[str]]:
+        """
+        稽核熱門查詢的查詢計畫，找出退化為整表掃描的查詢
+        
+        Returns:
+            {查詢名稱: 整表掃描的計畫明細}，空字典代表全部通過
+        """
+        self._ensure_temp_tables(self.get_connection())
+        
+        offenders = {}
+        for name, (query, params) in self._hot_queries().items():
+            scans = _full_scans(query, self.explain_query_plan(query, params))
+            if scans:
+                offenders[name] = scans
+                self.logger.warning(f"查詢退化為整表掃描 - {name}: {scans}")
+        
+        return offenders
+    
+    @timed('db.query.get_completed_dates')
+    def get_completed_dates(self, stock_code: str, start_date: str, end_date: str) -> set:
+        """
+        查詢已完成收集的日期 (回補時略過)
+        
+        包含 broker_trading 已有資料的日期 (daily_summary 每個有資料的股票、日期各一筆)，
+        以及進度表中確認查無資料的過去日期；當日查無資料可能只是尚未公布，不視為完成。
+        
+        Args:
+            stock_code: 股票代碼
+            start_date: 起始日期
+            end_date: 結束日期
+            
+        Returns:
+            已完成的日期集合 (YYYY-MM-DD)
+        """
+        try:
+            from datetime import datetime
+            today = datetime.now().strftime('%Y-%m-%d')
+            
+            conn = self.get_connection()
+            rows = conn.execute('''
+                SELECT date FROM daily_summary
+                WHERE stock_code = ? AND date BETWEEN ? AND ?
+                UNION
+                SELECT date FROM collection_progress
+                WHERE stock_code = ? AND date BETWEEN ? AND ?
+                  AND (status = 'ok' OR (status = 'empty' AND date < ?))
+            ''', (stock_code, start_date, end_date, stock_code, start_date, end_date, today)).fetchall()
+            
+            return {row[0] for row in rows}
+            
+        except Exception as e:
+            self.logger.error(f"查詢收集進度失敗: {e}")
+            return set()
+    
+    @timed('db.insert.progress')
+    def mark_collection_progress(self, stock_code: str, date: str, status: str,
+                                 row_count: int = 0, error: str = None) -> bool:
+        """
+        記錄單一股票、日期的收集結果
+        
+        Args:
+            stock_code: 股票代碼
+            date: 日期 (YYYY-MM-DD)
+            status: 'ok' (已寫入)、'empty' (查無資料) 或 'error' (抓取失敗，下次重試)
+            row_count: 寫入筆數
+            error: 錯誤訊息
+        """
+        try:
+            conn = self.get_connection()
+            
+            with conn:
+                conn.execute('''
+                    INSERT INTO collection_progress (stock_code, date, status, row_count, error)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (stock_code, date) DO UPDATE SET
+                        status = excluded.status,
+                        row_count = excluded.row_count,
+                        error = excluded.error,
+                        attempts = attempts + 1,
+                        updated_at = CURRENT_TIMESTAMP
+                ''', (stock_code, date, status, row_count, error))
+            
+            return True
+            
+        except Exception as e:
+            self.logger.error(f"記錄收集進度失敗: {e}")
+            return False
+    
     def cleanup_old_data(self, days_to_keep: int = 365) -> int:
         """清理舊資料"""
         try:
@@ -310,22 +2366,30 @@ class ChipDatabase:
             cutoff_date = (datetime.now() - timedelta(days=days_to_keep)).strftime('%Y-%m-%d')
             
             conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            # 刪除舊的券商交易資料
-            cursor.execute("DELETE FROM broker_trading WHERE date < ?", (cutoff_date,))
-            broker_deleted = cursor.rowcount
-            
-            # 刪除舊的每日摘要
-            cursor.execute("DELETE FROM daily_summary WHERE date < ?", (cutoff_date,))
-            summary_deleted = cursor.rowcount
-            
-            # 刪除舊的異常交易記錄
-            cursor.execute("DELETE FROM unusual_trading WHERE date < ?", (cutoff_date,))
-            unusual_deleted = cursor.rowcount
             
-            conn.commit()
-            conn.close()
+            with conn:
+                cursor = conn.cursor()
+                
+                # 刪除舊的券商交易資料
+                cursor.execute("DELETE FROM broker_trading WHERE date < ?", (cutoff_date,))
+                broker_deleted = cursor.rowcount
+                
+                # 刪除舊的每日摘要
+                cursor.execute("DELETE FROM daily_summary WHERE date < ?", (cutoff_date,))
+                summary_deleted = cursor.rowcount
+                
+                # 刪除舊的異常交易記錄
+                cursor.execute("DELETE FROM unusual_trading WHERE date < ?", (cutoff_date,))
+                unusual_deleted = cursor.rowcount
+                
+                # 刪除舊的券商彙總、回補進度與每日行情 (不計入刪除筆數)
+                for table in ('broker_daily_rollup', 'broker_stock_daily_rollup', 'broker_branch_daily',
+                              'collection_progress', 'daily_quotes', 'branch_cumulative'):
+                    cursor.execute(f"DELETE FROM {table} WHERE date < ?", (cutoff_date,))
+                
+                # 刪除保留期間內不再交易的分點基準與持股成本
+                cursor.execute("DELETE FROM branch_baseline WHERE last_date < ?", (cutoff_date,))
+                cursor.execute("DELETE FROM branch_cost_basis WHERE last_date < ?", (cutoff_date,))
             
             total_deleted = broker_deleted + summary_deleted + unusual_deleted
             self.logger.info(f"清理完成，刪除 {total_deleted} 筆舊資料")
@@ -336,28 +2400,57 @@ class ChipDatabase:
             self.logger.error(f"清理資料失敗: {e}")
             return 0
 
+def open_database(backend: str = None, read_only: bool = False):
+    """
+    依設定開啟籌碼資料庫
+
+    Args:
+        backend: 儲存後端 ('sqlite' 或 'parquet')，預設使用 STORAGE_BACKEND
+        read_only: 以唯讀模式開啟 SQLite (Parquet 分區檔本身即可多行程同時讀取)
+
+    Returns:
+        ChipDatabase 或 ParquetChipDatabase
+    """
+    backend = (backend or STORAGE_BACKEND).lower()
+    if backend == 'parquet':
+        from src.utils.parquet_store import ParquetChipDatabase
+        return ParquetChipDatabase()
+    if backend != 'sqlite':
+        raise ValueError(f"不支援的儲存後端: {backend}")
+    return ChipDatabase(read_only=read_only)
+
 if __name__ == "__main__":
-    # 測試資料庫功能
-    db = ChipDatabase()
-    
-    # 建立測試資料
-    import numpy as np
-    test_data = pd.DataFrame({
-        'date': ['2025-01-01'] * 5,
-        'stock_code': ['2330'] * 5,
-        '券商': ['9800', '9600', '9900', '1160', '5850'],
-        '分點': ['總公司', '台北', '新竹', '台中', '高雄'],
-        '買進股數': np.random.randint(1000, 50000, 5),
-        '賣出股數': np.random.randint(1000, 50000, 5),
-        '買進金額': np.random.randint(100000, 5000000, 5),
-        '賣出金額': np.random.randint(100000, 5000000, 5)
-    })
-    
-    # 測試插入資料
-    count = db.insert_broker_data(test_data)
-    print(f"插入了 {count} 筆測試資料")
-    
-    # 測試查詢資料
-    result = db.get_broker_data(stock_code='2330')
-    print(f"查詢結果: {len(result)} 筆資料")
-    print(result.head())
\ No newline at end of file
+    # 測試資料庫功能 (使用暫存資料庫，不寫入 DB_PATH 的正式資料庫)
+    import tempfile
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = ChipDatabase(Path(tmp_dir) / 'chip_data.db')
+        
+        # 建立測試資料
+        test_data = pd.DataFrame({
+            'date': ['2025-01-01'] * 5,
+            'stock_code': ['2330'] * 5,
+            '券商': ['9800', '9600', '9900', '1160', '5850'],
+            '分點': ['總公司', '台北', '新竹', '台中', '高雄'],
+            '買進股數': np.random.randint(1000, 50000, 5),
+            '賣出股數': np.random.randint(1000, 50000, 5),
+            '買進金額': np.random.randint(100000, 5000000, 5),
+            '賣出金額': np.random.randint(100000, 5000000, 5)
+        })
+        
+        # 測試插入資料
+        count = db.insert_broker_data(test_data)
+        print(f"插入了 {count} 筆測試資料")
+        
+        # 測試查詢資料
+        result = db.get_broker_data(stock_code='2330')
+        print(f"查詢結果: {len(result)} 筆資料")
+        print(result.head())
+        
+        # 檢查查詢計畫，有整表掃描時以非零狀態結束
+        offenders = db.audit_query_plans()
+        for name, scans in offenders.items():
+            print(f"整表掃描: {name} -> {scans}")
+        db.close()
+    
+    sys.exit(1 if offenders else 0)
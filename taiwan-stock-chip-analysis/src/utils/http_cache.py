@@ -0,0 +1,89 @@
+"""
+HTTP 回應快取
+以 (端點, 股票, 日期) 為鍵將交易所 API 的 JSON 回應存到磁碟
+過去交易日的資料不會再變動，永久有效；當日資料以 TTL 控制並透過 ETag / Last-Modified 重新驗證
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+# 添加專案根目錄到路徑
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+from config import *
+
+class HTTPCache:
+    """以檔案儲存的 API 回應快取 (每個鍵一個 JSON 檔)"""
+
+    def __init__(self, cache_dir: str = None, ttl: float = None):
+        """
+        Args:
+            cache_dir: 快取目錄，預設為 HTTP_CACHE_DIR
+            ttl: 當日資料的有效秒數，預設為 HTTP_CACHE_TTL
+        """
+        self.cache_dir = Path(cache_dir) if cache_dir else HTTP_CACHE_DIR
+        self.ttl = HTTP_CACHE_TTL if ttl is None else ttl
+        self.logger = logging.getLogger(__name__)
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, endpoint: str, date: str, stock_code: str = None) -> Path:
+        """快取檔路徑: <cache_dir>/<端點>/<YYYYMMDD>/<股票代碼>.json"""
+        return self.cache_dir / endpoint / date / f"{stock_code or '_all'}.json"
+
+    @staticmethod
+    def is_immutable_date(date: str) -> bool:
+        """早於今天的交易日資料已定案 (date 為 YYYYMMDD)"""
+        return date < datetime.now().strftime('%Y%m%d')
+
+    def get(self, endpoint: str, date: str, stock_code: str = None) -> Optional[Dict[str, Any]]:
+        """
+        讀取快取項目
+
+        Returns:
+            {'payload', 'fetched_at', 'etag', 'last_modified', 'immutable'}，沒有快取時為 None
+        """
+        path = self._path(endpoint, date, stock_code)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"快取檔損毀，將重新抓取: {path} ({e})")
+            return None
+
+    def is_fresh(self, entry: Dict[str, Any]) -> bool:
+        """快取項目是否可直接使用 (不需重新驗證)"""
+        if entry.get('immutable'):
+            return True
+        return time.time() - entry.get('fetched_at', 0) < self.ttl
+
+    def put(self, endpoint: str, date: str, stock_code: str = None, payload: Any = None,
+            etag: str = None, last_modified: str = None, immutable: bool = False) -> Dict[str, Any]:
+        """寫入快取項目 (先寫暫存檔再原子替換，並行寫入同一鍵也不會留下半個檔案)"""
+        entry = {
+            'payload': payload,
+            'fetched_at': time.time(),
+            'etag': etag,
+            'last_modified': last_modified,
+            'immutable': immutable
+        }
+
+        path = self._path(endpoint, date, stock_code)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            self.logger.warning(f"寫入快取失敗: {path} ({e})")
+
+        return entry
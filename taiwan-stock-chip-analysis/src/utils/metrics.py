@@ -0,0 +1,261 @@
+"""
+執行效能指標
+以計時器與計數器記錄各階段 (HTTP 請求、限速等待、解析、資料庫寫入與查詢、報告產生) 的耗時，
+輸出 JSON 執行摘要，並可選擇寫入 Prometheus textfile collector 格式的檔案
+"""
+import functools
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+# 添加專案根目錄到路徑
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+from config import *
+
+# 主要階段的計時器名稱 (依流程順序顯示)
+STAGES = [
+    'http.rate_limit_wait',
+    'http.request',
+    'http.parse_json',
+    'collector.parse_rows',
+    'db.insert',
+    'db.query',
+    'analysis.report',
+    'analysis.save',
+]
+
+class Metrics:
+    """執行緒安全的計時器與計數器"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """清除所有指標，重新開始計算一次執行"""
+        with self._lock:
+            self._timers: Dict[str, Dict[str, float]] = {}
+            self._counters: Dict[str, float] = {}
+            self.started_at = time.time()
+
+    def observe(self, name: str, seconds: float):
+        """記錄一次耗時"""
+        with self._lock:
+            timer = self._timers.get(name)
+            if timer is None:
+                timer = self._timers[name] = {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+            timer['count'] += 1
+            timer['seconds'] += seconds
+            timer['max_seconds'] = max(timer['max_seconds'], seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        """
+        計時區塊 (例外發生時仍會記錄)
+
+        用法:
+            with get_metrics().timer('db.insert'):
+                ...
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def increment(self, name: str, value: float = 1):
+        """累加計數器"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def snapshot(self) -> Dict[str, Any]:
+        """目前的指標 {'timers': {...}, 'counters': {...}}"""
+        with self._lock:
+            return {
+                'timers': {name: dict(timer) for name, timer in self._timers.items()},
+                'counters': dict(self._counters),
+            }
+
+    def merge(self, snapshot: Dict[str, Any]):
+        """併入其他行程的指標 (平行批量分析的子行程)"""
+        with self._lock:
+            for name, other in snapshot.get('timers', {}).items():
+                timer = self._timers.setdefault(name, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+                timer['count'] += other['count']
+                timer['seconds'] += other['seconds']
+                timer['max_seconds'] = max(timer['max_seconds'], other['max_seconds'])
+            for name, value in snapshot.get('counters', {}).items():
+                self._counters[name] = self._counters.get(name, 0) + value
+
+    def summary(self, run: str = None) -> Dict[str, Any]:
+        """
+        執行摘要
+
+        Returns:
+            {'run', 'started_at', 'finished_at', 'wall_seconds', 'timers', 'counters'}，
+            timers 依 STAGES 順序排列，其餘依耗時遞減
+        """
+        snapshot = self.snapshot()
+        finished_at = time.time()
+
+        def stage_order(name: str) -> int:
+            # 子項目 (如 db.query.get_broker_data) 排在所屬階段的位置
+            for i, stage in enumerate(STAGES):
+                if name == stage or name.startswith(stage + '.'):
+                    return i
+            return len(STAGES)
+
+        timers = dict(sorted(
+            snapshot['timers'].items(),
+            key=lambda item: (stage_order(item[0]), -item[1]['seconds'])
+        ))
+        for timer in timers.values():
+            timer['seconds'] = round(timer['seconds'], 6)
+            timer['max_seconds'] = round(timer['max_seconds'], 6)
+
+        return {
+            'run': run,
+            'started_at': datetime.fromtimestamp(self.started_at).isoformat(timespec='seconds'),
+            'finished_at': datetime.fromtimestamp(finished_at).isoformat(timespec='seconds'),
+            'wall_seconds': round(finished_at - self.started_at, 3),
+            'timers': timers,
+            'counters': snapshot['counters'],
+        }
+
+    def format_summary(self, run: str = None) -> str:
+        """將執行摘要排成文字表格 (日誌與終端機顯示用)"""
+        summary = self.summary(run)
+        lines = [f"執行摘要 {run or ''} - 總耗時 {summary['wall_seconds']:.1f} 秒"]
+        for name, timer in summary['timers'].items():
+            lines.append(f"  {name:<28} {timer['seconds']:>9.3f} 秒  {timer['count']:>7} 次  最長 {timer['max_seconds']:.3f} 秒")
+        for name, value in summary['counters'].items():
+            lines.append(f"  {name:<28} {value:>13,.0f}")
+        return '\n'.join(lines)
+
+    def write_summary(self, run: str, path: str = None) -> Path:
+        """
+        寫入 JSON 執行摘要
+
+        Args:
+            run: 執行名稱 (如 collect、daily_collection)
+            path: 輸出路徑，預設為 METRICS_DIR/<run>_<時間>.json
+
+        Returns:
+            輸出檔路徑
+        """
+        if path is None:
+            METRICS_DIR.mkdir(parents=True, exist_ok=True)
+            path = METRICS_DIR / f"{run}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        path = Path(path)
+
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(run), f, ensure_ascii=False, indent=2)
+        return path
+
+    def prometheus_text(self, run: str = None) -> str:
+        """以 Prometheus text exposition 格式輸出指標"""
+        summary = self.summary(run)
+        label = f',run="{run}"' if run else ''
+
+        lines = [
+            '# HELP chip_stage_seconds_total Time spent in each pipeline stage.',
+            '# TYPE chip_stage_seconds_total counter',
+        ]
+        lines += [f'chip_stage_seconds_total{{stage="{name}"{label}}} {timer["seconds"]}'
+                  for name, timer in summary['timers'].items()]
+
+        lines += [
+            '# HELP chip_stage_calls_total Number of timed calls per pipeline stage.',
+            '# TYPE chip_stage_calls_total counter',
+        ]
+        lines += [f'chip_stage_calls_total{{stage="{name}"{label}}} {timer["count"]}'
+                  for name, timer in summary['timers'].items()]
+
+        lines += [
+            '# HELP chip_stage_max_seconds Longest single call per pipeline stage.',
+            '# TYPE chip_stage_max_seconds gauge',
+        ]
+        lines += [f'chip_stage_max_seconds{{stage="{name}"{label}}} {timer["max_seconds"]}'
+                  for name, timer in summary['timers'].items()]
+
+        for name, value in summary['counters'].items():
+            metric = 'chip_' + re.sub(r'[^a-zA-Z0-9_]', '_', name) + '_total'
+            lines += [f'# TYPE {metric} counter', f'{metric}{{{label[1:]}}} {value}']
+
+        lines += [
+            '# HELP chip_run_wall_seconds Wall-clock duration of the run.',
+            '# TYPE chip_run_wall_seconds gauge',
+            f'chip_run_wall_seconds{{{label[1:]}}} {summary["wall_seconds"]}',
+            '# TYPE chip_run_finished_timestamp_seconds gauge',
+            f'chip_run_finished_timestamp_seconds{{{label[1:]}}} {time.time():.0f}',
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, run: str = None, path: str = None) -> Optional[Path]:
+        """
+        寫入 Prometheus textfile (先寫暫存檔再原子替換，避免 node_exporter 讀到半個檔案)
+
+        Args:
+            run: 執行名稱
+            path: 輸出路徑，預設為 METRICS_PROMETHEUS_FILE (未設定時不輸出)
+
+        Returns:
+            輸出檔路徑，未輸出時為 None
+        """
+        path = path or METRICS_PROMETHEUS_FILE
+        if not path:
+            return None
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.prometheus_text(run))
+        os.replace(tmp_path, path)
+        return path
+
+    def export(self, run: str) -> Optional[Path]:
+        """
+        寫入 JSON 執行摘要與 Prometheus textfile (已設定時)，失敗只記錄警告
+
+        Returns:
+            JSON 摘要路徑
+        """
+        logger = logging.getLogger(__name__)
+        try:
+            summary_path = self.write_summary(run)
+            self.write_prometheus(run)
+            return summary_path
+        except OSError as e:
+            logger.warning(f"寫入執行指標失敗: {e}")
+            return None
+
+_global_metrics = Metrics()
+
+def get_metrics() -> Metrics:
+    """取得全域共用的指標 (同一行程內所有元件共用)"""
+    return _global_metrics
+
+def timed(name: str) -> Callable:
+    """
+    將整個函式的執行時間記錄到指定計時器的裝飾器
+
+    用法:
+        @timed('db.query.get_broker_data')
+        def get_broker_data(self, ...):
+    """
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _global_metrics.timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,919 @@
+"""
+Parquet 欄式儲存後端
+以日期、股票分區的 Parquet 檔儲存券商分點資料，提供與 ChipDatabase 相同的查詢介面
+"""
+import pandas as pd
+import numpy as np
+import importlib.util
+import json
+import logging
+import os
+import shutil
+import sys
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
+
+# 添加專案根目錄到路徑
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+from config import *
+from src.utils.metrics import get_metrics, timed
+from src.utils.database import (
+    BROKER_TEXT_COLUMNS, BROKER_NUMERIC_COLUMNS, BROKER_INSERT_COLUMNS, QUOTE_INSERT_COLUMNS,
+    BRANCH_PNL_ORDER_COLUMNS, _text_column, _numeric_column, _normalize_dates, _analysis_aggregates
+)
+
+# 缺少 pyarrow 時的提示
+PYARROW_REQUIRED = "需要安裝 pyarrow 套件才能使用 Parquet 儲存後端，請執行: pip install -r requirements.txt (或 pip install pyarrow)"
+
+def pyarrow_available() -> bool:
+    """是否已安裝 pyarrow (只查找套件，不實際載入)"""
+    return importlib.util.find_spec('pyarrow') is not None
+
+# 分區檔內的欄位 (date, stock_code 由目錄名稱表示)
+PARTITION_COLUMNS = ['date', 'stock_code']
+FILE_COLUMNS = [column for column in BROKER_INSERT_COLUMNS if column not in PARTITION_COLUMNS]
+KEY_COLUMNS = ['broker_code', 'branch_name']
+
+class ParquetChipDatabase:
+    """以 Parquet 分區檔儲存券商分點資料的籌碼資料庫"""
+
+    def __init__(self, root_dir: str = None):
+        try:
+            import pyarrow as pa
+            import pyarrow.compute as pc
+            import pyarrow.dataset as ds
+            import pyarrow.fs as pafs
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError(PYARROW_REQUIRED)
+
+        self.pa, self.pc, self.ds, self.pq = pa, pc, ds, pq
+
+        self.root_dir = Path(root_dir) if root_dir else PARQUET_DATA_DIR
+        self.broker_dir = self.root_dir / "broker_trading"
+        self.broker_dir.mkdir(parents=True, exist_ok=True)
+        self.quotes_dir = self.root_dir / "daily_quotes"
+        self.progress_path = self.root_dir / "collection_progress.jsonl"
+        self._progress_lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+        # 讀取時以記憶體映射開檔，避免額外複製
+        self.filesystem = pafs.LocalFileSystem(use_mmap=True)
+
+        self.file_schema = pa.schema([
+            ('broker_code', pa.string()),
+            ('branch_name', pa.string()),
+            ('buy_volume', pa.int64()),
+            ('sell_volume', pa.int64()),
+            ('buy_amount', pa.int64()),
+            ('sell_amount', pa.int64()),
+        ])
+
+        # 每日行情依日期分區
+        self.quote_schema = pa.schema([
+            ('stock_code', pa.string()),
+            ('stock_name', pa.string()),
+            ('market', pa.string()),
+            ('open', pa.float64()),
+            ('high', pa.float64()),
+            ('low', pa.float64()),
+            ('close', pa.float64()),
+            ('change', pa.float64()),
+            ('volume', pa.int64()),
+            ('amount', pa.int64()),
+            ('transactions', pa.int64()),
+        ])
+
+        # 分區欄位固定為字串，避免股票代碼被推斷成整數
+        self.partitioning = ds.partitioning(
+            pa.schema([('date', pa.string()), ('stock_code', pa.string())]),
+            flavor='hive'
+        )
+
+    def _partition_path(self, date: str, stock_code: str) -> Path:
+        """取得 (日期, 股票) 分區的檔案路徑"""
+        return self.broker_dir / f"date={date}" / f"stock_code={stock_code}" / "part-0.parquet"
+
+    def _dataset(self):
+        """開啟 broker_trading 分區資料集"""
+        return self.ds.dataset(
+            str(self.broker_dir),
+            format='parquet',
+            partitioning=self.partitioning,
+            filesystem=self.filesystem
+        )
+
+    def close(self):
+        """與 ChipDatabase 介面一致 (Parquet 後端沒有長期連線)"""
+        pass
+
+    @contextmanager
+    def deferred_refresh(self):
+        """與 ChipDatabase 介面一致 (Parquet 後端沒有衍生統計表，查詢時直接由原始資料計算)"""
+        yield self
+
+    def insert_broker_data(self, df: pd.DataFrame, chunk_size: int = None) -> int:
+        """
+        插入券商分點資料
+
+        Args:
+            df: 包含券商分點資料的 DataFrame
+            chunk_size: 與 ChipDatabase 介面一致，Parquet 後端以分區為寫入單位
+
+        Returns:
+            寫入的記錄數量 (新增 + 取代)
+        """
+        stats = self.bulk_insert_broker_data(df, chunk_size)
+        return stats['inserted'] + stats['replaced']
+
+    @timed('db.insert.broker_data')
+    def bulk_insert_broker_data(self, df: pd.DataFrame, chunk_size: int = None) -> Dict[str, int]:
+        """
+        寫入券商分點資料到 (日期, 股票) 分區
+
+        每個分區與既有檔案合併，同一 (券商, 分點) 以新資料取代舊資料，
+        寫入暫存檔後再原子替換，與 SQLite 的 INSERT OR REPLACE 語意相同。
+
+        Args:
+            df: 包含券商分點資料的 DataFrame
+            chunk_size: 與 ChipDatabase 介面一致，不使用
+
+        Returns:
+            {'inserted': 新增筆數, 'replaced': 取代既有資料筆數}
+        """
+        stats = {'inserted': 0, 'replaced': 0}
+        if df is None or df.empty:
+            return stats
+
+        try:
+            # 與 ChipDatabase 相同的欄位轉換
+            columns = {target: _text_column(df, source) for source, target in BROKER_TEXT_COLUMNS}
+            columns['date'] = _normalize_dates(columns['date'])
+            columns.update({target: _numeric_column(df, source) for source, target in BROKER_NUMERIC_COLUMNS})
+            incoming = pd.DataFrame(columns)
+
+            for (date, stock_code), group in incoming.groupby(PARTITION_COLUMNS, sort=False):
+                group = group[FILE_COLUMNS].drop_duplicates(KEY_COLUMNS, keep='last')
+                path = self._partition_path(date, stock_code)
+
+                replaced = 0
+                if path.exists():
+                    existing = self.pq.read_table(path, schema=self.file_schema).to_pandas()
+                    merged = pd.concat([existing, group], ignore_index=True)
+                    before = len(merged)
+                    merged = merged.drop_duplicates(KEY_COLUMNS, keep='last')
+                    replaced = before - len(merged)
+                else:
+                    merged = group
+
+                path.parent.mkdir(parents=True, exist_ok=True)
+                table = self.pa.Table.from_pandas(merged, schema=self.file_schema, preserve_index=False)
+
+                tmp_path = path.with_suffix('.parquet.tmp')
+                self.pq.write_table(table, tmp_path, compression='zstd')
+                os.replace(tmp_path, path)
+
+                stats['inserted'] += len(group) - replaced
+                stats['replaced'] += replaced
+
+            get_metrics().increment('db.rows_written', stats['inserted'] + stats['replaced'])
+            self.logger.info(
+                f"成功寫入 {stats['inserted'] + stats['replaced']} 筆券商資料到 Parquet "
+                f"(新增 {stats['inserted']}，取代 {stats['replaced']})"
+            )
+            return stats
+
+        except Exception as e:
+            self.logger.error(f"插入券商資料失敗: {e}")
+            return stats
+
+    def _build_filter(self, stock_code: str = None, date: str = None,
+                      start_date: str = None, end_date: str = None,
+                      broker_code: str = None, branch_name: str = None,
+                      net_volume_band: Tuple[float, float] = None):
+        """建立推送到分區與檔案層級的篩選條件"""
+        field = self.ds.field
+        conditions = []
+
+        if stock_code:
+            conditions.append(field('stock_code') == stock_code)
+
+        if broker_code:
+            conditions.append(field('broker_code') == broker_code)
+            if branch_name:
+                conditions.append(field('branch_name') == branch_name)
+
+        if date:
+            conditions.append(field('date') == date)
+        else:
+            if start_date:
+                conditions.append(field('date') >= start_date)
+            if end_date:
+                conditions.append(field('date') <= end_date)
+
+        if net_volume_band is not None:
+            net_volume = self.pc.subtract(field('buy_volume'), field('sell_volume'))
+            conditions.append((net_volume < float(net_volume_band[0])) | (net_volume > float(net_volume_band[1])))
+
+        expression = None
+        for condition in conditions:
+            expression = condition if expression is None else expression & condition
+        return expression
+
+    def _read_table(self, columns: List[str], **filters):
+        """依條件讀取 Arrow Table (只讀取需要的分區與欄位)"""
+        return self._dataset().to_table(columns=columns, filter=self._build_filter(**filters))
+
+    def _with_net_columns(self, table):
+        """加上淨買賣股數與金額欄位"""
+        table = table.append_column('net_volume', self.pc.subtract(table['buy_volume'], table['sell_volume']))
+        return table.append_column('net_amount', self.pc.subtract(table['buy_amount'], table['sell_amount']))
+
+    @timed('db.query.get_broker_data')
+    def get_broker_data(self, stock_code: str = None, date: str = None,
+                        start_date: str = None, end_date: str = None,
+                        broker_code: str = None, branch_name: str = None) -> pd.DataFrame:
+        """
+        查詢券商分點資料
+
+        Args:
+            stock_code: 股票代碼
+            date: 特定日期
+            start_date: 起始日期
+            end_date: 結束日期
+            broker_code: 券商代碼
+            branch_name: 分點名稱 (需同時指定券商代碼)
+
+        Returns:
+            券商分點資料 DataFrame (欄位與 ChipDatabase.get_broker_data 相同)
+        """
+        try:
+            table = self._read_table(
+                BROKER_INSERT_COLUMNS,
+                stock_code=stock_code, date=date, start_date=start_date, end_date=end_date,
+                broker_code=broker_code, branch_name=branch_name
+            )
+
+            # 在 Arrow 內計算淨買賣與排序，最後一次轉成 DataFrame
+            table = self._with_net_columns(table)
+            table = table.sort_by([('date', 'descending'), ('net_volume', 'descending')])
+
+            df = table.to_pandas()
+
+            self.logger.info(f"查詢到 {len(df)} 筆券商資料")
+            return df
+
+        except Exception as e:
+            self.logger.error(f"查詢券商資料失敗: {e}")
+            return pd.DataFrame()
+
+    def iter_broker_data(self, stock_code: str = None, start_date: str = None,
+                         end_date: str = None, chunk_size: int = None,
+                         net_volume_band: Tuple[float, float] = None) -> Iterator[pd.DataFrame]:
+        """
+        依日期順序分段讀取券商分點資料 (介面與 ChipDatabase.iter_broker_data 相同)
+
+        分區檔依日期目錄排序後逐檔讀取，累積到 chunk_size 筆才轉成一段 DataFrame。
+
+        Args:
+            stock_code: 股票代碼
+            start_date: 起始日期
+            end_date: 結束日期
+            chunk_size: 每段筆數，預設為 ANALYSIS_CHUNK_SIZE
+            net_volume_band: (下限, 上限)，只讀取淨買賣股數落在區間外的資料
+
+        Yields:
+            券商分點資料 DataFrame (欄位與 get_broker_data 相同)
+        """
+        chunk_size = chunk_size or ANALYSIS_CHUNK_SIZE
+
+        try:
+            dataset = self._dataset()
+            expression = self._build_filter(
+                stock_code=stock_code, start_date=start_date, end_date=end_date,
+                net_volume_band=net_volume_band
+            )
+
+            # 分區路徑以 date=YYYY-MM-DD 開頭，依路徑排序即為日期順序
+            fragments = sorted(dataset.get_fragments(filter=expression), key=lambda fragment: fragment.path)
+
+            pending, pending_rows = [], 0
+            for fragment in fragments:
+                table = fragment.to_table(schema=dataset.schema, columns=BROKER_INSERT_COLUMNS, filter=expression)
+                if table.num_rows == 0:
+                    continue
+                pending.append(table)
+                pending_rows += table.num_rows
+
+                while pending_rows >= chunk_size:
+                    combined = self.pa.concat_tables(pending)
+                    yield self._with_net_columns(combined.slice(0, chunk_size)).to_pandas()
+                    rest = combined.slice(chunk_size)
+                    pending, pending_rows = [rest], rest.num_rows
+
+            if pending_rows:
+                yield self._with_net_columns(self.pa.concat_tables(pending)).to_pandas()
+
+        except Exception as e:
+            self.logger.error(f"分段查詢券商資料失敗: {e}")
+
+    @timed('db.query.get_analysis_aggregates')
+    def get_analysis_aggregates(self, stock_code: str = None, date: str = None,
+                                start_date: str = None, end_date: str = None) -> Dict:
+        """
+        在 Arrow 內完成券商、分點彙總與淨買賣股數統計 (介面與 ChipDatabase.get_analysis_aggregates 相同)
+
+        Returns:
+            {'總記錄數': 筆數, '券商彙總': DataFrame, '分點彙總': DataFrame,
+             '淨買賣統計': (筆數, 平均, 離均差平方和)}；查詢失敗時回傳空字典
+        """
+        try:
+            table = self._with_net_columns(self._read_table(
+                ['broker_code', 'branch_name', 'buy_volume', 'sell_volume', 'buy_amount', 'sell_amount'],
+                stock_code=stock_code, date=date, start_date=start_date, end_date=end_date
+            ))
+
+            grouped = table.group_by(KEY_COLUMNS).aggregate([
+                ('branch_name', 'count'),
+                ('buy_volume', 'sum'),
+                ('sell_volume', 'sum'),
+                ('buy_amount', 'sum'),
+                ('sell_amount', 'sum'),
+                ('net_volume', 'sum'),
+                ('net_amount', 'sum'),
+            ])
+            branches = grouped.to_pandas().rename(columns={
+                'broker_code': '券商',
+                'branch_name': '分點',
+                'branch_name_count': '筆數',
+                'buy_volume_sum': '買進股數',
+                'sell_volume_sum': '賣出股數',
+                'buy_amount_sum': '買進金額',
+                'sell_amount_sum': '賣出金額',
+                'net_volume_sum': '淨買賣股數',
+                'net_amount_sum': '淨買賣金額',
+            }).sort_values(['券商', '分點'], ignore_index=True)
+            aggregates = _analysis_aggregates(branches)
+
+            count, mean, _ = aggregates['淨買賣統計']
+            m2 = 0.0
+            if count:
+                deviation = self.pc.subtract(self.pc.cast(table['net_volume'], self.pa.float64()), mean)
+                m2 = self.pc.sum(self.pc.multiply(deviation, deviation)).as_py() or 0.0
+            aggregates['淨買賣統計'] = (count, mean, float(m2))
+
+            self.logger.info(f"彙總 {count} 筆券商資料 ({len(branches)} 個分點)")
+            return aggregates
+
+        except Exception as e:
+            self.logger.error(f"彙總券商資料失敗: {e}")
+            return {}
+
+    @timed('db.query.get_market_branch_totals')
+    def get_market_branch_totals(self, date: str = None, start_date: str = None,
+                                 end_date: str = None) -> pd.DataFrame:
+        """
+        查詢全市場各 (股票, 分點) 在區間內的買進與淨買賣股數 (介面與 ChipDatabase.get_market_branch_totals 相同)
+
+        單日時每個分區檔的 (股票, 分點) 已唯一，只讀取數值欄位；多日才以分點鍵在 Arrow 內分組。
+
+        Returns:
+            DataFrame (stock_code, buy_volume, net_volume)，每個 (股票, 分點) 一列
+        """
+        try:
+            single_day = date or (start_date and start_date == end_date)
+            key_columns = [] if single_day else KEY_COLUMNS
+            table = self._read_table(
+                ['stock_code'] + key_columns + ['buy_volume', 'sell_volume'],
+                date=date, start_date=start_date, end_date=end_date
+            )
+            table = table.append_column('net_volume', self.pc.subtract(table['buy_volume'], table['sell_volume']))
+
+            if not single_day:
+                table = table.group_by(['stock_code'] + KEY_COLUMNS).aggregate([
+                    ('buy_volume', 'sum'),
+                    ('net_volume', 'sum'),
+                ]).rename_columns(['stock_code'] + KEY_COLUMNS + ['buy_volume', 'net_volume'])
+            df = table.to_pandas()[['stock_code', 'buy_volume', 'net_volume']]
+
+            self.logger.info(f"查詢到 {len(df)} 筆全市場分點合計")
+            return df
+
+        except Exception as e:
+            self.logger.error(f"查詢全市場分點合計失敗: {e}")
+            return pd.DataFrame()
+
+    @timed('db.query.get_branch_footprint')
+    def get_branch_footprint(self, broker_code: str, branch_name: str = None,
+                             days: int = 30, limit: int = None) -> pd.DataFrame:
+        """
+        查詢券商分點的跨股票足跡 (介面與 ChipDatabase.get_branch_footprint 相同)
+
+        分區依日期、股票切分，券商 / 分點條件在讀取區間內的分區檔時過濾；
+        股票名稱取自同一區間的每日行情。
+        """
+        try:
+            end_date = datetime.now().strftime('%Y-%m-%d')
+            start_date = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+
+            table = self._with_net_columns(self._read_table(
+                ['date', 'stock_code', 'buy_volume', 'sell_volume', 'buy_amount', 'sell_amount'],
+                broker_code=broker_code, branch_name=branch_name, start_date=start_date, end_date=end_date
+            ))
+
+            grouped = table.group_by('stock_code').aggregate([
+                ('buy_volume', 'sum'),
+                ('sell_volume', 'sum'),
+                ('buy_amount', 'sum'),
+                ('sell_amount', 'sum'),
+                ('net_volume', 'sum'),
+                ('net_amount', 'sum'),
+                ('date', 'count_distinct'),
+                ('date', 'min'),
+                ('date', 'max'),
+            ])
+
+            df = grouped.to_pandas().rename(columns={
+                'buy_volume_sum': 'total_buy_volume',
+                'sell_volume_sum': 'total_sell_volume',
+                'buy_amount_sum': 'total_buy_amount',
+                'sell_amount_sum': 'total_sell_amount',
+                'net_volume_sum': 'total_net_volume',
+                'net_amount_sum': 'total_net_amount',
+                'date_count_distinct': 'trading_days',
+                'date_min': 'first_date',
+                'date_max': 'last_date',
+            })
+
+            quotes = self.get_daily_quotes(start_date=start_date, end_date=end_date)
+            names = quotes.drop_duplicates('stock_code').set_index('stock_code')['stock_name'] if not quotes.empty else {}
+            df['stock_name'] = df['stock_code'].map(names)
+
+            df = df.sort_values('total_net_amount', ascending=False, ignore_index=True)
+            if limit is not None:
+                df = df.head(limit)
+            return df[[
+                'stock_code', 'stock_name', 'total_buy_volume', 'total_sell_volume',
+                'total_buy_amount', 'total_sell_amount', 'total_net_volume', 'total_net_amount',
+                'trading_days', 'first_date', 'last_date'
+            ]]
+
+        except Exception as e:
+            self.logger.error(f"查詢分點足跡失敗: {e}")
+            return pd.DataFrame()
+
+    @timed('db.query.get_top_brokers')
+    def get_top_brokers(self, stock_code: str = None, days: int = 30, limit: int = 20) -> pd.DataFrame:
+        """
+        查詢熱門券商排行
+
+        Args:
+            stock_code: 股票代碼
+            days: 查詢天數
+            limit: 回傳數量限制
+
+        Returns:
+            券商排行 DataFrame (欄位與 ChipDatabase.get_top_brokers 相同)
+        """
+        try:
+            end_date = datetime.now().strftime('%Y-%m-%d')
+            start_date = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+
+            table = self._read_table(
+                ['broker_code', 'branch_name', 'buy_volume', 'sell_volume', 'buy_amount', 'sell_amount'],
+                stock_code=stock_code, start_date=start_date, end_date=end_date
+            )
+
+            grouped = table.group_by('broker_code').aggregate([
+                ('buy_volume', 'sum'),
+                ('sell_volume', 'sum'),
+                ('buy_amount', 'sum'),
+                ('sell_amount', 'sum'),
+                ('branch_name', 'count_distinct'),
+                ('branch_name', 'count'),
+            ])
+
+            df = grouped.to_pandas().rename(columns={
+                'buy_volume_sum': 'total_buy_volume',
+                'sell_volume_sum': 'total_sell_volume',
+                'buy_amount_sum': 'total_buy_amount',
+                'sell_amount_sum': 'total_sell_amount',
+                'branch_name_count_distinct': 'branch_count',
+                'branch_name_count': 'trading_days',
+            })
+            df['total_net_volume'] = df['total_buy_volume'] - df['total_sell_volume']
+            df['total_net_amount'] = df['total_buy_amount'] - df['total_sell_amount']
+
+            df = df.assign(abs_net_amount=df['total_net_amount'].abs()) \
+                .sort_values(['abs_net_amount', 'broker_code'], ascending=[False, True]).head(limit)
+            return df[[
+                'broker_code', 'total_buy_volume', 'total_sell_volume',
+                'total_buy_amount', 'total_sell_amount', 'total_net_volume', 'total_net_amount',
+                'branch_count', 'trading_days'
+            ]].reset_index(drop=True)
+
+        except Exception as e:
+            self.logger.error(f"查詢熱門券商失敗: {e}")
+            return pd.DataFrame()
+
+    @timed('db.query.get_daily_summary')
+    def get_daily_summary(self, stock_code: str = None, date: str = None,
+                          start_date: str = None, end_date: str = None) -> pd.DataFrame:
+        """
+        查詢每日摘要 (由分區資料即時計算，欄位與 ChipDatabase.get_daily_summary 相同)
+
+        Args:
+            stock_code: 股票代碼
+            date: 特定日期
+            start_date: 起始日期
+            end_date: 結束日期
+
+        Returns:
+            每日摘要 DataFrame
+        """
+        try:
+            table = self._read_table(
+                BROKER_INSERT_COLUMNS,
+                stock_code=stock_code, date=date, start_date=start_date, end_date=end_date
+            )
+            df = table.to_pandas()
+            if df.empty:
+                return pd.DataFrame()
+
+            df['net_volume'] = df['buy_volume'] - df['sell_volume']
+            df['net_amount'] = df['buy_amount'] - df['sell_amount']
+            day = df.groupby(PARTITION_COLUMNS, sort=False)
+
+            summary = pd.DataFrame({
+                'total_volume': day['buy_volume'].sum() + day['sell_volume'].sum(),
+                'total_amount': day['buy_amount'].sum() + day['sell_amount'].sum(),
+                'broker_count': day['broker_code'].nunique(),
+                'branch_count': day.size(),
+            })
+
+            # 買超/賣超第一名券商 (同額時取券商代碼較小者，沒有買超或賣超時為空值)
+            brokers = df.groupby(PARTITION_COLUMNS + ['broker_code'])['net_amount'].sum().reset_index()
+            brokers = brokers.sort_values('broker_code')
+            top_buyer = brokers[brokers['net_amount'] > 0] \
+                .sort_values('net_amount', ascending=False, kind='stable') \
+                .drop_duplicates(PARTITION_COLUMNS).set_index(PARTITION_COLUMNS)['broker_code']
+            top_seller = brokers[brokers['net_amount'] < 0] \
+                .sort_values('net_amount', ascending=True, kind='stable') \
+                .drop_duplicates(PARTITION_COLUMNS).set_index(PARTITION_COLUMNS)['broker_code']
+            summary['top_buyer_broker'] = top_buyer
+            summary['top_seller_broker'] = top_seller
+
+            # 與 ChipAnalyzer.detect_unusual_activity 相同的判斷: |淨買賣 - 平均| > k * 標準差
+            mean = day['net_volume'].transform('mean')
+            std = day['net_volume'].transform('std')
+            unusual = (df['net_volume'] - mean).abs() > UNUSUAL_STD_THRESHOLD * std
+            summary['unusual_activity_count'] = unusual.groupby([df['date'], df['stock_code']]).sum()
+
+            summary = summary.reset_index()
+            summary['unusual_activity_count'] = summary['unusual_activity_count'].fillna(0).astype('int64')
+            summary = summary.sort_values(['date', 'total_amount'], ascending=[False, False])
+
+            return summary[[
+                'date', 'stock_code', 'total_volume', 'total_amount', 'broker_count', 'branch_count',
+                'top_buyer_broker', 'top_seller_broker', 'unusual_activity_count'
+            ]].reset_index(drop=True)
+
+        except Exception as e:
+            self.logger.error(f"查詢每日摘要失敗: {e}")
+            return pd.DataFrame()
+
+    def has_branch_baseline(self, stock_code: str) -> bool:
+        """Parquet 後端不維護分點異常基準，分析時沿用全體標準差的異常判斷"""
+        return False
+
+    def get_unusual_trading(self, stock_code: str = None, date: str = None,
+                            start_date: str = None, end_date: str = None) -> pd.DataFrame:
+        """Parquet 後端不維護分點異常基準，回傳空的異常交易表 (欄位與 ChipDatabase 相同)"""
+        return pd.DataFrame(columns=['date', 'stock_code', 'broker_code', 'branch_name', 'net_volume',
+                                     'net_amount', 'anomaly_score', 'anomaly_type'])
+
+    def get_branch_accumulation_series(self, stock_code: str, broker_code: str, branch_name: str,
+                                       start_date: str = None, end_date: str = None) -> pd.DataFrame:
+        """
+        分點對某檔股票的每日累積淨買賣走勢 (介面與 ChipDatabase.get_branch_accumulation_series 相同)
+
+        Parquet 後端不維護累積表，讀取區間內該分點的資料後累加。
+        """
+        try:
+            table = self._with_net_columns(self._read_table(
+                ['date', 'buy_volume', 'sell_volume', 'buy_amount', 'sell_amount'],
+                stock_code=stock_code, broker_code=broker_code, branch_name=branch_name,
+                start_date=start_date, end_date=end_date
+            ))
+
+            df = table.select(['date', 'net_volume', 'net_amount']).to_pandas()
+            df = df.sort_values('date', ignore_index=True)
+            df['cum_net_volume'] = df['net_volume'].cumsum()
+            df['cum_net_amount'] = df['net_amount'].cumsum()
+            return df
+
+        except Exception as e:
+            self.logger.error(f"查詢分點累積走勢失敗: {e}")
+            return pd.DataFrame()
+
+    def get_branch_accumulation(self, stock_code: str, broker_code: str, branch_name: str,
+                                start_date: str = None, end_date: str = None) -> Dict:
+        """分點在區間內對某檔股票的累積淨買賣 (介面與 ChipDatabase.get_branch_accumulation 相同)"""
+        series = self.get_branch_accumulation_series(stock_code, broker_code, branch_name, start_date, end_date)
+
+        result = {'net_volume': 0, 'net_amount': 0, 'trading_days': 0, 'avg_cost': None}
+        if not series.empty:
+            result['net_volume'] = int(series['net_volume'].sum())
+            result['net_amount'] = int(series['net_amount'].sum())
+            result['trading_days'] = len(series)
+            if result['net_volume']:
+                result['avg_cost'] = result['net_amount'] / result['net_volume']
+        return result
+
+    def _mark_prices(self, stock_codes) -> pd.DataFrame:
+        """
+        股票的參考價: 最後交易日的收盤價，沒有行情時以當日全體分點的成交均價代替
+
+        Returns:
+            DataFrame (index 為 stock_code，欄位 mark_date、mark_price)
+        """
+        dataset = self._dataset()
+        latest = {}
+        for fragment in dataset.get_fragments(filter=self.ds.field('stock_code').isin(list(stock_codes))):
+            keys = self.ds.get_partition_keys(fragment.partition_expression)
+            if keys['date'] > latest.get(keys['stock_code'], ('', None))[0]:
+                latest[keys['stock_code']] = (keys['date'], fragment)
+
+        rows = []
+        for stock_code, (date, fragment) in latest.items():
+            table = fragment.to_table(schema=dataset.schema,
+                                      columns=['buy_volume', 'sell_volume', 'buy_amount', 'sell_amount'])
+            volume = self.pc.sum(table['buy_volume']).as_py() + self.pc.sum(table['sell_volume']).as_py()
+            amount = self.pc.sum(table['buy_amount']).as_py() + self.pc.sum(table['sell_amount']).as_py()
+            rows.append((stock_code, date, amount / volume if volume else np.nan))
+        marks = pd.DataFrame(rows, columns=['stock_code', 'mark_date', 'mark_price']).set_index('stock_code')
+
+        quotes = self.get_daily_quotes(start_date=marks['mark_date'].min(), end_date=marks['mark_date'].max())
+        if not quotes.empty:
+            closes = quotes[quotes['close'] > 0].set_index(['stock_code', 'date'])['close']
+            close = closes.reindex(pd.MultiIndex.from_arrays([marks.index, marks['mark_date']])).to_numpy()
+            marks['mark_price'] = np.where(np.isnan(close), marks['mark_price'], close)
+        return marks
+
+    @timed('db.query.get_branch_pnl')
+    def get_branch_pnl(self, stock_code: str = None, broker_code: str = None, branch_name: str = None,
+                       order_by: str = 'unrealized_pnl', ascending: bool = False, limit: int = 20) -> pd.DataFrame:
+        """
+        分點的持股成本與損益 (介面與 ChipDatabase.get_branch_pnl 相同)
+
+        Parquet 後端不維護持股成本表，讀取全部歷史後依日期逐日重播；
+        每一日以 NumPy 同時更新所有分點，規則與 COST_BASIS_UPDATE_SQL 相同。
+        """
+        try:
+            if order_by not in BRANCH_PNL_ORDER_COLUMNS:
+                raise ValueError(f"不支援的排序欄位: {order_by}")
+
+            df = self._read_table(
+                BROKER_INSERT_COLUMNS, stock_code=stock_code, broker_code=broker_code, branch_name=branch_name
+            ).to_pandas()
+            if df.empty:
+                return pd.DataFrame()
+
+            df = df.sort_values('date', ignore_index=True)
+            keys = df.groupby(['stock_code'] + KEY_COLUMNS, sort=False).ngroup().to_numpy()
+            size = keys.max() + 1
+
+            buy_volume, sell_volume = df['buy_volume'].to_numpy(), df['sell_volume'].to_numpy()
+            buy_price = np.divide(df['buy_amount'].to_numpy(), buy_volume, out=np.zeros(len(df)), where=buy_volume > 0)
+            sell_price = np.divide(df['sell_amount'].to_numpy(), sell_volume, out=np.zeros(len(df)), where=sell_volume > 0)
+            net = (buy_volume - sell_volume).astype(np.float64)
+            net_cost = net * np.where(net > 0, buy_price, sell_price)
+            intraday = np.where((buy_volume > 0) & (sell_volume > 0),
+                                np.minimum(buy_volume, sell_volume) * (sell_price - buy_price), 0.0)
+
+            position, cost, realized = np.zeros(size), np.zeros(size), np.zeros(size)
+            _, starts = np.unique(df['date'].to_numpy(), return_index=True)
+            bounds = list(starts[1:]) + [len(df)]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                for start, end in zip(starts, bounds):
+                    k, n, nc = keys[start:end], net[start:end], net_cost[start:end]
+                    p, c = position[k], cost[k]
+                    same = p * n >= 0
+                    reduce = ~same & (np.abs(n) <= np.abs(p))
+                    cost[k] = np.where(same, c + nc, np.where(reduce, c * (p + n) / p, (p + n) * nc / n))
+                    realized[k] += intraday[start:end] + np.where(
+                        same, 0.0, np.where(reduce, n * c / p - nc, p * nc / n - c))
+                    position[k] = p + n
+
+            groups = df.groupby(keys)
+            result = groups[['stock_code'] + KEY_COLUMNS].first()
+            result['position'] = position.astype(np.int64)
+            result['cost_basis'] = cost
+            result['realized_pnl'] = realized
+            result['trading_days'] = groups.size()
+            result['last_date'] = groups['date'].max()
+
+            marks = self._mark_prices(result['stock_code'].unique())
+            result = result[result['position'] != 0].join(marks, on='stock_code')
+            result['avg_cost'] = result['cost_basis'] / result['position']
+            result['unrealized_pnl'] = result['position'] * result['mark_price'] - result['cost_basis']
+
+            result = result.sort_values(order_by, ascending=ascending).head(limit)
+            return result[[
+                'stock_code', 'broker_code', 'branch_name', 'position', 'avg_cost', 'mark_price', 'mark_date',
+                'unrealized_pnl', 'realized_pnl', 'trading_days', 'last_date'
+            ]].reset_index(drop=True)
+
+        except Exception as e:
+            self.logger.error(f"查詢分點持股成本失敗: {e}")
+            return pd.DataFrame()
+
+    @timed('db.insert.daily_quotes')
+    def insert_daily_quotes(self, df: pd.DataFrame) -> int:
+        """寫入全市場每日行情到日期分區 (介面與 ChipDatabase.insert_daily_quotes 相同)"""
+        if df is None or df.empty:
+            return 0
+
+        try:
+            columns = [column for column in QUOTE_INSERT_COLUMNS if column != 'date']
+            written = 0
+            for date, group in df.groupby('date', sort=False):
+                path = self.quotes_dir / f"date={date}" / "part-0.parquet"
+                group = group[columns]
+                if path.exists():
+                    existing = self.pq.read_table(path, schema=self.quote_schema).to_pandas()
+                    group = pd.concat([existing, group], ignore_index=True)
+                group = group.drop_duplicates('stock_code', keep='last')
+
+                path.parent.mkdir(parents=True, exist_ok=True)
+                table = self.pa.Table.from_pandas(group, schema=self.quote_schema, preserve_index=False)
+                tmp_path = path.with_suffix('.parquet.tmp')
+                self.pq.write_table(table, tmp_path, compression='zstd')
+                os.replace(tmp_path, path)
+                written += len(df[df['date'] == date])
+
+            self.logger.info(f"成功寫入 {written} 筆每日行情到 Parquet")
+            return written
+
+        except Exception as e:
+            self.logger.error(f"插入每日行情失敗: {e}")
+            return 0
+
+    @timed('db.query.get_daily_quotes')
+    def get_daily_quotes(self, date: str = None, stock_code: str = None,
+                         start_date: str = None, end_date: str = None,
+                         market: str = None) -> pd.DataFrame:
+        """查詢全市場每日行情 (介面與 ChipDatabase.get_daily_quotes 相同)"""
+        try:
+            if not self.quotes_dir.exists():
+                return pd.DataFrame(columns=QUOTE_INSERT_COLUMNS)
+
+            dataset = self.ds.dataset(
+                str(self.quotes_dir),
+                format='parquet',
+                partitioning=self.ds.partitioning(self.pa.schema([('date', self.pa.string())]), flavor='hive'),
+                filesystem=self.filesystem
+            )
+
+            field = self.ds.field
+            conditions = []
+            if stock_code:
+                conditions.append(field('stock_code') == stock_code)
+            if date:
+                conditions.append(field('date') == date)
+            else:
+                if start_date:
+                    conditions.append(field('date') >= start_date)
+                if end_date:
+                    conditions.append(field('date') <= end_date)
+            if market:
+                conditions.append(field('market') == market)
+
+            expression = None
+            for condition in conditions:
+                expression = condition if expression is None else expression & condition
+
+            df = dataset.to_table(columns=QUOTE_INSERT_COLUMNS, filter=expression).to_pandas()
+            return df.sort_values(['date', 'stock_code'], ascending=[False, True], ignore_index=True)
+
+        except Exception as e:
+            self.logger.error(f"查詢每日行情失敗: {e}")
+            return pd.DataFrame()
+
+    def _read_progress(self) -> Dict[Tuple[str, str], Dict]:
+        """讀取回補進度 (同一股票、日期以最後一筆為準)"""
+        progress = {}
+        if not self.progress_path.exists():
+            return progress
+        with open(self.progress_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    progress[(record['stock_code'], record['date'])] = record
+        return progress
+
+    @timed('db.query.get_completed_dates')
+    def get_completed_dates(self, stock_code: str, start_date: str, end_date: str) -> set:
+        """
+        查詢已完成收集的日期 (介面與 ChipDatabase.get_completed_dates 相同)
+
+        包含已有分區檔的日期，以及進度檔中確認查無資料的過去日期。
+        """
+        try:
+            today = datetime.now().strftime('%Y-%m-%d')
+
+            completed = set()
+            for path in self.broker_dir.glob(f'date=*/stock_code={stock_code}/*.parquet'):
+                date = path.parent.parent.name.split('=', 1)[1]
+                if start_date <= date <= end_date:
+                    completed.add(date)
+
+            for (code, date), record in self._read_progress().items():
+                if code != stock_code or not (start_date <= date <= end_date):
+                    continue
+                if record['status'] == 'ok' or (record['status'] == 'empty' and date < today):
+                    completed.add(date)
+
+            return completed
+
+        except Exception as e:
+            self.logger.error(f"查詢收集進度失敗: {e}")
+            return set()
+
+    @timed('db.insert.progress')
+    def mark_collection_progress(self, stock_code: str, date: str, status: str,
+                                 row_count: int = 0, error: str = None) -> bool:
+        """記錄單一股票、日期的收集結果 (附加到進度檔)"""
+        try:
+            record = {
+                'stock_code': stock_code, 'date': date, 'status': status,
+                'row_count': int(row_count), 'error': error,
+                'updated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            }
+            with self._progress_lock, open(self.progress_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            return True
+
+        except Exception as e:
+            self.logger.error(f"記錄收集進度失敗: {e}")
+            return False
+
+    def cleanup_old_data(self, days_to_keep: int = 365) -> int:
+        """清理舊資料 (刪除早於保留期限的日期分區)"""
+        try:
+            cutoff_date = (datetime.now() - timedelta(days=days_to_keep)).strftime('%Y-%m-%d')
+
+            total_deleted = 0
+            for date_dir in self.broker_dir.glob('date=*'):
+                if date_dir.name.split('=', 1)[1] < cutoff_date:
+                    for path in date_dir.glob('stock_code=*/*.parquet'):
+                        total_deleted += self.pq.ParquetFile(path).metadata.num_rows
+                    shutil.rmtree(date_dir)
+
+            for date_dir in self.quotes_dir.glob('date=*'):
+                if date_dir.name.split('=', 1)[1] < cutoff_date:
+                    shutil.rmtree(date_dir)
+
+            # 回補進度一併移除過期日期
+            if self.progress_path.exists():
+                with self._progress_lock:
+                    kept = [record for record in self._read_progress().values() if record['date'] >= cutoff_date]
+                    tmp_path = self.progress_path.with_suffix('.jsonl.tmp')
+                    with open(tmp_path, 'w', encoding='utf-8') as f:
+                        f.writelines(json.dumps(record, ensure_ascii=False) + '\n' for record in kept)
+                    os.replace(tmp_path, self.progress_path)
+
+            self.logger.info(f"清理完成，刪除 {total_deleted} 筆舊資料")
+            return total_deleted
+
+        except Exception as e:
+            self.logger.error(f"清理資料失敗: {e}")
+            return 0
+
+if __name__ == "__main__":
+    # 測試 Parquet 儲存後端 (使用暫存目錄，不寫入 PARQUET_DATA_DIR)
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        store = ParquetChipDatabase(tmp_dir)
+
+        test_data = pd.DataFrame({
+            'date': ['2025-01-01'] * 5,
+            'stock_code': ['2330'] * 5,
+            '券商': ['9800', '9600', '9900', '1160', '5850'],
+            '分點': ['總公司', '台北', '新竹', '台中', '高雄'],
+            '買進股數': np.random.randint(1000, 50000, 5),
+            '賣出股數': np.random.randint(1000, 50000, 5),
+            '買進金額': np.random.randint(100000, 5000000, 5),
+            '賣出金額': np.random.randint(100000, 5000000, 5)
+        })
+
+        count = store.insert_broker_data(test_data)
+        print(f"插入了 {count} 筆測試資料")
+
+        result = store.get_broker_data(stock_code='2330')
+        print(f"查詢結果: {len(result)} 筆資料")
+        print(result.head())
@@ -0,0 +1,69 @@
+"""
+請求速率限制工具
+以權杖桶 (token bucket) 控制所有對交易所 API 的請求頻率
+"""
+import threading
+import time
+import sys
+import os
+from typing import Optional
+
+# 添加專案根目錄到路徑
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+from config import *
+
+class RateLimiter:
+    """執行緒安全的權杖桶速率限制器"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        """
+        Args:
+            rate: 每秒補充的權杖數 (即允許的每秒請求數)，0 表示不限速
+            burst: 權杖桶容量，允許的瞬間突發請求數
+        """
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+        self._tokens = float(self.burst)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: int = 1) -> float:
+        """
+        取得權杖，權杖不足時阻塞等待
+
+        Args:
+            tokens: 需要的權杖數
+
+        Returns:
+            實際等待的秒數
+        """
+        if self.rate <= 0:
+            return 0.0
+
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+                self._last_refill = now
+
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+
+                # 計算補足權杖所需時間，在鎖外等待
+                wait_time = (tokens - self._tokens) / self.rate
+
+            time.sleep(wait_time)
+            waited += wait_time
+
+_global_limiter: Optional[RateLimiter] = None
+_global_lock = threading.Lock()
+
+def get_rate_limiter() -> RateLimiter:
+    """取得全域共用的速率限制器 (依 config 的 REQUEST_RATE / REQUEST_BURST 建立)"""
+    global _global_limiter
+    with _global_lock:
+        if _global_limiter is None:
+            _global_limiter = RateLimiter(REQUEST_RATE, REQUEST_BURST)
+        return _global_limiter
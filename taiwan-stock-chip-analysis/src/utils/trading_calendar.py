@@ -0,0 +1,301 @@
+"""
+台股交易日曆
+由證交所休市日期表 (holidaySchedule) 建立，快取在本機 JSON 檔，
+無法連線時可由檔案匯入 (API 回應 JSON、CSV 或每行一個日期的文字檔)
+"""
+import csv
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import requests
+
+# 添加專案根目錄到路徑
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+from config import *
+from src.utils.rate_limiter import get_rate_limiter
+
+HOLIDAY_SCHEDULE_URL = f"{TWSE_WEB_BASE}/holidaySchedule/holidaySchedule"
+
+# 休市日期表中標示「開始交易」、「最後交易」的項目本身是交易日
+TRADING_MARKERS = ('開始交易', '最後交易')
+
+def _parse_date(text: str, year: int = None) -> Optional[str]:
+    """
+    解析休市日期表中的日期
+
+    支援 2024-01-01、2024/01/01、20240101、民國 113/01/01、1130101，以及搭配 year 的 1月1日
+
+    Returns:
+        YYYY-MM-DD，無法解析時為 None
+    """
+    text = str(text).strip()
+
+    match = re.fullmatch(r'(\d{2,4})[-/.](\d{1,2})[-/.](\d{1,2})', text)
+    if match:
+        y, m, d = (int(part) for part in match.groups())
+    else:
+        match = re.fullmatch(r'(\d{3,4})(\d{2})(\d{2})', text)
+        if match:
+            y, m, d = (int(part) for part in match.groups())
+        else:
+            match = re.fullmatch(r'(\d{1,2})月(\d{1,2})日', text)
+            if not match or year is None:
+                return None
+            y, (m, d) = year, (int(part) for part in match.groups())
+
+    # 民國年轉西元年
+    if y < 1911:
+        y += 1911
+
+    try:
+        return datetime(y, m, d).strftime('%Y-%m-%d')
+    except ValueError:
+        return None
+
+def _parse_holiday_rows(rows: List[Dict[str, str]], year: int = None) -> Dict[str, str]:
+    """由休市日期表的列 (名稱、日期、說明) 取出休市日 {日期: 名稱}"""
+    holidays = {}
+    for row in rows:
+        name = str(row.get('名稱') or row.get('Name') or '')
+        description = str(row.get('說明') or row.get('Description') or '')
+        date = _parse_date(row.get('日期') or row.get('Date') or '', year)
+
+        if not date:
+            continue
+        if any(marker in name or marker in description for marker in TRADING_MARKERS):
+            continue
+
+        holidays[date] = name or description
+    return holidays
+
+class TradingCalendar:
+    """台股交易日曆 (週一至週五且非休市日)"""
+
+    def __init__(self, cache_path: str = None, max_age_days: float = None):
+        """
+        Args:
+            cache_path: 本機快取檔，預設為 TRADING_CALENDAR_PATH
+            max_age_days: 今年及未來年度的休市表超過此天數即重新下載，預設為 TRADING_CALENDAR_MAX_AGE_DAYS
+        """
+        self.cache_path = Path(cache_path) if cache_path else TRADING_CALENDAR_PATH
+        self.max_age_days = TRADING_CALENDAR_MAX_AGE_DAYS if max_age_days is None else max_age_days
+        self.logger = logging.getLogger(__name__)
+
+        self._lock = threading.Lock()
+        self._years: Dict[str, Dict] = self._load_cache()
+        self._attempted = set()  # 本行程已嘗試下載的年度，失敗時不重複嘗試
+
+    def _load_cache(self) -> Dict[str, Dict]:
+        """讀取本機快取 {年度: {'fetched_at', 'holidays', 'manual'}}"""
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                return json.load(f).get('years', {})
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"交易日曆快取損毀，將重新建立: {e}")
+            return {}
+
+    def _save_cache(self):
+        """寫入本機快取 (暫存檔後原子替換)"""
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.cache_path.with_suffix('.json.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'years': self._years}, f, ensure_ascii=False, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.cache_path)
+
+    def _is_stale(self, year: int) -> bool:
+        """今年及未來年度的休市表可能新增臨時休市 (如颱風)，需定期更新"""
+        entry = self._years.get(str(year))
+        if entry is None or entry.get('fetched_at') is None:
+            return True
+        if year < datetime.now().year:
+            return False
+        return time.time() - entry['fetched_at'] > self.max_age_days * 86400
+
+    def fetch_year(self, year: int) -> bool:
+        """
+        由證交所下載指定年度的休市日期表並更新快取
+
+        Returns:
+            是否下載成功
+        """
+        params = {'response': 'json', 'queryYear': year - 1911}
+
+        try:
+            self.logger.info(f"正在下載 {year} 年休市日期表...")
+            get_rate_limiter().acquire()  # 與資料收集共用全域限速
+            response = requests.get(HOLIDAY_SCHEDULE_URL, params=params, timeout=TIMEOUT)
+            response.raise_for_status()
+
+            data = response.json()
+            if data.get('stat') != 'OK' or 'data' not in data:
+                self.logger.warning(f"休市日期表回應異常: {data.get('stat', 'Unknown')}")
+                return False
+
+            fields = data.get('fields', ['名稱', '日期', '星期', '說明'])
+            rows = [dict(zip(fields, row)) for row in data['data']]
+            holidays = _parse_holiday_rows(rows, year)
+            # 只保留該年度的日期 (表中可能附帶隔年元旦)
+            holidays = {date: name for date, name in holidays.items() if date.startswith(str(year))}
+
+            with self._lock:
+                entry = self._years.setdefault(str(year), {'manual': {}})
+                entry['holidays'] = holidays
+                entry['fetched_at'] = time.time()
+                self._save_cache()
+
+            self.logger.info(f"{year} 年休市日共 {len(holidays)} 天")
+            return True
+
+        except Exception as e:
+            self.logger.error(f"下載 {year} 年休市日期表失敗: {e}")
+            return False
+
+    def import_file(self, filepath: str, year: int = None) -> int:
+        """
+        由檔案匯入休市日 (離線更新)，匯入的日期與下載的資料分開保存，重新下載時不會被覆蓋
+
+        支援:
+            - 證交所 holidaySchedule API 的 JSON 回應
+            - 含「名稱、日期、說明」欄位的 CSV (證交所網站下載的格式)
+            - 每行一個日期的文字檔 (可在日期後以空白或逗號附註名稱)
+
+        Args:
+            filepath: 檔案路徑
+            year: 日期只有月日 (如 1月1日) 時使用的年度
+
+        Returns:
+            匯入的休市日數量
+        """
+        path = Path(filepath)
+        text = path.read_text(encoding='utf-8-sig')
+
+        if path.suffix.lower() == '.json':
+            data = json.loads(text)
+            fields = data.get('fields', ['名稱', '日期', '星期', '說明'])
+            rows = [dict(zip(fields, row)) if isinstance(row, list) else row for row in data.get('data', data)]
+            holidays = _parse_holiday_rows(rows, year)
+        elif path.suffix.lower() == '.csv':
+            lines = text.splitlines()
+            # 證交所的 CSV 在欄位列前可能有標題列
+            header_index = next((i for i, line in enumerate(lines) if '日期' in line), 0)
+            holidays = _parse_holiday_rows(list(csv.DictReader(lines[header_index:])), year)
+        else:
+            holidays = {}
+            for line in text.splitlines():
+                parts = re.split(r'[\s,]+', line.strip(), maxsplit=1)
+                date = _parse_date(parts[0], year) if parts[0] else None
+                if date:
+                    holidays[date] = parts[1] if len(parts) > 1 else '休市'
+
+        with self._lock:
+            for date, name in holidays.items():
+                entry = self._years.setdefault(date[:4], {'manual': {}, 'holidays': {}, 'fetched_at': None})
+                entry.setdefault('manual', {})[date] = name
+            self._save_cache()
+
+        self.logger.info(f"由 {path} 匯入 {len(holidays)} 個休市日")
+        return len(holidays)
+
+    def holidays(self, year: int) -> Dict[str, str]:
+        """
+        取得指定年度的休市日 {日期: 名稱}
+
+        快取沒有或過期時下載一次；無法下載時使用既有快取 (沒有快取則僅排除週末)。
+        """
+        if self._is_stale(year) and year not in self._attempted:
+            self._attempted.add(year)
+            if not self.fetch_year(year) and str(year) not in self._years:
+                self.logger.warning(f"無 {year} 年休市日期表，僅排除週末")
+
+        entry = self._years.get(str(year), {})
+        return {**entry.get('holidays', {}), **entry.get('manual', {})}
+
+    def is_trading_day(self, date: str) -> bool:
+        """
+        是否為交易日
+
+        Args:
+            date: 日期 (YYYY-MM-DD 或 YYYYMMDD)
+
+        Raises:
+            ValueError: 無法解析日期
+        """
+        parsed = _parse_date(date)
+        if parsed is None:
+            raise ValueError(f"無法解析日期: {date}")
+        date = parsed
+        day = datetime.strptime(date, '%Y-%m-%d')
+        if day.weekday() >= 5:
+            return False
+        return date not in self.holidays(day.year)
+
+    def trading_days(self, start_date: str, end_date: str) -> List[str]:
+        """
+        列出區間內的交易日
+
+        Args:
+            start_date: 開始日期 (YYYY-MM-DD)
+            end_date: 結束日期 (YYYY-MM-DD)
+
+        Returns:
+            交易日列表 (YYYY-MM-DD，遞增)
+        """
+        current = datetime.strptime(start_date, '%Y-%m-%d')
+        end = datetime.strptime(end_date, '%Y-%m-%d')
+
+        days = []
+        holidays_by_year = {}
+        while current <= end:
+            if current.year not in holidays_by_year:
+                holidays_by_year[current.year] = self.holidays(current.year)
+            date = current.strftime('%Y-%m-%d')
+            if current.weekday() < 5 and date not in holidays_by_year[current.year]:
+                days.append(date)
+            current += timedelta(days=1)
+        return days
+
+_global_calendar: Optional[TradingCalendar] = None
+_global_lock = threading.Lock()
+
+def get_trading_calendar() -> TradingCalendar:
+    """取得全域共用的交易日曆"""
+    global _global_calendar
+    with _global_lock:
+        if _global_calendar is None:
+            _global_calendar = TradingCalendar()
+        return _global_calendar
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='台股交易日曆維護')
+    parser.add_argument('--fetch', type=int, nargs='+', metavar='YEAR', help='下載指定年度的休市日期表')
+    parser.add_argument('--import', dest='import_file', metavar='FILE', help='由檔案匯入休市日 (離線更新)')
+    parser.add_argument('--year', type=int, help='匯入檔案的日期只有月日時使用的年度')
+    parser.add_argument('--show', type=int, metavar='YEAR', help='顯示指定年度的休市日')
+    args = parser.parse_args()
+
+    calendar = TradingCalendar()
+
+    for year in args.fetch or []:
+        calendar.fetch_year(year)
+
+    if args.import_file:
+        count = calendar.import_file(args.import_file, args.year)
+        print(f"匯入 {count} 個休市日")
+
+    if args.show:
+        for date, name in sorted(calendar.holidays(args.show).items()):
+            print(f"{date}  {name}")
@@ -0,0 +1,8 @@
+"""
+測試共用設定
+"""
+import os
+import sys
+
+# 添加專案根目錄到路徑
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,45 @@
+"""
+測試用合成資料
+"""
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+STOCKS = ['2330', '2454', '1101']
+BRANCHES = [(broker, branch) for broker in ('9800', '9600', '1160', '5850', '9200')
+            for branch in ('總公司', '台北', '台中')]
+
+def trading_dates(count: int) -> list:
+    """最近 count 天，由舊到新 (get_top_brokers 以今日為區間終點)"""
+    today = datetime.now()
+    return [(today - timedelta(days=offset)).strftime('%Y-%m-%d') for offset in range(count - 1, -1, -1)]
+
+def broker_frame(dates: list, seed: int = 7) -> pd.DataFrame:
+    """
+    合成券商分點資料 (TWSECollector 的欄位格式)
+
+    每日約七成分點有交易，含只買、只賣與同日買賣，部位會翻多翻空。
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for date in dates:
+        for stock_code in STOCKS:
+            price = 50 + STOCKS.index(stock_code) * 100 + rng.random() * 5
+            for broker_code, branch_name in BRANCHES:
+                if rng.random() > 0.7:
+                    continue
+                buy_volume, sell_volume = (int(volume) * 1000 for volume in rng.integers(0, 40, 2))
+                if not buy_volume and not sell_volume:
+                    continue
+                rows.append({
+                    'date': date,
+                    'stock_code': stock_code,
+                    '券商': broker_code,
+                    '分點': branch_name,
+                    '買進股數': buy_volume,
+                    '賣出股數': sell_volume,
+                    '買進金額': int(buy_volume * (price + rng.random())),
+                    '賣出金額': int(sell_volume * (price + rng.random())),
+                })
+    return pd.DataFrame(rows)
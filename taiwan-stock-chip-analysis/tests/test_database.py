@@ -0,0 +1,225 @@
+"""
+ChipDatabase 測試
+"""
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from config import BASELINE_MIN_DAYS, BASELINE_SPAN_DAYS, UNUSUAL_STD_THRESHOLD
+from src.utils.database import ChipDatabase
+from sample_data import STOCKS, broker_frame, trading_dates
+
+@pytest.fixture
+def database(tmp_path):
+    """建立在暫存目錄的資料庫 (不使用 DB_PATH 的正式資料庫)"""
+    db = ChipDatabase(tmp_path / 'chip_data.db')
+    yield db
+    db.close()
+
+@pytest.fixture(scope='module')
+def reinserted_database(tmp_path_factory):
+    """
+    依打亂順序逐日寫入 10 天資料，再以不同內容重新寫入其中三天的資料庫
+
+    重新寫入的日期同時含有被取代與新增的分點列。
+    """
+    db = ChipDatabase(tmp_path_factory.mktemp('reinserted') / 'chip_data.db')
+    dates = trading_dates(10)
+    broker_data = broker_frame(dates)
+    for index in np.random.default_rng(5).permutation(len(dates)):
+        db.insert_broker_data(broker_data[broker_data['date'] == dates[index]])
+    
+    replaced = broker_frame([dates[7], dates[2], dates[9]], seed=11)
+    for date in replaced['date'].unique():
+        db.insert_broker_data(replaced[replaced['date'] == date])
+    
+    yield db
+    db.close()
+
+def test_audit_query_plans_has_no_full_scans(database):
+    """熱門查詢與寫入時的衍生表更新語句都不應整表掃描"""
+    assert database.audit_query_plans() == {}
+
+def test_close_closes_other_thread_connections(tmp_path):
+    """close() 需關閉其他執行緒建立的連線"""
+    db = ChipDatabase(tmp_path / 'chip_data.db')
+    opened, closed = threading.Event(), threading.Event()
+    errors = []
+    
+    def worker():
+        conn = db.get_connection()
+        opened.set()
+        closed.wait()
+        try:
+            conn.execute('SELECT 1')
+        except sqlite3.ProgrammingError as e:
+            errors.append(e)
+    
+    thread = threading.Thread(target=worker)
+    thread.start()
+    opened.wait()
+    db.close()
+    closed.set()
+    thread.join()
+    
+    assert len(errors) == 1 and 'closed' in str(errors[0])
+
+# 最初版本 (未設定 user_version) 的 broker_trading 結構
+BASELINE_BROKER_TRADING_SQL = '''
+    CREATE TABLE broker_trading (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        date TEXT NOT NULL,
+        stock_code TEXT NOT NULL,
+        broker_code TEXT NOT NULL,
+        branch_name TEXT NOT NULL,
+        buy_volume INTEGER DEFAULT 0,
+        sell_volume INTEGER DEFAULT 0,
+        buy_amount INTEGER DEFAULT 0,
+        sell_amount INTEGER DEFAULT 0,
+        net_volume INTEGER GENERATED ALWAYS AS (buy_volume - sell_volume),
+        net_amount INTEGER GENERATED ALWAYS AS (buy_amount - sell_amount),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(date, stock_code, broker_code, branch_name)
+    )
+'''
+
+def test_version_zero_database_rebuilds_derived_tables(tmp_path):
+    """最初版本建立 (user_version 為 0) 且已有資料的資料庫，開啟時需補建衍生表"""
+    db_path = tmp_path / 'chip_data.db'
+    today = datetime.now()
+    dates = [(today - timedelta(days=offset)).strftime('%Y-%m-%d') for offset in (2, 1)]
+    rows = [
+        (date, '2330', broker_code, branch_name, 1000 * lots, 1000, 600000 * lots, 600000)
+        for date in dates
+        for broker_code, branch_name, lots in [('9800', '總公司', 5), ('9600', '台北', 3), ('1160', '台中', 0)]
+    ]
+    
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.execute(BASELINE_BROKER_TRADING_SQL)
+        conn.executemany('''
+            INSERT INTO broker_trading
+            (date, stock_code, broker_code, branch_name, buy_volume, sell_volume, buy_amount, sell_amount)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+    conn.close()
+    
+    db = ChipDatabase(db_path)
+    try:
+        assert len(db.get_top_brokers(stock_code='2330', days=30)) == 3
+        pd.testing.assert_frame_equal(db.get_top_brokers(days=30), db.get_top_brokers_raw(days=30))
+        assert len(db.get_daily_summary(stock_code='2330')) == 2
+        assert db.get_completed_dates('2330', dates[0], dates[-1]) == set(dates)
+    finally:
+        db.close()
+
+@pytest.mark.parametrize('stock_code', [None, STOCKS[0]])
+@pytest.mark.parametrize('days', [0, 2, 5, 30])
+def test_get_top_brokers_matches_raw(reinserted_database, stock_code, days):
+    """由彙總表加總的熱門券商排行需與直接彙總 broker_trading 相同"""
+    expected = reinserted_database.get_top_brokers_raw(stock_code=stock_code, days=days, limit=3)
+    actual = reinserted_database.get_top_brokers(stock_code=stock_code, days=days, limit=3)
+    
+    assert not expected.empty
+    pd.testing.assert_frame_equal(actual, expected)
+
+UNUSUAL_KEYS = ['date', 'stock_code', 'broker_code', 'branch_name']
+
+def _insert_by_day(db: ChipDatabase, broker_data: pd.DataFrame, dates: list):
+    """依 dates 的順序逐日寫入"""
+    for date in dates:
+        db.insert_broker_data(broker_data[broker_data['date'] == date])
+
+def _expected_unusual_trading(broker_data: pd.DataFrame) -> pd.DataFrame:
+    """
+    以 pandas ewm 獨立計算分點異常
+
+    每個分點依自身交易日計算指數加權平均與變異數 (adjust=False, bias=True)，
+    當日淨買賣股數對照前一交易日為止的基準評分。
+    """
+    df = broker_data.rename(columns={'券商': 'broker_code', '分點': 'branch_name'})
+    df['net_volume'] = df['買進股數'] - df['賣出股數']
+    df = df.sort_values('date', kind='stable')
+    
+    groups = df.groupby(['stock_code', 'broker_code', 'branch_name'])['net_volume']
+    alpha = 2.0 / (BASELINE_SPAN_DAYS + 1)
+    df['ewm_mean'] = groups.transform(lambda s: s.ewm(alpha=alpha, adjust=False).mean().shift())
+    df['ewm_var'] = groups.transform(lambda s: s.ewm(alpha=alpha, adjust=False).var(bias=True).shift())
+    df['observations'] = groups.cumcount()
+    
+    deviation = df['net_volume'] - df['ewm_mean']
+    df = df[(df['observations'] >= BASELINE_MIN_DAYS) & (df['ewm_var'] > 0)
+            & (deviation ** 2 > UNUSUAL_STD_THRESHOLD ** 2 * df['ewm_var'])].copy()
+    df['anomaly_score'] = (df['net_volume'] - df['ewm_mean']).abs() / np.sqrt(df['ewm_var'])
+    return df[UNUSUAL_KEYS + ['net_volume', 'anomaly_score']]
+
+def test_unusual_trading_independent_of_insert_order(tmp_path):
+    """依日期順序或打亂順序寫入，分點異常結果需相同"""
+    dates = trading_dates(40)
+    broker_data = broker_frame(dates)
+    shuffled = [dates[index] for index in np.random.default_rng(9).permutation(len(dates))]
+    
+    in_order = ChipDatabase(tmp_path / 'in_order.db')
+    out_of_order = ChipDatabase(tmp_path / 'out_of_order.db')
+    try:
+        _insert_by_day(in_order, broker_data, dates)
+        _insert_by_day(out_of_order, broker_data, shuffled)
+        
+        expected = in_order.get_unusual_trading().sort_values(UNUSUAL_KEYS, ignore_index=True)
+        actual = out_of_order.get_unusual_trading().sort_values(UNUSUAL_KEYS, ignore_index=True)
+        
+        assert not expected.empty
+        pd.testing.assert_frame_equal(actual, expected)
+    finally:
+        in_order.close()
+        out_of_order.close()
+
+def test_anomaly_score_matches_pandas_ewm(database):
+    """異常程度需與 pandas ewm 計算的分點基準偏離倍數相同"""
+    dates = trading_dates(40)
+    broker_data = broker_frame(dates, seed=13)
+    _insert_by_day(database, broker_data, dates)
+    
+    expected = _expected_unusual_trading(broker_data).sort_values(UNUSUAL_KEYS, ignore_index=True)
+    actual = database.get_unusual_trading().sort_values(UNUSUAL_KEYS, ignore_index=True)
+    
+    assert not expected.empty
+    pd.testing.assert_frame_equal(actual[expected.columns], expected, check_dtype=False, rtol=1e-9)
+
+SUMMARY_QUERY = '''
+    SELECT date, stock_code, total_volume, total_amount, broker_count, branch_count,
+           top_buyer_broker, top_seller_broker, unusual_activity_count
+    FROM daily_summary
+    ORDER BY date, stock_code
+'''
+
+def test_daily_summary_matches_rebuild(database):
+    """寫入、重新寫入與刪除後逐步維護的每日摘要，需與完整重建的結果相同"""
+    dates = trading_dates(12)
+    broker_data = broker_frame(dates)
+    _insert_by_day(database, broker_data, dates[::-1])
+    
+    replaced = broker_frame([dates[3], dates[8]], seed=17)
+    _insert_by_day(database, replaced, [dates[8], dates[3]])
+    
+    conn = database.get_connection()
+    with conn:
+        # 整日刪除與刪除單一股票部分分點
+        conn.execute('DELETE FROM broker_trading WHERE date = ?', (dates[5],))
+        conn.execute("DELETE FROM broker_trading WHERE date = ? AND stock_code = ? AND broker_code = '9800'",
+                     (dates[10], STOCKS[1]))
+    database.rebuild_derived_tables(dates[5], dates[5])
+    database.rebuild_derived_tables(dates[10], dates[10])
+    maintained = pd.read_sql_query(SUMMARY_QUERY, conn)
+    
+    with conn:
+        conn.execute('DELETE FROM daily_summary')
+    database.rebuild_derived_tables()
+    rebuilt = pd.read_sql_query(SUMMARY_QUERY, conn)
+    
+    assert dates[5] not in set(rebuilt['date'])
+    pd.testing.assert_frame_equal(maintained, rebuilt)
@@ -0,0 +1,86 @@
+"""
+ParquetChipDatabase 與 ChipDatabase 的查詢結果一致性測試
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyarrow')
+
+from src.utils.database import ChipDatabase
+from src.utils.parquet_store import ParquetChipDatabase
+from sample_data import BRANCHES, STOCKS, broker_frame, trading_dates
+
+TRADING_DAYS = 8
+
+def _quote_frame(date: str) -> pd.DataFrame:
+    """第一檔股票在最後一日的行情 (其餘股票以成交均價作為參考價)"""
+    return pd.DataFrame([{
+        'date': date, 'stock_code': STOCKS[0], 'stock_name': '台積電', 'market': 'TWSE',
+        'open': 52.0, 'high': 54.0, 'low': 51.0, 'close': 53.5, 'change': 1.5,
+        'volume': 1000000, 'amount': 53000000, 'transactions': 1000,
+    }])
+
+@pytest.fixture(scope='module')
+def backends(tmp_path_factory):
+    """
+    寫入相同資料的 (ChipDatabase, ParquetChipDatabase)
+
+    SQLite 依打亂的日期順序逐日寫入，一併驗證寫入較早日期時衍生表的重播。
+    """
+    root = tmp_path_factory.mktemp('backends')
+    dates = trading_dates(TRADING_DAYS)
+    broker_data = broker_frame(dates)
+
+    sqlite_db = ChipDatabase(root / 'chip_data.db')
+    parquet_db = ParquetChipDatabase(root / 'parquet')
+
+    order = np.random.default_rng(3).permutation(len(dates))
+    for index in order:
+        day = broker_data[broker_data['date'] == dates[index]]
+        sqlite_db.insert_broker_data(day)
+        parquet_db.insert_broker_data(day)
+
+    for db in (sqlite_db, parquet_db):
+        db.insert_daily_quotes(_quote_frame(dates[-1]))
+
+    yield sqlite_db, parquet_db, dates
+    sqlite_db.close()
+    parquet_db.close()
+
+@pytest.mark.parametrize('stock_code', [None, STOCKS[0]])
+def test_get_top_brokers_matches(backends, stock_code):
+    sqlite_db, parquet_db, _ = backends
+    expected = sqlite_db.get_top_brokers(stock_code=stock_code, days=30, limit=10)
+    actual = parquet_db.get_top_brokers(stock_code=stock_code, days=30, limit=10)
+
+    assert not expected.empty
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+
+@pytest.mark.parametrize('stock_code', [None, STOCKS[1]])
+def test_get_daily_summary_matches(backends, stock_code):
+    sqlite_db, parquet_db, dates = backends
+    expected = sqlite_db.get_daily_summary(stock_code=stock_code, start_date=dates[1], end_date=dates[-2])
+    actual = parquet_db.get_daily_summary(stock_code=stock_code, start_date=dates[1], end_date=dates[-2])
+
+    assert not expected.empty
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+
+@pytest.mark.parametrize('filters', [{}, {'stock_code': STOCKS[0]}, {'broker_code': '9800'},
+                                     {'broker_code': '9600', 'branch_name': '台北'}])
+def test_get_branch_pnl_matches(backends, filters):
+    sqlite_db, parquet_db, _ = backends
+    keys = ['stock_code', 'broker_code', 'branch_name']
+    expected = sqlite_db.get_branch_pnl(limit=1000, **filters).sort_values(keys, ignore_index=True)
+    actual = parquet_db.get_branch_pnl(limit=1000, **filters).sort_values(keys, ignore_index=True)
+
+    assert not expected.empty
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False, rtol=1e-9)
+
+def test_get_branch_accumulation_matches(backends):
+    sqlite_db, parquet_db, dates = backends
+    for broker_code, branch_name in BRANCHES:
+        for start_date, end_date in [(None, None), (dates[2], dates[5])]:
+            expected = sqlite_db.get_branch_accumulation(STOCKS[2], broker_code, branch_name, start_date, end_date)
+            actual = parquet_db.get_branch_accumulation(STOCKS[2], broker_code, branch_name, start_date, end_date)
+            assert actual == pytest.approx(expected)